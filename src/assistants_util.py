@@ -0,0 +1,140 @@
+"""
+Helper functions for waiting on Assistants API runs.
+
+Polling runs.retrieve once a second costs a request per second per run, and
+adds up to a second of latency to every run. Instead, we stream the run's
+events and return as soon as the run finishes. If the stream drops, we fall
+back to polling, starting with a short interval and backing off, since most
+runs take several seconds. Other errors (e.g. rate limits) are raised, so the
+caller's retries can back off.
+"""
+
+import time
+from dataclasses import dataclass
+
+import httpx
+from openai import APIConnectionError
+
+# Statuses where the run hasn't finished yet.
+PENDING_STATUSES = ["queued", "in_progress", "cancelling"]
+# Errors where the stream dropped, rather than the API turning us down.
+_STREAM_ERRORS = (APIConnectionError, httpx.TransportError, httpx.StreamError)
+
+
+@dataclass
+class PollingPolicy:
+    initial_interval_seconds: float = 0.25
+    max_interval_seconds: float = 2
+    multiplier: float = 1.5
+    # Give up (and cancel the run) after this long.
+    timeout_seconds: float = 600
+
+
+DEFAULT_POLLING_POLICY = PollingPolicy()
+
+
+@dataclass
+class RunResult:
+    run: any
+    # Only known when we streamed the run.
+    time_to_first_token_seconds: float = None
+    # How many times we had to call runs.retrieve.
+    num_polls: int = 0
+
+
+def poll_run(client, thread_id: str, run, policy: PollingPolicy = DEFAULT_POLLING_POLICY):
+    """
+    Polls until the run finishes, backing off between polls.
+
+    Returns:
+        (the last run we retrieved, number of polls)
+    """
+    interval = policy.initial_interval_seconds
+    deadline = time.monotonic() + policy.timeout_seconds
+    num_polls = 0
+    while run.status in PENDING_STATUSES:
+        if time.monotonic() > deadline:
+            print(f"[WARNING] run {run.id} timed out, cancelling it")
+            try:
+                client.beta.threads.runs.cancel(thread_id=thread_id, run_id=run.id)
+            except Exception as e:
+                print(f"[WARNING] failed to cancel run {run.id}: {e}")
+            break
+        time.sleep(interval)
+        interval = min(interval * policy.multiplier, policy.max_interval_seconds)
+        run = client.beta.threads.runs.retrieve(thread_id=thread_id, run_id=run.id)
+        num_polls += 1
+    return run, num_polls
+
+
+def _is_run_event(event) -> bool:
+    # Run step events (thread.run.step.*) carry a RunStep, not a Run.
+    return event.event.startswith("thread.run.") and not event.event.startswith(
+        "thread.run.step."
+    )
+
+
+def _get_active_run(client, thread_id: str):
+    """
+    Returns the thread's latest run if it hasn't finished yet, otherwise None.
+    A thread can only have one active run at a time.
+    """
+    runs = client.beta.threads.runs.list(thread_id=thread_id, limit=1)
+    for run in runs.data:
+        if run.status in PENDING_STATUSES:
+            return run
+    return None
+
+
+def run_and_wait(
+    client,
+    thread_id: str,
+    assistant_id: str,
+    use_streaming: bool = True,
+    policy: PollingPolicy = DEFAULT_POLLING_POLICY,
+    **kwargs,
+) -> RunResult:
+    """
+    Starts a run on the thread and waits for it to finish. `kwargs` are
+    passed along to runs.create (e.g. additional_instructions).
+
+    The client is blocking, so to wait on many runs at once, call this from
+    several threads (see concurrency_util.run_concurrently). Each call only
+    holds its own stream open, so there's no polling traffic to add up.
+    """
+    start = time.monotonic()
+    run = None
+    if use_streaming:
+        first_token_at = None
+        try:
+            with client.beta.threads.runs.stream(
+                thread_id=thread_id, assistant_id=assistant_id, **kwargs
+            ) as stream:
+                for event in stream:
+                    if event.event == "thread.message.delta" and first_token_at is None:
+                        first_token_at = time.monotonic()
+                    elif _is_run_event(event):
+                        run = event.data
+        except _STREAM_ERRORS as e:
+            print(f"[WARNING] run stream failed, falling back to polling: {e}")
+
+        time_to_first_token = (
+            first_token_at - start if first_token_at is not None else None
+        )
+        if run is not None:
+            # If the stream dropped part way, the run is still going on the
+            # server, so poll it instead of starting a new one.
+            run, num_polls = poll_run(client, thread_id, run, policy)
+            return RunResult(run, time_to_first_token, num_polls)
+        # The stream may have dropped after the server created the run but
+        # before we heard about it. Starting another one would be rejected.
+        run = _get_active_run(client, thread_id)
+        if run is not None:
+            run, num_polls = poll_run(client, thread_id, run, policy)
+            return RunResult(run, time_to_first_token, num_polls)
+
+    run = client.beta.threads.runs.create(
+        thread_id=thread_id, assistant_id=assistant_id, **kwargs
+    )
+    run, num_polls = poll_run(client, thread_id, run, policy)
+    return RunResult(run, None, num_polls)
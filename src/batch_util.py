@@ -0,0 +1,263 @@
+"""
+Helper functions for running inference through the Batch API instead of one
+chat completion at a time. Our experiments are offline evaluations, so we
+don't need answers right away, and batches are half the price and don't count
+against our per-minute rate limits.
+
+The flow is:
+    1. write every request to a JSONL file (one line per chat completion)
+    2. submit it with a backend
+    3. poll until the batch is done
+    4. read back a ChatCompletion for each request
+
+There are two backends. OpenAIBatchBackend uses the real Batch API.
+LocalBatchBackend runs the file against a client on this machine
+(FakeOpenAI by default), so the whole pipeline can be dry-run offline.
+"""
+
+import json
+import os
+import threading
+import time
+import uuid
+from dataclasses import dataclass, field
+
+from openai.types.chat import ChatCompletion
+from cache_util import make_cache_key
+from concurrency_util import run_concurrently
+import inference_util
+from private import ROOT_DIR
+
+BATCH_DIR = f"{ROOT_DIR}/out/batches"
+BATCH_ENDPOINT = "/v1/chat/completions"
+# The Batch API doesn't allow more than this many requests in one file.
+MAX_REQUESTS_PER_BATCH = 50000
+DEFAULT_POLL_INTERVAL_SECONDS = 30
+# Once a batch is in one of these states, it won't change anymore.
+TERMINAL_STATUSES = ["completed", "failed", "expired", "cancelled"]
+
+
+@dataclass
+class BatchRequest:
+    custom_id: str
+    model_string: str
+    messages: any
+    ensemble_index: int = 0
+    params: dict = field(default_factory=dict)
+
+    def to_json_line(self) -> str:
+        return json.dumps(
+            {
+                "custom_id": self.custom_id,
+                "method": "POST",
+                "url": BATCH_ENDPOINT,
+                "body": {
+                    "model": self.model_string,
+                    "messages": self.messages,
+                    **self.params,
+                },
+            }
+        )
+
+
+class OpenAIBatchBackend:
+    """Submits batches to the openAI Batch API."""
+
+    # Results from the real API are shared with the synchronous path through
+    # the response cache.
+    is_dry_run = False
+
+    def __init__(self, client):
+        self.client = client
+
+    def submit(self, input_path: str) -> str:
+        with open(input_path, "rb") as file:
+            batch_file = self.client.files.create(file=file, purpose="batch")
+        batch = self.client.batches.create(
+            input_file_id=batch_file.id,
+            endpoint=BATCH_ENDPOINT,
+            completion_window="24h",
+        )
+        return batch.id
+
+    def poll(self, batch_id: str) -> str:
+        return self.client.batches.retrieve(batch_id).status
+
+    def fetch_results(self, batch_id: str) -> "list[str]":
+        """Returns the output lines, including the ones for failed requests."""
+        batch = self.client.batches.retrieve(batch_id)
+        lines = []
+        for file_id in [batch.output_file_id, batch.error_file_id]:
+            if file_id is None:
+                continue
+            lines.extend(self.client.files.content(file_id).text.splitlines())
+        return lines
+
+
+class LocalBatchBackend:
+    """
+    Stand-in for the Batch API. Each submitted file is run in the background
+    against `client` and the output is written next to the input file in the
+    same format the Batch API uses.
+
+    The responses are fake, so they must never end up in the response cache.
+    """
+
+    is_dry_run = True
+
+    def __init__(self, client=None, max_concurrency: int = 16):
+        if client is None:
+            from fake_client import FakeOpenAI
+
+            client = FakeOpenAI(latency_seconds=0.1)
+        self.client = client
+        self.max_concurrency = max_concurrency
+        self._batches = {}
+
+    def _run_request(self, line: str) -> str:
+        request = json.loads(line)
+        result = {
+            "id": f"batch_req_{uuid.uuid4().hex}",
+            "custom_id": request["custom_id"],
+            "response": None,
+            "error": None,
+        }
+        try:
+            response = self.client.chat.completions.create(**request["body"])
+            result["response"] = {
+                "status_code": 200,
+                "body": response.model_dump(mode="json"),
+            }
+        except Exception as e:
+            result["error"] = {"code": type(e).__name__, "message": str(e)}
+        return json.dumps(result)
+
+    def _run_batch(self, input_path: str, output_path: str):
+        with open(input_path, "r") as file:
+            lines = [line for line in file if line.strip()]
+        outputs = run_concurrently(
+            [lambda line=line: self._run_request(line) for line in lines],
+            max_concurrency=self.max_concurrency,
+        )
+        with open(output_path, "w") as file:
+            for output in outputs:
+                file.write(output + "\n")
+
+    def submit(self, input_path: str) -> str:
+        batch_id = f"local_batch_{uuid.uuid4().hex}"
+        output_path = f"{os.path.splitext(input_path)[0]}_output.jsonl"
+        thread = threading.Thread(
+            target=self._run_batch, args=(input_path, output_path), daemon=True
+        )
+        thread.start()
+        self._batches[batch_id] = (thread, output_path)
+        return batch_id
+
+    def poll(self, batch_id: str) -> str:
+        thread, output_path = self._batches[batch_id]
+        if thread.is_alive():
+            return "in_progress"
+        # If the worker thread crashed, there won't be any output.
+        return "completed" if os.path.exists(output_path) else "failed"
+
+    def fetch_results(self, batch_id: str) -> "list[str]":
+        _, output_path = self._batches[batch_id]
+        if not os.path.exists(output_path):
+            return []
+        with open(output_path, "r") as file:
+            return file.read().splitlines()
+
+
+def _parse_output_line(line: str):
+    """Returns (custom_id, ChatCompletion or None)."""
+    result = json.loads(line)
+    custom_id = result["custom_id"]
+    response = result.get("response")
+    if result.get("error") or response is None or response["status_code"] != 200:
+        error = result.get("error") or (response or {}).get("body")
+        print(f"[ERROR] batch request {custom_id} failed: {error}")
+        return custom_id, None
+    return custom_id, ChatCompletion.model_validate(response["body"])
+
+
+def _wait_for_batch(backend, batch_id: str, poll_interval_seconds: float) -> str:
+    start = time.monotonic()
+    while True:
+        status = backend.poll(batch_id)
+        if status in TERMINAL_STATUSES:
+            return status
+        print(
+            f"   batch {batch_id} is {status} "
+            f"({time.monotonic() - start:.0f}s elapsed)"
+        )
+        time.sleep(poll_interval_seconds)
+
+
+def run_batch(
+    backend,
+    requests: "list[BatchRequest]",
+    name: str,
+    poll_interval_seconds: float = DEFAULT_POLL_INTERVAL_SECONDS,
+) -> "dict[str, ChatCompletion]":
+    """
+    Runs every request through `backend` and blocks until the results are
+    back. Requests that are already in the response cache aren't submitted,
+    and new responses are added to the cache, so the batch and synchronous
+    paths share results. Dry-run backends (see LocalBatchBackend) skip the
+    cache completely, and write their files under BATCH_DIR/dry_run.
+
+    Returns:
+        dict of custom id to ChatCompletion. Requests that failed map to None.
+    """
+    use_cache = inference_util.USE_RESPONSE_CACHE and not backend.is_dry_run
+    batch_dir = f"{BATCH_DIR}/dry_run" if backend.is_dry_run else BATCH_DIR
+    results = {}
+    pending = []
+    cache_keys = {}
+    for request in requests:
+        cache_key = make_cache_key(
+            request.model_string,
+            request.messages,
+            request.params,
+            request.ensemble_index,
+        )
+        cache_keys[request.custom_id] = cache_key
+        cached = None
+        if use_cache:
+            cached = inference_util.RESPONSE_CACHE.get(cache_key)
+        if cached is not None:
+            results[request.custom_id] = ChatCompletion.model_validate_json(cached)
+        else:
+            pending.append(request)
+    print(f"{len(results)} requests were cached, submitting {len(pending)}")
+
+    os.makedirs(batch_dir, exist_ok=True)
+    for start in range(0, len(pending), MAX_REQUESTS_PER_BATCH):
+        chunk = pending[start : start + MAX_REQUESTS_PER_BATCH]
+        input_path = f"{batch_dir}/{name}_{start // MAX_REQUESTS_PER_BATCH}.jsonl"
+        with open(input_path, "w") as file:
+            for request in chunk:
+                file.write(request.to_json_line() + "\n")
+
+        batch_id = backend.submit(input_path)
+        print(f"submitted {len(chunk)} requests from {input_path} as {batch_id}")
+        status = _wait_for_batch(backend, batch_id, poll_interval_seconds)
+        if status != "completed":
+            # Expired batches still return whatever finished in time.
+            print(f"[WARNING] batch {batch_id} ended with status {status}")
+
+        for line in backend.fetch_results(batch_id):
+            if not line.strip():
+                continue
+            custom_id, response = _parse_output_line(line)
+            results[custom_id] = response
+            if response is not None and use_cache:
+                inference_util.RESPONSE_CACHE.put(
+                    cache_keys[custom_id], response.model_dump_json()
+                )
+
+    for request in pending:
+        if request.custom_id not in results:
+            print(f"[ERROR] batch is missing a result for {request.custom_id}")
+            results[request.custom_id] = None
+    return results
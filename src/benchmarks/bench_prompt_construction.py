@@ -0,0 +1,80 @@
+"""
+Micro-benchmark for building every few-shot prompt of a full year sweep.
+
+Compares building the exemplar messages (and formatting every question) from
+scratch for each prompt, which is what we used to do, against the memoized
+exemplar blocks in prompt_util.
+"""
+
+import os
+import sys
+import time
+
+# Hack to import from parent dir
+parent_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(parent_dir)
+import prompt_util
+from data_util import (
+    Category,
+    ContentType,
+    QuestionsBuilder,
+    get_n_examples_from_each_category,
+)
+from prompt_util import create_prompt
+from token_util import get_prompt_token_budget
+
+YEARS = [2009, 2010, 2011, 2012, 2013]
+MODEL_STRING = "gpt-4o"
+PREAMBLE = "You are a board certified hand surgeon taking a multiple choice exam."
+
+
+def _clear_caches(questions):
+    prompt_util._EXEMPLAR_BLOCK_CACHE.clear()
+    for q in questions:
+        q._formatted_question = None
+        q._clean_commentary = None
+
+
+def _build_prompts(exemplars, eval_sets, use_cache: bool):
+    token_budget = get_prompt_token_budget(MODEL_STRING)
+    num_prompts = 0
+    start = time.perf_counter()
+    for eval_set in eval_sets:
+        for entry in eval_set:
+            if not use_cache:
+                _clear_caches(exemplars + [entry])
+            create_prompt(
+                PREAMBLE,
+                exemplars,
+                entry,
+                token_budget=token_budget,
+                model_string=MODEL_STRING,
+            )
+            num_prompts += 1
+    return num_prompts, time.perf_counter() - start
+
+
+exemplars = get_n_examples_from_each_category(
+    QuestionsBuilder()
+    .year(2008)
+    .question_content_type(ContentType.TEXT_ONLY)
+    .commentary_content_type(ContentType.TEXT_ONLY)
+    .build(),
+    1,
+    list(Category),
+)
+eval_sets = [QuestionsBuilder().year(year).build() for year in YEARS]
+
+num_prompts, uncached = _build_prompts(exemplars, eval_sets, use_cache=False)
+_clear_caches(exemplars + [q for eval_set in eval_sets for q in eval_set])
+_, cached = _build_prompts(exemplars, eval_sets, use_cache=True)
+print(f"built {num_prompts} prompts with {len(exemplars)} exemplars")
+print(
+    f"rebuilding exemplars every prompt: {uncached:.2f}s "
+    f"({uncached / num_prompts * 1000:.2f}ms per prompt)"
+)
+print(
+    f"memoized exemplar blocks: {cached:.2f}s "
+    f"({cached / num_prompts * 1000:.2f}ms per prompt)"
+)
+print(f"speedup: {uncached / cached:.1f}x")
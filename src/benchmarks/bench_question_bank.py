@@ -0,0 +1,72 @@
+"""
+Micro-benchmark for building, filtering and sorting the full multi-year
+question bank.
+
+Compares the fields that ExamQuestion now precomputes at construction against
+re-running the regex / media scans on every call (which is what we used to
+do).
+"""
+
+import os
+import re
+import sys
+import time
+
+# Hack to import from parent dir
+parent_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(parent_dir)
+from data_util import QuestionsBuilder
+
+YEARS = [2008, 2009, 2010, 2011, 2012, 2013]
+NUM_ROUNDS = 100
+
+
+def _legacy_get_year(q):
+    match = re.search(r"\b\d{4}\b", q.origination_exam)
+    return int(match.group()) if match else None
+
+
+def _legacy_get_question_number(q):
+    match = re.search(r"Q(\d+)", q.title, flags=re.IGNORECASE)
+    return int(match.group(1)) if match else None
+
+
+def _legacy_question_has_text_only(q):
+    return len([m for m in q.media if m.show_in_question]) == 0
+
+
+def _legacy_sort_and_filter(bank):
+    for year in YEARS:
+        questions = [q for q in bank if _legacy_get_year(q) == year]
+        questions = [q for q in questions if _legacy_question_has_text_only(q)]
+        questions.sort(
+            key=lambda q: (_legacy_get_year(q), _legacy_get_question_number(q))
+        )
+
+
+def _sort_and_filter(bank):
+    for year in YEARS:
+        questions = [q for q in bank if q.get_year() == year]
+        questions = [q for q in questions if q.question_has_text_only()]
+        questions.sort(key=lambda q: (q.get_year(), q.get_question_number()))
+
+
+def _time_per_round(fn, num_rounds):
+    start = time.perf_counter()
+    for _ in range(num_rounds):
+        fn()
+    return (time.perf_counter() - start) / num_rounds
+
+
+start = time.perf_counter()
+bank = QuestionsBuilder().keep_video(True).build()
+print(f"built {len(bank)} questions in {time.perf_counter() - start:.3f}s (cold)")
+
+warm_build = _time_per_round(lambda: QuestionsBuilder().keep_video(True).build(), 10)
+print(f"build (warm): {warm_build * 1000:.2f}ms")
+
+legacy = _time_per_round(lambda: _legacy_sort_and_filter(bank), NUM_ROUNDS)
+precomputed = _time_per_round(lambda: _sort_and_filter(bank), NUM_ROUNDS)
+print(f"filter + sort every year (regex per call): {legacy * 1000:.2f}ms")
+print(f"filter + sort every year (precomputed): {precomputed * 1000:.2f}ms")
+print(f"speedup: {legacy / precomputed:.1f}x")
@@ -0,0 +1,77 @@
+"""
+Micro-benchmark for parsing saved responses.
+
+Uses every response in the response cache (see cache_util) as the corpus.
+Compares searching each response once per tag with a raw pattern string
+(which is what we used to do) against the single-pass scan in parse_util.
+"""
+
+import json
+import os
+import re
+import sqlite3
+import sys
+import time
+
+# Hack to import from parent dir
+parent_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(parent_dir)
+from cache_util import DEFAULT_CACHE_PATH
+from parse_util import scan_tags
+
+NUM_ROUNDS = 5
+
+
+def _read_corpus(path):
+    conn = sqlite3.connect(path)
+    texts = []
+    for (value,) in conn.execute("SELECT value FROM responses"):
+        for choice in json.loads(value).get("choices", []):
+            content = choice["message"]["content"]
+            if content:
+                texts.append(content)
+    conn.close()
+    return texts
+
+
+def _legacy_parse(txt):
+    match = re.search(
+        r"<discussion>(.*?)<\/discussion>\s*<answer>(.*?)<\/answer>", txt, re.DOTALL
+    )
+    discussion, answer = (match.group(1), match.group(2)) if match else (None, None)
+    match = re.search(r"<answer>(.*?)<\/answer>", txt, re.DOTALL)
+    first_answer = match.group(1) if match else None
+    match = re.search(r"<finalAnswer>(.*?)<\/finalAnswer>", txt, re.DOTALL)
+    final_answer = match.group(1) if match else None
+    return discussion, answer, first_answer, final_answer
+
+
+def _scan_parse(txt):
+    tags = scan_tags(txt)
+    return tags.discussion, tags.answer, tags.first_answer, tags.final_answer
+
+
+def _time_per_round(fn, texts, num_rounds):
+    start = time.perf_counter()
+    for _ in range(num_rounds):
+        for txt in texts:
+            fn(txt)
+    return (time.perf_counter() - start) / num_rounds
+
+
+start = time.perf_counter()
+texts = _read_corpus(DEFAULT_CACHE_PATH)
+read_seconds = time.perf_counter() - start
+print(
+    f"read {len(texts)} responses "
+    f"({sum(len(t) for t in texts) / 1e6:.1f}M chars) in {read_seconds:.2f}s"
+)
+
+mismatches = sum(_legacy_parse(t) != _scan_parse(t) for t in texts)
+print(f"{mismatches} responses parsed differently")
+
+legacy = _time_per_round(_legacy_parse, texts, NUM_ROUNDS)
+scanned = _time_per_round(_scan_parse, texts, NUM_ROUNDS)
+print(f"re.search per tag: {legacy * 1000:.2f}ms")
+print(f"single-pass scan: {scanned * 1000:.2f}ms")
+print(f"speedup: {legacy / scanned:.1f}x")
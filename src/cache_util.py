@@ -0,0 +1,146 @@
+"""
+Disk-backed cache for API responses. Re-running an experiment (e.g. after a
+crash, or to regenerate a CSV) sends the exact same prompts, so we can skip
+paying for completions we already have.
+"""
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from private import ROOT_DIR
+
+DEFAULT_CACHE_PATH = f"{ROOT_DIR}/out/cache/responses.sqlite"
+# Once the cache gets bigger than this, we evict the least recently used
+# responses.
+DEFAULT_MAX_CACHE_BYTES = 2 * 1024 * 1024 * 1024
+_EVICTION_BATCH_SIZE = 100
+
+
+def make_cache_key(model_string: str, messages, params: dict, ensemble_index: int):
+    """
+    Hashes everything that determines a response. The ensemble index is part
+    of the key so that each ensembling query gets its own (independent)
+    sample instead of all of them sharing one.
+    """
+    payload = json.dumps(
+        {
+            "model": model_string,
+            "messages": messages,
+            "params": params,
+            "ensemble_index": ensemble_index,
+        },
+        sort_keys=True,
+        default=str,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """
+    Content-addressed key/value store backed by SQLite. Values are strings
+    (we store responses as json). The connection is opened lazily so that
+    importing this module doesn't touch the disk.
+    """
+
+    def __init__(
+        self,
+        path: str = DEFAULT_CACHE_PATH,
+        max_bytes: int = DEFAULT_MAX_CACHE_BYTES,
+    ):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def _get_conn(self):
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            # We serialize access with our own lock, so it's fine to share the
+            # connection between worker threads.
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.execute(
+                """CREATE TABLE IF NOT EXISTS responses (
+                    key TEXT PRIMARY KEY,
+                    value TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    last_accessed REAL NOT NULL
+                )"""
+            )
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS responses_last_accessed "
+                "ON responses (last_accessed)"
+            )
+            self._conn.commit()
+        return self._conn
+
+    def get(self, key: str):
+        with self._lock:
+            conn = self._get_conn()
+            row = conn.execute(
+                "SELECT value FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            conn.execute(
+                "UPDATE responses SET last_accessed = ? WHERE key = ?",
+                (time.time(), key),
+            )
+            conn.commit()
+            self.hits += 1
+            return row[0]
+
+    def put(self, key: str, value: str):
+        with self._lock:
+            conn = self._get_conn()
+            conn.execute(
+                "INSERT OR REPLACE INTO responses (key, value, size, last_accessed) "
+                "VALUES (?, ?, ?, ?)",
+                (key, value, len(value.encode("utf-8")), time.time()),
+            )
+            self._evict_if_needed(conn)
+            conn.commit()
+
+    def _evict_if_needed(self, conn):
+        total_bytes = conn.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM responses"
+        ).fetchone()[0]
+        while total_bytes > self.max_bytes:
+            oldest = conn.execute(
+                "SELECT key, size FROM responses ORDER BY last_accessed LIMIT ?",
+                (_EVICTION_BATCH_SIZE,),
+            ).fetchall()
+            if not oldest:
+                break
+            conn.executemany(
+                "DELETE FROM responses WHERE key = ?", [(key,) for key, _ in oldest]
+            )
+            total_bytes -= sum(size for _, size in oldest)
+
+    def stats(self) -> dict:
+        with self._lock:
+            conn = self._get_conn()
+            num_entries, total_bytes = conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses"
+            ).fetchone()
+        num_lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / num_lookups if num_lookups else 0,
+            "entries": num_entries,
+            "bytes": total_bytes,
+        }
+
+    def print_stats(self):
+        stats = self.stats()
+        print(
+            f"response cache: {stats['hits']} hits, {stats['misses']} misses "
+            f"({stats['hit_rate']:.0%} hit rate), {stats['entries']} entries, "
+            f"{stats['bytes'] / 1024 / 1024:.1f} MB at {self.path}"
+        )
@@ -0,0 +1,99 @@
+"""
+Append-only journal of inference responses. Every response is written to the
+journal as soon as it arrives, so if a run crashes (or we hit our quota) we
+can resume where we left off instead of paying for everything again.
+"""
+
+import json
+import os
+import threading
+from openai.types.chat import ChatCompletion
+from inference_util import HandGPTResponse
+from private import ROOT_DIR
+
+CHECKPOINT_DIR = f"{ROOT_DIR}/out/checkpoints"
+
+
+class CheckpointJournal:
+    """
+    One json record per (question, ensemble index) response, stored at
+    $ROOT_DIR/out/checkpoints/{year}_{exp_name}.jsonl
+
+    Requests that failed (no response even after retries) are recorded as
+    failed, so they still count as incorrect in the results, but a resumed
+    run tries them again.
+    """
+
+    def __init__(self, year: int, exp_name: str, checkpoint_dir: str = CHECKPOINT_DIR):
+        self.path = f"{checkpoint_dir}/{year}_{exp_name}.jsonl"
+        self._lock = threading.Lock()
+        os.makedirs(checkpoint_dir, exist_ok=True)
+
+    def reset(self):
+        """Starts a fresh journal, throwing away any previous run."""
+        with self._lock:
+            open(self.path, "w").close()
+
+    def append(
+        self,
+        question_id,
+        ensemble_index: int,
+        response: HandGPTResponse,
+        failed: bool = False,
+    ):
+        raw_response = response.raw_response
+        if raw_response is not None:
+            raw_response = raw_response.model_dump(mode="json")
+        record = {
+            "question_id": str(question_id),
+            "ensemble_index": ensemble_index,
+            "discussion": response.discussion,
+            "answer": response.answer,
+            "raw_response": raw_response,
+            "failed": failed,
+        }
+        line = json.dumps(record)
+        with self._lock:
+            with open(self.path, "a") as file:
+                file.write(line + "\n")
+
+    def read(
+        self, include_failed: bool = True
+    ) -> "dict[tuple[str, int], HandGPTResponse]":
+        """
+        Returns every response in the journal, keyed by
+        (question id, ensemble index). If a key was written more than once
+        (e.g. a failed request that was retried on resume), the last one wins.
+
+        Set `include_failed` to False to leave out failed requests, e.g. to
+        work out what still needs to be done.
+        """
+        completed = {}
+        if not os.path.exists(self.path):
+            return completed
+
+        with open(self.path, "r") as file:
+            for line in file:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # The last line may be cut off if we crashed mid-write.
+                    print(f"[WARNING] skipping corrupt checkpoint line: {line}")
+                    continue
+                key = (record["question_id"], record["ensemble_index"])
+                if record.get("failed", False):
+                    if not include_failed:
+                        # An earlier success for the same key doesn't count
+                        # either, since the failure came after it.
+                        completed.pop(key, None)
+                        continue
+                raw_response = record["raw_response"]
+                if raw_response is not None:
+                    raw_response = ChatCompletion.model_validate(raw_response)
+                completed[key] = HandGPTResponse(
+                    raw_response=raw_response,
+                    discussion=record["discussion"],
+                    answer=record["answer"],
+                    citations=[],
+                )
+        return completed
@@ -0,0 +1,55 @@
+"""
+Shared OpenAI client factory. Every entry point gets its client from here so
+that all requests in a process go through one pooled HTTP transport, with
+keep-alive connections (no TLS handshake per request) and a pool that's big
+enough for how many requests we have in flight.
+"""
+
+import functools
+
+import httpx
+from openai import DEFAULT_MAX_RETRIES, DefaultHttpxClient, OpenAI
+
+# HTTP/2 needs the optional h2 package. With it, concurrent requests can
+# share a few connections instead of needing one each.
+try:
+    import h2  # noqa: F401
+
+    _HAS_H2 = True
+except ImportError:
+    _HAS_H2 = False
+
+# This should be at least the number of requests we have in flight at once
+# (e.g. MAX_CONCURRENT_REQUESTS x MAX_CONCURRENT_EXPERIMENTS in
+# run_inference), otherwise requests wait for a free connection.
+DEFAULT_MAX_CONNECTIONS = 64
+# Idle connections are kept open this long so the next request can reuse it.
+KEEPALIVE_EXPIRY_SECONDS = 60
+CONNECT_TIMEOUT_SECONDS = 10
+# Long completions (and streamed assistant runs) can take minutes, so only
+# give up once we haven't heard anything for this long.
+READ_TIMEOUT_SECONDS = 600
+
+
+@functools.lru_cache(maxsize=None)
+def get_openai_client(
+    max_retries: int = DEFAULT_MAX_RETRIES,
+    max_connections: int = DEFAULT_MAX_CONNECTIONS,
+) -> OpenAI:
+    """
+    Returns the OpenAI client for these settings, creating it the first
+    time. Callers with the same settings share the client (and its
+    connection pool).
+
+    Pass max_retries=0 when the calls are already retried by retry_util.
+    """
+    http_client = DefaultHttpxClient(
+        http2=_HAS_H2,
+        limits=httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_connections,
+            keepalive_expiry=KEEPALIVE_EXPIRY_SECONDS,
+        ),
+        timeout=httpx.Timeout(READ_TIMEOUT_SECONDS, connect=CONNECT_TIMEOUT_SECONDS),
+    )
+    return OpenAI(max_retries=max_retries, http_client=http_client)
@@ -0,0 +1,55 @@
+"""
+Helper functions for running many blocking API calls concurrently.
+"""
+
+import asyncio
+import contextvars
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+# Default number of requests we allow in flight at once. This should stay
+# comfortably below the rate limits for our tier.
+DEFAULT_MAX_CONCURRENCY = 16
+
+
+def run_concurrently(jobs, max_concurrency=DEFAULT_MAX_CONCURRENCY, should_stop=None):
+    """
+    Runs each job (a function that takes no arguments) on a worker thread,
+    with at most `max_concurrency` jobs in flight at once.
+
+    The OpenAI client is blocking, so we fan the jobs out with asyncio and hand
+    each one to a thread. This means any client with the same interface as
+    OpenAI() (e.g. FakeOpenAI) can be plugged in.
+
+    If `should_stop` returns True for a job's result (e.g. we hit our quota),
+    jobs that have not started yet are skipped. Jobs already in flight are
+    allowed to finish.
+
+    Returns:
+        list of results in the same order as `jobs`. Skipped jobs are None.
+    """
+    return asyncio.run(_run_concurrently(jobs, max_concurrency, should_stop))
+
+
+async def _run_concurrently(jobs, max_concurrency, should_stop):
+    loop = asyncio.get_running_loop()
+    semaphore = asyncio.Semaphore(max_concurrency)
+    stop_event = asyncio.Event()
+
+    with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+
+        async def _run_one(job):
+            async with semaphore:
+                if stop_event.is_set():
+                    return None
+                # Copy the context so that context vars set by the caller are
+                # visible inside the job.
+                context = contextvars.copy_context()
+                result = await loop.run_in_executor(
+                    executor, functools.partial(context.run, job)
+                )
+                if should_stop is not None and should_stop(result):
+                    stop_event.set()
+                return result
+
+        return await asyncio.gather(*[_run_one(job) for job in jobs])
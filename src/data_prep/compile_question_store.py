@@ -0,0 +1,11 @@
+"""
+Compiles questions.csv and media.csv into the parquet question store. This
+happens automatically whenever the CSVs change, but it's handy to do it up
+front (e.g. before kicking off several experiments at once).
+"""
+
+from data_util import compile_question_store, QUESTION_STORE_DIR
+
+compile_question_store()
+print(f"wrote question store to {QUESTION_STORE_DIR}")
+print("done :)")
@@ -4,11 +4,26 @@ Helper functions for reading data from CSVs and parsing into dataclasses.
 
 import pandas as pd
 from enum import Enum, auto
-import re
-from dataclasses import dataclass
+import copy
+import json
+import os
+import threading
+from collections import namedtuple
+from dataclasses import dataclass, field
 from typing import Optional
 import math
 from private import ROOT_DIR, dic_to_exam_question, dic_to_media
+from reference_store import REFERENCE_CORPUS, get_processed_reference_path
+from parse_util import COMMENTARY_PATTERN, QUESTION_NUMBER_PATTERN, YEAR_PATTERN
+
+# pyarrow is needed to read and write the compiled question store. Without it,
+# we fall back to parsing the CSVs.
+try:
+    import pyarrow  # noqa: F401
+
+    _HAS_PYARROW = True
+except ImportError:
+    _HAS_PYARROW = False
 
 
 @dataclass
@@ -35,16 +50,30 @@ class Reference:
 
     def get_text(self):
         # print(self)
-        year = str(self.year).split(".")[0]
-        question_num = str(self.question_num).split(".")[0]
-        reference_num = str(self.reference_num).split(".")[0]
-        root_dir = f"{ROOT_DIR}/data/references/handai-{year}-references/drive"
-        path = f"{root_dir}/question_{question_num}/reference_{reference_num}/question_{question_num}_reference_{reference_num}_processed.txt"
-        content = ""
+        content = REFERENCE_CORPUS.get_text(
+            self.year, self.question_num, self.reference_num
+        )
+        if content is not None:
+            return content
+
+        # Not in the packed corpus (e.g. it hasn't been rebuilt since this
+        # reference was processed), so read the file directly.
+        path = get_processed_reference_path(
+            self.year, self.question_num, self.reference_num
+        )
         with open(path, "r", encoding="utf-8") as file:
             content = file.read()
         return content
 
+    def get_text_view(self) -> "memoryview | None":
+        """
+        Zero-copy view of the reference's utf-8 bytes in the packed corpus, or
+        None if it's not in the corpus.
+        """
+        return REFERENCE_CORPUS.get_view(
+            self.year, self.question_num, self.reference_num
+        )
+
 
 def read_references_as_dict(year: int) -> "dict[int, Reference]":
     path = f"{ROOT_DIR}/data/references/handai-2013-references/2013-references.csv"
@@ -138,7 +167,7 @@ def _remove_nbsp_first_30_chars(input_string):
 
 
 # This is a hack...need to figure out a better way of handling this.
-def _is_nan(txt):
+def is_nan(txt):
     try:
         float_value = float(txt)
         return math.isnan(float_value)
@@ -148,7 +177,7 @@ def _is_nan(txt):
         return False
 
 
-@dataclass
+@dataclass(slots=True)
 class ExamQuestion:
     """Class for a question on the Exam."""
 
@@ -187,6 +216,30 @@ class ExamQuestion:
     distractor_percentages: "dic[str, float]"
     references: "list[Reference]"
 
+    # These are derived from the fields above. They get used a lot (filtering,
+    # sorting, logging, writing csvs), so we compute them once up front
+    # instead of running a regex every time.
+    _year: Optional[int] = field(init=False, repr=False, compare=False)
+    _question_number: Optional[int] = field(init=False, repr=False, compare=False)
+    _has_question_media: bool = field(init=False, repr=False, compare=False)
+    _has_commentary_media: bool = field(init=False, repr=False, compare=False)
+    _has_video: bool = field(init=False, repr=False, compare=False)
+    # These are only computed the first time they're asked for, since most
+    # questions in the bank never get formatted.
+    _formatted_question: Optional[str] = field(
+        init=False, default=None, repr=False, compare=False
+    )
+    _clean_commentary: Optional[str] = field(
+        init=False, default=None, repr=False, compare=False
+    )
+
+    def __post_init__(self):
+        self._year = self._parse_year()
+        self._question_number = self._parse_question_number()
+        self._has_question_media = any(m.show_in_question for m in self.media)
+        self._has_commentary_media = any(m.show_in_commentary for m in self.media)
+        self._has_video = any(m.media_type == MediaType.VIDEO for m in self.media)
+
     def attach_reference(self, ref: Reference):
         """
         This is REALLY hacky. but since the references are created
@@ -200,14 +253,13 @@ class ExamQuestion:
         return self.references
 
     def get_clean_commentary(self) -> str:
-        pattern = r"Prefer+ed Response: ?[A-Z](<br /><br />|\s*)(.*)"
+        if self._clean_commentary is None:
+            self._clean_commentary = self._parse_clean_commentary()
+        return self._clean_commentary
 
-        # Use re.search() to find the text after the matched pattern
-        match = re.search(
-            pattern,
-            _remove_nbsp_first_30_chars(self.commentary),
-            flags=re.IGNORECASE | re.DOTALL,
-        )
+    def _parse_clean_commentary(self) -> str:
+        # Find the text after e.g. "Preferred Response: C"
+        match = COMMENTARY_PATTERN.search(_remove_nbsp_first_30_chars(self.commentary))
         if match:
             # Return everything after the "Preferred Response"
             return match.group(2)  # group(2) refers to the (.*) part of the pattern
@@ -220,23 +272,32 @@ class ExamQuestion:
             return self.commentary
 
     def format_question(self) -> str:
+        if self._formatted_question is None:
+            self._formatted_question = self._format_question()
+        return self._formatted_question
+
+    def _format_question(self) -> str:
         question = f"{self.question}\n"
         # TODO(zkbaum) need a better way of handling missing questions...
-        if not _is_nan(self.choice_a):
+        if not is_nan(self.choice_a):
             question += f"A. {self.choice_a}\n"
-        if not _is_nan(self.choice_b):
+        if not is_nan(self.choice_b):
             question += f"B. {self.choice_b}\n"
-        if not _is_nan(self.choice_c):
+        if not is_nan(self.choice_c):
             question += f"C. {self.choice_c}\n"
-        if not _is_nan(self.choice_d):
+        if not is_nan(self.choice_d):
             question += f"D. {self.choice_d}\n"
-        if not _is_nan(self.choice_e):
+        if not is_nan(self.choice_e):
             question += f"E. {self.choice_e}"
         return question
 
-    def get_year(self) -> int:
+    def _parse_year(self) -> int:
+        # Fake exemplars don't have an exam.
+        if self.origination_exam is None:
+            return None
+
         # text = "2013 Self-Assessment Examination"
-        match = re.search(r"\b\d{4}\b", self.origination_exam)
+        match = YEAR_PATTERN.search(self.origination_exam)
 
         if match:
             year = match.group()
@@ -245,9 +306,13 @@ class ExamQuestion:
             print("No year found in the text: ", self.origination_exam)
             return None
 
-    def get_question_number(self) -> int | None:
+    def _parse_question_number(self) -> int | None:
+        # Fake exemplars don't have a title.
+        if self.title is None:
+            return None
+
         # Use regular expression to find the number after 'Q'
-        match = re.search(r"Q(\d+)", self.title, flags=re.IGNORECASE)
+        match = QUESTION_NUMBER_PATTERN.search(self.title)
 
         if match:
             return int(match.group(1))
@@ -255,20 +320,29 @@ class ExamQuestion:
             print("No question number found in :", self.title)
             return None
 
+    def get_year(self) -> int:
+        return self._year
+
+    def get_question_number(self) -> int | None:
+        return self._question_number
+
     def get_correct_answer(self):
         return ["A", "B", "C", "D", "E"][int(self.correct_answer)]
 
     def question_has_text_only(self):
-        return len([m for m in self.media if m.show_in_question]) == 0
+        return not self._has_question_media
 
     def question_has_text_and_images(self):
-        return len([m for m in self.media if m.show_in_question]) > 0
+        return self._has_question_media
 
     def commentary_has_text_only(self):
-        return len([m for m in self.media if m.show_in_commentary]) == 0
+        return not self._has_commentary_media
 
     def commentary_has_text_and_images(self):
-        return len([m for m in self.media if m.show_in_commentary]) > 0
+        return self._has_commentary_media
+
+    def has_video(self):
+        return self._has_video
 
     def get_question_content_type(self):
         if self.question_has_text_only():
@@ -285,7 +359,7 @@ class ExamQuestion:
             "E": self.choice_e,
         }
         # hack to account for sometimes E not being there
-        if _is_nan(self.choice_e):
+        if is_nan(self.choice_e):
             distribution[self.choice_e] = 0
 
         answer_text = letter_to_text[self.get_correct_answer()]
@@ -327,6 +401,19 @@ class ExamMedia:
         return f"https://de90rgl81jte0.cloudfront.net{relative_path}"
 
 
+def _record_to_exam_question(
+    dic: dict, question_id_to_media: "dict[str, list[ExamMedia]]"
+) -> ExamQuestion:
+    question_id = dic["QuestionID"]
+
+    # extract media if it it exists for this question
+    media = []
+    if question_id in question_id_to_media:
+        media = question_id_to_media[question_id]
+
+    return dic_to_exam_question(dic, CATEGORY_MAP, media)
+
+
 def read_questions_csv(
     filepath: str, question_id_to_media: "dict[str, list[ExamMedia]]"
 ) -> "list[ExamQuestion]":
@@ -335,14 +422,7 @@ def read_questions_csv(
 
     questions = []
     for dic in dict_list:
-        question_id = dic["QuestionID"]
-
-        # extract media if it it exists for this question
-        media = []
-        if question_id in question_id_to_media:
-            media = question_id_to_media[question_id]
-
-        question = dic_to_exam_question(dic, CATEGORY_MAP, media)
+        question = _record_to_exam_question(dic, question_id_to_media)
         questions.append(question)
 
     # VALIDATION to catch any obvious formatting problems
@@ -354,8 +434,7 @@ def read_questions_csv(
     return questions
 
 
-def read_media_csv(filepath) -> "list[ExamMedia]":
-    df = pd.read_csv(filepath)
+def _media_df_to_dict(df) -> "dict[str, list[ExamMedia]]":
     dict_list = df.to_dict(orient="records")
 
     question_to_media = {}
@@ -369,11 +448,363 @@ def read_media_csv(filepath) -> "list[ExamMedia]":
     return question_to_media
 
 
+def read_media_csv(filepath) -> "list[ExamMedia]":
+    return _media_df_to_dict(pd.read_csv(filepath))
+
+
 class ContentType(Enum):
     TEXT_ONLY = auto()
     TEXT_AND_IMAGES = auto()
 
 
+QUESTIONS_CSV_PATH = f"{ROOT_DIR}/data/assh-data/questions.csv"
+MEDIA_CSV_PATH = f"{ROOT_DIR}/data/assh-data/media.csv"
+
+# Loading the question bank is slow, and most scripts build several question
+# sets, so we only load it once per process. The keys include the mtimes of
+# the source files so that we reload if they change.
+_QUESTION_BANKS = {}
+_QUESTION_BANKS_LOCK = threading.RLock()
+
+
+def _load_question_bank_from_csv() -> "QuestionBank":
+    key = (
+        QUESTIONS_CSV_PATH,
+        os.path.getmtime(QUESTIONS_CSV_PATH),
+        MEDIA_CSV_PATH,
+        os.path.getmtime(MEDIA_CSV_PATH),
+    )
+    with _QUESTION_BANKS_LOCK:
+        if key not in _QUESTION_BANKS:
+            media = read_media_csv(MEDIA_CSV_PATH)
+            questions = read_questions_csv(QUESTIONS_CSV_PATH, media)
+            _QUESTION_BANKS[key] = QuestionBank.from_questions(questions)
+        return _QUESTION_BANKS[key]
+
+
+# The question store is a pre-compiled parquet copy of questions.csv and
+# media.csv, with the fields we filter on (year, question number, category,
+# content types) already extracted. Loading it is much faster than parsing the
+# CSVs, and we only build ExamQuestions for the rows that survive the filters.
+QUESTION_STORE_DIR = f"{ROOT_DIR}/data/assh-data/compiled"
+QUESTION_STORE_PATH = f"{QUESTION_STORE_DIR}/questions.parquet"
+MEDIA_STORE_PATH = f"{QUESTION_STORE_DIR}/media.parquet"
+QUESTION_STORE_MANIFEST_PATH = f"{QUESTION_STORE_DIR}/manifest.json"
+_DERIVED_COLUMNS = [
+    "derived_year",
+    "derived_question_number",
+    "derived_category",
+    "derived_question_content_type",
+    "derived_commentary_content_type",
+    "derived_has_video",
+]
+
+
+def _get_source_fingerprint() -> dict:
+    return {
+        path: [os.path.getmtime(path), os.path.getsize(path)]
+        for path in [QUESTIONS_CSV_PATH, MEDIA_CSV_PATH]
+    }
+
+
+def _is_question_store_fresh() -> bool:
+    if not os.path.exists(QUESTION_STORE_MANIFEST_PATH):
+        return False
+    with open(QUESTION_STORE_MANIFEST_PATH, "r") as file:
+        manifest = json.load(file)
+    return manifest["sources"] == _get_source_fingerprint()
+
+
+def compile_question_store():
+    """
+    Normalizes questions.csv and media.csv into the parquet question store.
+    You don't need to call this by hand, QuestionsBuilder will recompile the
+    store whenever the source CSVs change.
+    """
+    print(f"compiling question store to {QUESTION_STORE_DIR}")
+    # Read the CSVs exactly the same way as read_questions_csv so that the
+    # records we get back from the store are identical.
+    questions_df = pd.read_csv(QUESTIONS_CSV_PATH)
+    media_df = pd.read_csv(MEDIA_CSV_PATH)
+    question_id_to_media = _media_df_to_dict(media_df)
+
+    derived = {column: [] for column in _DERIVED_COLUMNS}
+    for dic in questions_df.to_dict(orient="records"):
+        q = _record_to_exam_question(dic, question_id_to_media)
+        commentary_content_type = ContentType.TEXT_AND_IMAGES
+        if q.commentary_has_text_only():
+            commentary_content_type = ContentType.TEXT_ONLY
+        derived["derived_year"].append(q.get_year())
+        derived["derived_question_number"].append(q.get_question_number())
+        derived["derived_category"].append(q.category.value if q.category else None)
+        derived["derived_question_content_type"].append(
+            q.get_question_content_type().name
+        )
+        derived["derived_commentary_content_type"].append(commentary_content_type.name)
+        derived["derived_has_video"].append(q.has_video())
+
+    os.makedirs(QUESTION_STORE_DIR, exist_ok=True)
+    questions_df.assign(**derived).to_parquet(QUESTION_STORE_PATH, index=False)
+    media_df.to_parquet(MEDIA_STORE_PATH, index=False)
+    with open(QUESTION_STORE_MANIFEST_PATH, "w") as file:
+        json.dump({"sources": _get_source_fingerprint()}, file)
+
+
+def _restore_nans(df):
+    """
+    Parquet turns NaN in text columns into None, but the rest of the code
+    expects NaN (which is what pd.read_csv gives us).
+    """
+    object_columns = df.select_dtypes(include="object").columns
+    df[object_columns] = df[object_columns].where(
+        df[object_columns].notna(), float("nan")
+    )
+    return df
+
+
+class _QuestionStore:
+    """
+    The loaded question store. ExamQuestions are built lazily (and only once)
+    the first time they're asked for.
+    """
+
+    def __init__(self, questions_df, question_id_to_media):
+        self.questions_df = questions_df
+        self._raw_df = questions_df.drop(columns=_DERIVED_COLUMNS)
+        self._question_id_to_media = question_id_to_media
+        self._built_questions = {}
+        self._lock = threading.Lock()
+
+    def get_question(self, row_index: int) -> ExamQuestion:
+        with self._lock:
+            if row_index not in self._built_questions:
+                dic = self._raw_df.iloc[[row_index]].to_dict(orient="records")[0]
+                self._built_questions[row_index] = _record_to_exam_question(
+                    dic, self._question_id_to_media
+                )
+            return self._built_questions[row_index]
+
+
+def _load_question_bank_from_store() -> "QuestionBank":
+    with _QUESTION_BANKS_LOCK:
+        if not _is_question_store_fresh():
+            compile_question_store()
+        key = (QUESTION_STORE_PATH, os.path.getmtime(QUESTION_STORE_MANIFEST_PATH))
+        if key not in _QUESTION_BANKS:
+            questions_df = _restore_nans(pd.read_parquet(QUESTION_STORE_PATH))
+            media_df = _restore_nans(pd.read_parquet(MEDIA_STORE_PATH))
+            store = _QuestionStore(questions_df, _media_df_to_dict(media_df))
+            _QUESTION_BANKS[key] = QuestionBank.from_store(store)
+        return _QUESTION_BANKS[key]
+
+
+def _copy_question(question: ExamQuestion) -> ExamQuestion:
+    """
+    The cached questions are shared, so callers get their own copy. Only the
+    fields that we mutate after construction (references get attached later,
+    and get_human_distribution writes to distractor_percentages) need to be
+    copied.
+    """
+    copied = copy.copy(question)
+    copied.references = list(question.references)
+    if isinstance(question.distractor_percentages, dict):
+        copied.distractor_percentages = dict(question.distractor_percentages)
+    return copied
+
+
+def _nan_to_none(value):
+    return None if is_nan(value) else value
+
+
+# The fields that QuestionBank keeps a hash index on.
+_IndexKeys = namedtuple(
+    "_IndexKeys",
+    [
+        "year",
+        "question_number",
+        "category",
+        "question_content_type",
+        "commentary_content_type",
+        "has_video",
+    ],
+)
+
+
+class QuestionBank:
+    """
+    Every question we have, with hash indexes on the fields we query by.
+    Queries intersect the indexes instead of scanning the whole list, and
+    (when loaded from the question store) questions are only built once a
+    query returns them.
+
+    Like QuestionsBuilder, queries return copies sorted by year and question
+    number, so callers can mutate them (e.g. attach references) freely.
+
+    Example:
+        bank = QuestionBank.load()
+        bank.query(year=2013, question_numbers=[56, 62, 64])
+        bank.get(2013, 56)
+    """
+
+    def __init__(self, index_keys: "list[_IndexKeys]", get_question):
+        """
+        index_keys: the index keys of every question, sorted by year and
+            question number. Questions are identified by their position here.
+        get_question: function that returns the ExamQuestion at a position.
+        """
+        self._get_question = get_question
+        self._all_positions = set(range(len(index_keys)))
+        self._indexes = {name: {} for name in _IndexKeys._fields}
+        self._positions_by_year_and_question_number = {}
+        for position, keys in enumerate(index_keys):
+            for name, value in keys._asdict().items():
+                self._indexes[name].setdefault(value, set()).add(position)
+            self._positions_by_year_and_question_number[
+                (keys.year, keys.question_number)
+            ] = position
+
+        # References are attached later (see attach_references).
+        self._references = {}
+        self._indexes["has_references"] = {
+            False: set(self._all_positions),
+            True: set(),
+        }
+
+    @classmethod
+    def load(cls) -> "QuestionBank":
+        """Returns the question bank for this process, loading it if needed."""
+        if _HAS_PYARROW:
+            return _load_question_bank_from_store()
+        return _load_question_bank_from_csv()
+
+    @classmethod
+    def from_questions(cls, questions: "list[ExamQuestion]") -> "QuestionBank":
+        questions = sorted(
+            questions, key=lambda q: (q.get_year(), q.get_question_number())
+        )
+        index_keys = [
+            _IndexKeys(
+                year=q.get_year(),
+                question_number=q.get_question_number(),
+                category=q.category,
+                question_content_type=q.get_question_content_type(),
+                commentary_content_type=(
+                    ContentType.TEXT_ONLY
+                    if q.commentary_has_text_only()
+                    else ContentType.TEXT_AND_IMAGES
+                ),
+                has_video=q.has_video(),
+            )
+            for q in questions
+        ]
+        return cls(index_keys, questions.__getitem__)
+
+    @classmethod
+    def from_store(cls, store: "_QuestionStore") -> "QuestionBank":
+        # We can build the indexes straight from the derived columns, without
+        # building any ExamQuestions.
+        df = store.questions_df.sort_values(
+            ["derived_year", "derived_question_number"], kind="stable"
+        )
+        row_indices = list(df.index)
+        index_keys = []
+        for row in df[_DERIVED_COLUMNS].itertuples(index=False):
+            year = _nan_to_none(row.derived_year)
+            question_number = _nan_to_none(row.derived_question_number)
+            category = _nan_to_none(row.derived_category)
+            index_keys.append(
+                _IndexKeys(
+                    year=int(year) if year is not None else None,
+                    question_number=(
+                        int(question_number) if question_number is not None else None
+                    ),
+                    category=CATEGORY_MAP[category] if category else None,
+                    question_content_type=ContentType[
+                        row.derived_question_content_type
+                    ],
+                    commentary_content_type=ContentType[
+                        row.derived_commentary_content_type
+                    ],
+                    has_video=bool(row.derived_has_video),
+                )
+            )
+        return cls(index_keys, lambda position: store.get_question(row_indices[position]))
+
+    def __len__(self):
+        return len(self._all_positions)
+
+    def _copy_at(self, position: int) -> ExamQuestion:
+        question = _copy_question(self._get_question(position))
+        for ref in self._references.get(position, []):
+            question.attach_reference(ref)
+        return question
+
+    def get(self, year: int, question_number: int) -> Optional[ExamQuestion]:
+        position = self._positions_by_year_and_question_number.get(
+            (year, question_number)
+        )
+        if position is None:
+            return None
+        return self._copy_at(position)
+
+    def query(
+        self,
+        year: Optional[int] = None,
+        category: Optional[Category] = None,
+        question_content_type: Optional[ContentType] = None,
+        commentary_content_type: Optional[ContentType] = None,
+        has_video: Optional[bool] = None,
+        has_references: Optional[bool] = None,
+        question_numbers: "Optional[list[int]]" = None,
+    ) -> "list[ExamQuestion]":
+        """
+        Returns the questions that match every filter that is not None.
+        """
+        filters = {
+            "year": year,
+            "category": category,
+            "question_content_type": question_content_type,
+            "commentary_content_type": commentary_content_type,
+            "has_video": has_video,
+            "has_references": has_references,
+        }
+        candidate_sets = [
+            self._indexes[name].get(value, set())
+            for name, value in filters.items()
+            if value is not None
+        ]
+        if question_numbers is not None:
+            index = self._indexes["question_number"]
+            candidate_sets.append(
+                set().union(*[index.get(n, set()) for n in question_numbers])
+            )
+
+        positions = self._all_positions
+        if candidate_sets:
+            # Start from the smallest set to keep the intersection cheap.
+            candidate_sets.sort(key=len)
+            positions = candidate_sets[0].intersection(*candidate_sets[1:])
+
+        return [self._copy_at(p) for p in sorted(positions)]
+
+    def attach_references(self, year: int, references_dic: "dict[int, list[Reference]]"):
+        """
+        Records the (uploaded) references for a year, so that they get
+        attached to every question returned from now on and can be queried
+        with `has_references`.
+        """
+        for question_num, refs in references_dic.items():
+            position = self._positions_by_year_and_question_number.get(
+                (year, question_num)
+            )
+            uploaded = [ref for ref in refs if ref.is_uploaded]
+            if position is None or not uploaded:
+                continue
+            self._references[position] = uploaded
+            self._indexes["has_references"][False].discard(position)
+            self._indexes["has_references"][True].add(position)
+
+
 class QuestionsBuilder:
     # _year: Optional[int]
     # _question_content_type: Optional[ContentType]
@@ -403,50 +834,14 @@ class QuestionsBuilder:
         return self
 
     def build(self) -> "list[ExamQuestion]":
-        media = read_media_csv(f"{ROOT_DIR}/data/assh-data/media.csv")
-        questions = read_questions_csv(
-            f"{ROOT_DIR}/data/assh-data/questions.csv", media
+        return QuestionBank.load().query(
+            year=self._year or None,
+            question_content_type=self._question_content_type,
+            commentary_content_type=self._commentary_content_type,
+            # filter out any questions with videos
+            has_video=None if self._keep_video else False,
         )
 
-        # filter out based on year
-        if self._year:
-            questions = [q for q in questions if q.get_year() == self._year]
-
-        # filter based on content restrictions - question
-        if self._question_content_type == ContentType.TEXT_ONLY:
-            questions = [q for q in questions if q.question_has_text_only()]
-        elif self._question_content_type == ContentType.TEXT_AND_IMAGES:
-            questions = [q for q in questions if q.question_has_text_and_images()]
-
-        # filter based on content restrictions - commentary
-        if self._commentary_content_type == ContentType.TEXT_ONLY:
-            questions = [q for q in questions if q.commentary_has_text_only()]
-        elif self._commentary_content_type == ContentType.TEXT_AND_IMAGES:
-            questions = [q for q in questions if q.commentary_has_text_and_images()]
-
-        # sort by year and question number
-        questions.sort(
-            key=lambda question: (
-                question.get_year(),
-                question.get_question_number(),
-            )
-        )
-
-        # filter out any questions with videos
-        if not self._keep_video:
-            # before_ids = set([q.get_question_number() for q in questions])
-            # print(f"len before: {len(before_ids)}")
-            questions = [
-                q
-                for q in questions
-                if len([m for m in q.media if m.media_type == MediaType.VIDEO]) == 0
-            ]
-            # after_ids = set([q.get_question_number() for q in questions])
-            # print(f"len after: {len(after_ids)}")
-            # print(f"filtered out {sorted(before_ids - after_ids)}")
-
-        return questions
-
 
 def get_n_examples_from_each_category(exam_questions, n, categories: "list[Category]"):
     category_ct = {}
@@ -495,6 +890,25 @@ def attach_references(references_dic, entry):
         )
 
 
+def load_references(year: int) -> "dict[int, list[Reference]]":
+    """
+    Reads the references for a year and attaches them in the process-wide
+    question bank, so every question for that year returned from now on has
+    its (uploaded) references, and can be queried with `has_references`.
+
+    This affects every later query in the process (including exemplars, and
+    other experiments running at the same time), so only call it when that's
+    what you want. To attach references to a few questions, use
+    attach_references instead.
+
+    Returns:
+        the references, keyed by question number
+    """
+    references_dic = read_references_as_dict(year)
+    QuestionBank.load().attach_references(year, references_dic)
+    return references_dic
+
+
 def prune_questions_without_any_references(
     exam_questions: "list[ExamQuestion]", year: int
 ):
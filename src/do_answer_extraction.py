@@ -1,27 +1,64 @@
 """
 As part of few-shot prompting experiments, we have a seperate model to extract
-the single letter answer from responses. Usuallyt we run this as part of 
+the single letter answer from responses. Usuallyt we run this as part of
 run_inference. However, if we already have the inferences, we can run this
 one-off script to compute everything.
 """
 
-from openai import OpenAI
+import functools
+import re
 
 import pandas as pd
-from inference_util import _use_chatgpt_to_extract_answer_internal
+from client_util import get_openai_client
+from concurrency_util import run_concurrently
+from extraction_util import EXTRACTION_STATS, extract_answers
 
-CLIENT = OpenAI()
+# Retries are handled by retry_util, so turn off the client's own retries.
+CLIENT = get_openai_client(max_retries=0)
+# This is the max number of questions we extract at the same time.
+MAX_CONCURRENT_REQUESTS = 16
+# The model the CSV's responses came from, which picks the extractor prompt
+# (e.g. Model.GPT4O for chat completion results). None means the results are
+# from the assistants API.
+MODEL = None
 
 
-def _read_inference_csv_and_extract_answers(client, filepath):
+def _get_discussion_columns(df) -> "list[str]":
+    columns = [c for c in df.columns if re.fullmatch(r"chatgpt_discussion_\d+", c)]
+    return sorted(columns, key=lambda c: int(c.split("_")[-1]))
+
+
+def _is_rate_limited(answers) -> bool:
+    return "EXTRACTION_ERROR_RATELIMIT" in answers
+
+
+def _read_inference_csv_and_extract_answers(client, filepath, model):
     df = pd.read_csv(filepath)
-    for index, row in df.iterrows():
-        print(f'handling question {row["question_number"]}')
-        # in place update the answer :)
-        _, extracted = _use_chatgpt_to_extract_answer_internal(
-            client, row["chatgpt_discussion_0"]
-        )
-        df.loc[index, "chatgpt_answer_0"] = extracted
+    discussion_columns = _get_discussion_columns(df)
+    print(
+        f"extracting answers for {len(df)} questions x "
+        f"{len(discussion_columns)} responses"
+    )
+
+    # One job per question, so that all of a question's responses can be
+    # packed into the same extractor requests.
+    discussions = df[discussion_columns].to_numpy().tolist()
+    jobs = [
+        functools.partial(extract_answers, client, question, texts, model)
+        for question, texts in zip(df["question"].tolist(), discussions)
+    ]
+    # Once we're out of quota, don't bother starting the other questions.
+    answers = run_concurrently(
+        jobs, max_concurrency=MAX_CONCURRENT_REQUESTS, should_stop=_is_rate_limited
+    )
+    answers = [
+        a if a is not None else ["EXTRACTION_ERROR_RATELIMIT"] * len(discussion_columns)
+        for a in answers
+    ]
+
+    for n, column in enumerate(discussion_columns):
+        answer_column = column.replace("chatgpt_discussion_", "chatgpt_answer_")
+        df[answer_column] = [answers_for_question[n] for answers_for_question in answers]
 
     return df
 
@@ -29,6 +66,7 @@ def _read_inference_csv_and_extract_answers(client, filepath):
 INPUT_PATH = "/PATH/TO/INPUT"
 OUTPUT_PATH = "/PATH/TO/OUTPUT"
 
-df = _read_inference_csv_and_extract_answers(CLIENT, INPUT_PATH)
+df = _read_inference_csv_and_extract_answers(CLIENT, INPUT_PATH, MODEL)
 df.to_csv(OUTPUT_PATH, index=True)
+EXTRACTION_STATS.print_stats()
 print(f"wrote results to {OUTPUT_PATH}")
@@ -0,0 +1,76 @@
+"""
+Helper functions for adaptive ensembling. Instead of always asking each
+question ENSEMBLING_COUNT times, we keep sampling until we're confident about
+the majority answer (or we hit the cap). Easy questions, where the model
+gives the same answer every time, stop after a few samples.
+"""
+
+import math
+from collections import Counter
+from dataclasses import dataclass
+
+# Written in place of the discussion and answer for ensembling slots we
+# didn't need to sample, so the CSV keeps the same columns.
+NOT_SAMPLED = "NOT_SAMPLED"
+
+
+@dataclass
+class StoppingRule:
+    # analyze_results looks at the first 3 attempts for unanimity, so we
+    # always take at least that many.
+    min_samples: int = 3
+    max_samples: int = 10
+    # After the first min_samples, sample this many more at a time.
+    step_size: int = 2
+    # z score for the Wilson bound. 1.96 is a 95% confidence interval.
+    z: float = 1.96
+    # Stop once we're confident the top answer gets more than this share of
+    # the samples.
+    majority_threshold: float = 0.5
+
+
+DEFAULT_STOPPING_RULE = StoppingRule()
+
+
+def wilson_lower_bound(successes: int, n: int, z: float) -> float:
+    """Lower end of the Wilson score interval for a binomial proportion."""
+    if n == 0:
+        return 0
+    p = successes / n
+    denominator = 1 + z * z / n
+    center = p + z * z / (2 * n)
+    margin = z * math.sqrt(p * (1 - p) / n + z * z / (4 * n * n))
+    return (center - margin) / denominator
+
+
+def should_stop_sampling(
+    answers: "list[str]", rule: StoppingRule = DEFAULT_STOPPING_RULE
+) -> bool:
+    """
+    Returns True once we have enough samples for a question. That's when
+    either:
+      - we're confident the most common answer is the true majority, or
+      - the remaining samples couldn't change the majority answer anyway, or
+      - we've hit the cap.
+    """
+    n = len(answers)
+    if n >= rule.max_samples:
+        return True
+    if n < rule.min_samples:
+        return False
+
+    counts = Counter(answers).most_common(2)
+    top_count = counts[0][1]
+    runner_up_count = counts[1][1] if len(counts) > 1 else 0
+    if wilson_lower_bound(top_count, n, rule.z) > rule.majority_threshold:
+        return True
+    return top_count - runner_up_count > rule.max_samples - n
+
+
+def get_next_sample_count(
+    num_sampled: int, rule: StoppingRule = DEFAULT_STOPPING_RULE
+) -> int:
+    """How many more samples to ask for in the next round."""
+    if num_sampled < rule.min_samples:
+        return rule.min_samples - num_sampled
+    return min(rule.step_size, rule.max_samples - num_sampled)
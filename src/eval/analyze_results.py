@@ -12,13 +12,15 @@ import csv
 parent_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 sys.path.append(parent_dir)
 from private import get_result_csvpath_for_experiment, ROOT_DIR
+from ensemble_util import NOT_SAMPLED
 
 
 def _determine_majority_or_tie(row):
     """
     Determines the most frequent answer, or "TIE" if there's a tie.
     """
-    modes = row.mode()
+    # Slots that adaptive ensembling didn't sample don't get a vote.
+    modes = row[row != NOT_SAMPLED].mode()
     if modes.empty:  # Check if the modes Series is empty
         return None  # Return None or some default value if no mode exists
     elif len(modes) > 1:  # More than one mode indicates a tie
@@ -37,6 +39,36 @@ def _check_unanimity(row):
         return "NOT_UNANIMOUS"
 
 
+def _is_attempt_correct(df, i):
+    """
+    Whether attempt i is correct for each question. Attempts that adaptive
+    ensembling didn't sample are NaN, so they're left out of averages.
+    """
+    answers = df[f"chatgpt_answer_{i}"]
+    return (answers == df["actual_answer"]).where(answers != NOT_SAMPLED)
+
+
+def _get_question_accuracy(df):
+    """
+    Each question's accuracy over the attempts that were actually sampled.
+
+    With adaptive ensembling, only the hard questions get the later attempts,
+    so averaging each attempt column first would weigh the hard questions
+    more. Averaging per question first keeps runs with and without adaptive
+    ensembling comparable.
+    """
+    num_correct = sum(
+        (df[f"chatgpt_answer_{i}"] == df["actual_answer"]).astype(int)
+        for i in range(10)
+    )
+    if "samples_used" in df.columns:
+        samples_used = df["samples_used"]
+    else:
+        # Results from before we recorded samples_used sampled every attempt.
+        samples_used = 10
+    return num_correct / samples_used
+
+
 def _parse_inference_results_df(df):
     """
     Parses inference results df by computing the average per question type,
@@ -50,50 +82,22 @@ def _parse_inference_results_df(df):
     df["chatgpt_majority_correct"] = df["majority_answer_or_tie"] == df["actual_answer"]
     df["chatgpt_unanimous_correct"] = df["unanimous_or_not"] == df["actual_answer"]
 
-    for i in range(10):
-        df[f"chatgpt_attempt{i}_correct"] = (
-            df[f"chatgpt_answer_{i}"] == df["actual_answer"]
-        )
+    df["chatgpt_average_correct_percentage"] = _get_question_accuracy(df)
 
     df["human_correct_percentage"] /= 100
 
-    # Slice by question type.
+    # Slice by question type, averaging over questions.
     df = (
         df.groupby("question_type")[
             [
                 "human_correct_percentage",
-                "chatgpt_attempt0_correct",
-                "chatgpt_attempt1_correct",
-                "chatgpt_attempt2_correct",
-                "chatgpt_attempt3_correct",
-                "chatgpt_attempt4_correct",
-                "chatgpt_attempt5_correct",
-                "chatgpt_attempt6_correct",
-                "chatgpt_attempt7_correct",
-                "chatgpt_attempt8_correct",
-                "chatgpt_attempt9_correct",
+                "chatgpt_average_correct_percentage",
             ]
         ].mean()
         * 100
     )
     df.reset_index(inplace=True)
 
-    # average the 10 attempts
-    df["chatgpt_average_correct_percentage"] = df[
-        [
-            "chatgpt_attempt0_correct",
-            "chatgpt_attempt1_correct",
-            "chatgpt_attempt2_correct",
-            "chatgpt_attempt3_correct",
-            "chatgpt_attempt4_correct",
-            "chatgpt_attempt5_correct",
-            "chatgpt_attempt6_correct",
-            "chatgpt_attempt7_correct",
-            "chatgpt_attempt8_correct",
-            "chatgpt_attempt9_correct",
-        ]
-    ].mean(axis=1)
-
     df = df[
         [
             "question_type",
@@ -131,9 +135,7 @@ def _compute_averages_per_attempt_slice_by_question_type():
         df = pd.read_csv(filepath)
 
         for i in range(10):
-            df[f"chatgpt_attempt{i}_correct"] = (
-                df[f"chatgpt_answer_{i}"] == df["actual_answer"]
-            )
+            df[f"chatgpt_attempt{i}_correct"] = _is_attempt_correct(df, i)
 
         question_type_counts = df["question_type"].value_counts()
         df["num_questions"] = df["question_type"].map(question_type_counts) / 100
@@ -184,9 +186,7 @@ def _compute_averages_per_attempt(slice_by_question_type):
         df = pd.read_csv(filepath)
 
         for i in range(10):
-            df[f"chatgpt_attempt{i}_correct"] = (
-                df[f"chatgpt_answer_{i}"] == df["actual_answer"]
-            )
+            df[f"chatgpt_attempt{i}_correct"] = _is_attempt_correct(df, i)
 
         num_questions = len(df)
         df = (
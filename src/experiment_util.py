@@ -0,0 +1,155 @@
+"""
+Helper functions for running a matrix of experiments (years x configs) at
+the same time instead of one after another.
+
+All the cells share the process-wide rate limiter (see rate_limit_util),
+which has separate buckets per model. So while one cell is waiting on
+gpt-4o's quota, a gpt-3.5 cell can keep sending requests.
+
+Since the cells' output is interleaved, each cell reports its per-question
+progress tagged with the cell name (see track_progress).
+"""
+
+import contextlib
+import contextvars
+import functools
+import itertools
+import threading
+import time
+from dataclasses import dataclass
+
+from concurrency_util import run_concurrently
+from inference_util import Model
+
+# How many experiments we run at once. Each one has its own pool of
+# in-flight requests, and the rate limiter keeps the total under our limits.
+DEFAULT_MAX_CONCURRENT_EXPERIMENTS = 4
+
+# The name of the cell we're running, and its progress. run_concurrently
+# copies these into every job, so the per-question jobs see them too.
+_CELL_NAME = contextvars.ContextVar("cell_name", default=None)
+_CELL_PROGRESS = contextvars.ContextVar("cell_progress", default=None)
+
+
+@dataclass
+class ExperimentConfig:
+    exp_name: str
+    model: Model
+    # See inference_util for the parsing functions.
+    parsing_fn: any
+    # No preamble or exemplars means zero-shot.
+    preamble: str = None
+    exemplars: any = None
+
+
+@dataclass
+class ExperimentCell:
+    year: int
+    config: ExperimentConfig
+
+    def get_name(self) -> str:
+        return f"{self.year}_{self.config.exp_name}"
+
+
+class _CellProgress:
+    def __init__(self, num_questions: int):
+        self.name = _CELL_NAME.get()
+        self.num_questions = num_questions
+        self.num_done = 0
+        self.start = time.monotonic()
+        self._lock = threading.Lock()
+
+    def question_done(self, question_number):
+        with self._lock:
+            self.num_done += 1
+            num_done = self.num_done
+        tag = f"[{self.name}] " if self.name is not None else ""
+        print(
+            f"{tag}finished q={question_number} "
+            f"({num_done} of {self.num_questions} questions, "
+            f"{time.monotonic() - self.start:.0f}s)"
+        )
+
+
+@contextlib.contextmanager
+def track_progress(num_questions: int):
+    """
+    Counts the questions finished inside the `with` block (see
+    report_question_done) out of `num_questions`.
+    """
+    token = _CELL_PROGRESS.set(_CellProgress(num_questions))
+    try:
+        yield
+    finally:
+        _CELL_PROGRESS.reset(token)
+
+
+def report_question_done(question_number):
+    """
+    Prints that a question is done, tagged with the cell name. Does nothing
+    outside of track_progress.
+    """
+    progress = _CELL_PROGRESS.get()
+    if progress is not None:
+        progress.question_done(question_number)
+
+
+def build_experiment_matrix(
+    years: "list[int]", configs: "list[ExperimentConfig]"
+) -> "list[ExperimentCell]":
+    """
+    Returns a cell for every (year, config) pair. The cells are ordered so
+    that neighbouring cells use different models, which spreads the first
+    experiments we start across as many models' quotas as possible.
+    """
+    cells_by_model = {}
+    for year, config in itertools.product(years, configs):
+        cells_by_model.setdefault(config.model, []).append(
+            ExperimentCell(year, config)
+        )
+    cells = []
+    for round_robin in itertools.zip_longest(*cells_by_model.values()):
+        cells.extend(cell for cell in round_robin if cell is not None)
+    return cells
+
+
+def run_experiment_matrix(
+    cells: "list[ExperimentCell]",
+    run_cell,
+    max_concurrent_experiments: int = DEFAULT_MAX_CONCURRENT_EXPERIMENTS,
+) -> "list[str]":
+    """
+    Runs `run_cell(cell)` for every cell, with at most
+    `max_concurrent_experiments` at once. `run_cell` should return the
+    results output file path.
+
+    If a cell fails, the others keep going.
+
+    Returns:
+        output file paths of the cells that finished, in the same order as
+        `cells`
+    """
+    lock = threading.Lock()
+    num_done = [0]
+
+    def _run_one(cell: ExperimentCell):
+        print(f"=== Starting experiment {cell.get_name()} ===")
+        start = time.monotonic()
+        _CELL_NAME.set(cell.get_name())
+        try:
+            path = run_cell(cell)
+        except Exception as e:
+            print(f"[ERROR] experiment {cell.get_name()} failed: {e}")
+            path = None
+        with lock:
+            num_done[0] += 1
+            print(
+                f"=== Finished experiment {cell.get_name()} in "
+                f"{time.monotonic() - start:.0f}s "
+                f"({num_done[0]} of {len(cells)} done): {path} ==="
+            )
+        return path
+
+    jobs = [functools.partial(_run_one, cell) for cell in cells]
+    paths = run_concurrently(jobs, max_concurrency=max_concurrent_experiments)
+    return [path for path in paths if path is not None]
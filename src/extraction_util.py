@@ -0,0 +1,325 @@
+"""
+Cascaded answer extraction for zero-shot responses. Most responses state
+their answer plainly ("The correct answer is C."), so we try a few local
+heuristics first and only send the response to the LLM extractor
+(use_chatgpt_to_extract_answer) when we're not confident.
+
+For re-extracting answers from a results CSV, extract_answers also packs
+several responses to the same question into one extractor request.
+"""
+
+import re
+import threading
+from dataclasses import dataclass
+
+from openai import RateLimitError
+
+from data_util import ExamQuestion, is_nan
+from ensemble_util import NOT_SAMPLED
+from telemetry_util import TELEMETRY, call_context
+from inference_util import (
+    _create_chat_completion,
+    _use_chatgpt_to_extract_answer_for_model,
+    _use_chatgpt_to_extract_answer_internal,
+    get_extractor_exemplars,
+    use_chatgpt_to_extract_answer,
+)
+
+# Below this, we escalate to the LLM extractor.
+CONFIDENCE_THRESHOLD = 0.8
+
+# Confidence for each kind of match.
+_TAG_CONFIDENCE = 0.99
+_PREFERRED_RESPONSE_CONFIDENCE = 0.95
+_PHRASE_CONFIDENCE = 0.9
+_OPTION_TEXT_CONFIDENCE = 0.85
+# Used when a heuristic finds more than one different answer.
+_CONFLICT_CONFIDENCE = 0.3
+
+_TAG_PATTERN = re.compile(
+    r"<(finalAnswer|answer)>\s*\(?([A-E])\)?(?![A-Za-z])[^<]*</\1>"
+)
+_PREFERRED_RESPONSE_PATTERN = re.compile(r"Preferred Response:\s*([A-E])\b")
+# e.g. "The correct answer is C", "Final answer: **(B)**", "the best option
+# would be D.", "The best answer is: B", "The answer is C." The letter has to
+# be upper case so that we don't match the word "a", and a bare letter has to
+# end the statement (so "the answer is A splint" doesn't count).
+_PHRASE_PATTERN = re.compile(
+    r"(?i:\b(?:correct|best|final|most appropriate|most likely)\s+"
+    r"(?:answer|response|choice|option)\s*(?:(?:is|would be)\s*:?|:)"
+    r"|\bthe\s+answer\s+(?:is|would be)\s*:?|\banswer\s*:)"
+    r"\s*(?i:option\s+|choice\s+)?[*_]*"
+    r"(?:\(([A-E])\)|([A-E])(?=[*_]*\s*(?:[.,;:!)\-\u2013\u2014]|$)))",
+    re.MULTILINE,
+)
+_WORD_PATTERN = re.compile(r"[a-z0-9]+")
+# Matches the options in ExamQuestion.format_question, e.g. "B. Splinting".
+_CHOICE_LINE_PATTERN = re.compile(r"^([A-E])\. (.*)$", re.MULTILINE)
+_PACKED_ANSWER_PATTERN = re.compile(
+    r'<finalAnswer id="(\d+)">(.*?)</finalAnswer>', re.DOTALL
+)
+# How many responses we pack into one extractor request. The extractor gets
+# sloppier with more than this.
+MAX_RESPONSES_PER_EXTRACTION = 5
+
+# Used to match the text of an option right after e.g. "the best answer is",
+# up to the end of that sentence.
+_CONCLUSION_PATTERN = re.compile(
+    r"(?i:\b(?:correct|best|final|most appropriate|most likely)\s+"
+    r"(?:answer|response|choice|option)\s*(?:is|would be|:))"
+    r"\s*(.{1,300}?)\s*(?:[;!?\n]|\.(?:\s|$)|$)",
+    re.DOTALL,
+)
+
+
+@dataclass
+class LocalExtraction:
+    answer: str
+    confidence: float
+    method: str
+
+
+def _get_choices(exam_question: ExamQuestion) -> "dict[str, str]":
+    choices = {
+        "A": exam_question.choice_a,
+        "B": exam_question.choice_b,
+        "C": exam_question.choice_c,
+        "D": exam_question.choice_d,
+        "E": exam_question.choice_e,
+    }
+    return {letter: str(text) for letter, text in choices.items() if not is_nan(text)}
+
+
+def parse_choices(question_text: str) -> "dict[str, str]":
+    """Gets the options back out of a formatted question."""
+    return dict(_CHOICE_LINE_PATTERN.findall(question_text))
+
+
+def _normalize_text(text: str) -> str:
+    return " ".join(_WORD_PATTERN.findall(text.lower()))
+
+
+def _from_letters(letters: "list[str]", confidence: float, method: str):
+    if not letters:
+        return None
+    if len(set(letters)) > 1:
+        # e.g. "the answer is not A... the correct answer is B". The LLM
+        # extractor is better at this.
+        return LocalExtraction(letters[-1], _CONFLICT_CONFIDENCE, method)
+    return LocalExtraction(letters[0], confidence, method)
+
+
+def extract_answer_locally(text: str, choices: "dict[str, str]") -> LocalExtraction:
+    """
+    Tries each heuristic from most to least reliable. `choices` maps each
+    letter to the text of its option.
+
+    Returns:
+        the extraction, or None if none of the heuristics found an answer
+    """
+    tag_letters = [m.group(2) for m in _TAG_PATTERN.finditer(text)]
+    extraction = _from_letters(
+        [x for x in tag_letters if x in choices], _TAG_CONFIDENCE, "tag"
+    )
+    if extraction is not None:
+        return extraction
+
+    preferred_letters = _PREFERRED_RESPONSE_PATTERN.findall(text)
+    extraction = _from_letters(
+        [x for x in preferred_letters if x in choices],
+        _PREFERRED_RESPONSE_CONFIDENCE,
+        "preferred_response",
+    )
+    if extraction is not None:
+        return extraction
+
+    phrase_letters = [
+        m.group(1) or m.group(2) for m in _PHRASE_PATTERN.finditer(text)
+    ]
+    extraction = _from_letters(
+        [x for x in phrase_letters if x in choices], _PHRASE_CONFIDENCE, "phrase"
+    )
+    if extraction is not None:
+        return extraction
+
+    # Sometimes the response repeats the option instead of giving the letter,
+    # e.g. "The best answer is carpal tunnel release." The whole sentence has
+    # to be the option, otherwise we leave it to the LLM extractor.
+    normalized_choices = {
+        letter: _normalize_text(choice) for letter, choice in choices.items()
+    }
+    option_letters = []
+    for match in _CONCLUSION_PATTERN.finditer(text):
+        conclusion = _normalize_text(match.group(1))
+        option_letters.extend(
+            letter
+            for letter, choice in normalized_choices.items()
+            if choice and conclusion == choice
+        )
+    return _from_letters(option_letters, _OPTION_TEXT_CONFIDENCE, "option_text")
+
+
+class ExtractionStats:
+    """Counts how often we had to escalate to the LLM extractor."""
+
+    def __init__(self):
+        self.num_local = 0
+        self.num_escalated = 0
+        self._lock = threading.Lock()
+
+    def record(self, escalated: bool):
+        with self._lock:
+            if escalated:
+                self.num_escalated += 1
+            else:
+                self.num_local += 1
+
+    def print_stats(self):
+        total = self.num_local + self.num_escalated
+        escalation_rate = self.num_escalated / total if total else 0
+        print(
+            f"answer extraction: {self.num_escalated} of {total} responses "
+            f"({escalation_rate:.0%}) escalated to the LLM extractor, "
+            f"saved {self.num_local} API calls"
+        )
+
+
+EXTRACTION_STATS = ExtractionStats()
+
+
+def use_cascaded_extractor(
+    client,
+    model,
+    exam_question: ExamQuestion,
+    original_response,
+):
+    """
+    Drop-in replacement for use_chatgpt_to_extract_answer that only calls the
+    LLM extractor when the local heuristics aren't confident.
+    """
+    if original_response is not None:
+        text = original_response.choices[0].message.content or ""
+        extraction = extract_answer_locally(text, _get_choices(exam_question))
+        if extraction is not None and extraction.confidence >= CONFIDENCE_THRESHOLD:
+            EXTRACTION_STATS.record(escalated=False)
+            TELEMETRY.record(kind="extraction", extractor="local")
+            print(
+                f"   extracted answer {extraction.answer} locally "
+                f"(method={extraction.method}, confidence={extraction.confidence})"
+            )
+            return text, extraction.answer
+
+    EXTRACTION_STATS.record(escalated=True)
+    return use_chatgpt_to_extract_answer(client, model, exam_question, original_response)
+
+
+def _extract_answers_packed(
+    client, question_text: str, texts: "list[str]", model=None
+):
+    """
+    Asks the extractor for the answers of several responses to the same
+    question in one request. The exemplars are the same ones the
+    one-at-a-time extractor uses for `model` (see get_extractor_exemplars).
+
+    Returns:
+        list of answers, with None for any the extractor didn't give us, or
+        EXTRACTION_ERROR_RATELIMIT for all of them if we hit our quota
+    """
+    responses = "\n".join(
+        f'<response id="{i}">{text}</response>' for i, text in enumerate(texts)
+    )
+    extractor_prompt = [
+        {
+            "role": "system",
+            "content": 'You are analyzing ChatGPT responses to multiple choice questions. You will be given several responses to the same question. Your task is to extract ChatGPT\'s final answer from each response. \n\nFor each response, reply with just the letter inside finalAnswer tags with the same id. For example, "<finalAnswer id="0">C</finalAnswer>".\n\nIf you cannot identify the answer for a response, reply with "<finalAnswer id="0">Inconclusive</finalAnswer>" \n\nThe examples show one response at a time.',
+        },
+    ]
+    extractor_prompt += get_extractor_exemplars(model)
+    extractor_prompt += [
+        {
+            "role": "user",
+            "content": f"<question>{question_text}</question>\n{responses}",
+        },
+    ]
+    try:
+        with call_context(kind="extraction", extractor="llm_packed"):
+            response = _create_chat_completion(
+                client,
+                model_string="gpt-4o",
+                messages=extractor_prompt,
+                max_tokens=32 * len(texts),
+            )
+    except RateLimitError as e:
+        print(f"[ERROR] Got RateLimitError with packed extraction: {e}")
+        return ["EXTRACTION_ERROR_RATELIMIT"] * len(texts)
+    except Exception as e:
+        print(f"[ERROR] Got error with packed extraction: {e}")
+        return [None] * len(texts)
+
+    answers = [None] * len(texts)
+    for i, answer in _PACKED_ANSWER_PATTERN.findall(
+        response.choices[0].message.content or ""
+    ):
+        if int(i) < len(texts):
+            answers[int(i)] = answer.strip()
+    return answers
+
+
+def extract_answers(
+    client, question_text: str, texts: "list", model=None
+) -> "list[str]":
+    """
+    Extracts the answer from each of the responses to one question (e.g. every
+    chatgpt_discussion_{n} in a row of a results CSV). Local heuristics go
+    first, then the rest are packed into as few extractor requests as
+    possible. Any the packed request misses are extracted one at a time.
+
+    `model` is the model the responses came from, for chat completion
+    results, or None for assistants results. It picks the extractor prompt.
+
+    Once we hit our quota, the rest of the escalated responses are
+    EXTRACTION_ERROR_RATELIMIT.
+    """
+    choices = parse_choices(question_text)
+    answers = [None] * len(texts)
+    to_escalate = []
+    for i, text in enumerate(texts):
+        if text == NOT_SAMPLED:
+            answers[i] = NOT_SAMPLED
+            continue
+        if is_nan(text):
+            # Inference failed, so there's nothing to extract.
+            answers[i] = "PARSE_ERROR"
+            continue
+        extraction = extract_answer_locally(text, choices)
+        if extraction is not None and extraction.confidence >= CONFIDENCE_THRESHOLD:
+            EXTRACTION_STATS.record(escalated=False)
+            TELEMETRY.record(kind="extraction", extractor="local")
+            answers[i] = extraction.answer
+        else:
+            EXTRACTION_STATS.record(escalated=True)
+            to_escalate.append(i)
+
+    rate_limited = False
+    for start in range(0, len(to_escalate), MAX_RESPONSES_PER_EXTRACTION):
+        indices = to_escalate[start : start + MAX_RESPONSES_PER_EXTRACTION]
+        if rate_limited:
+            packed_answers = ["EXTRACTION_ERROR_RATELIMIT"] * len(indices)
+        else:
+            packed_answers = _extract_answers_packed(
+                client, question_text, [texts[i] for i in indices], model
+            )
+        for i, answer in zip(indices, packed_answers):
+            if answer is None and rate_limited:
+                answer = "EXTRACTION_ERROR_RATELIMIT"
+            elif answer is None and model is None:
+                _, answer = _use_chatgpt_to_extract_answer_internal(
+                    client, question_text, texts[i]
+                )
+            elif answer is None:
+                _, answer = _use_chatgpt_to_extract_answer_for_model(
+                    client, model, question_text, texts[i]
+                )
+            rate_limited = rate_limited or answer == "EXTRACTION_ERROR_RATELIMIT"
+            answers[i] = answer
+    return answers
@@ -0,0 +1,160 @@
+"""
+A local stand-in for the OpenAI client. This is useful for dry-running the
+inference scripts (e.g. to check concurrency and retries) without spending
+any money.
+
+Usage:
+    CLIENT = FakeOpenAI(latency_seconds=1, failure_rate=0.1)
+"""
+
+import random
+import threading
+import time
+import uuid
+from types import SimpleNamespace
+
+import httpx
+from openai import InternalServerError, RateLimitError
+from openai.types.chat import ChatCompletion, ChatCompletionChunk
+
+_FAKE_REQUEST = httpx.Request("POST", "https://fake.openai.local/v1/chat/completions")
+
+
+def _fake_status_error(error_cls, status_code, message, headers=None):
+    response = httpx.Response(status_code, headers=headers, request=_FAKE_REQUEST)
+    return error_cls(message, response=response, body=None)
+
+
+class _FakeCompletions:
+    def __init__(self, fake_client):
+        self._fake_client = fake_client
+
+    def create(self, model, messages, **kwargs):
+        return self._fake_client._create_completion(model, messages, **kwargs)
+
+
+class _FakeStream:
+    """Mimics the Stream returned by `create(..., stream=True)`."""
+
+    def __init__(self, chunks, seconds_per_chunk):
+        self._chunks = chunks
+        self._seconds_per_chunk = seconds_per_chunk
+        self.closed = False
+
+    def __iter__(self):
+        for chunk in self._chunks:
+            if self.closed:
+                return
+            time.sleep(self._seconds_per_chunk)
+            yield chunk
+
+    def close(self):
+        self.closed = True
+
+
+def _to_chunks(completion: ChatCompletion, include_usage: bool):
+    """Splits a completion into one chunk per word of each choice."""
+
+    def _chunk(choices, usage=None):
+        return ChatCompletionChunk.model_validate(
+            {
+                "id": completion.id,
+                "object": "chat.completion.chunk",
+                "created": completion.created,
+                "model": completion.model,
+                "choices": choices,
+                "usage": usage,
+            }
+        )
+
+    chunks = []
+    for choice in completion.choices:
+        words = choice.message.content.split(" ")
+        for i, word in enumerate(words):
+            text = word if i == len(words) - 1 else word + " "
+            chunks.append(
+                _chunk([{"index": choice.index, "delta": {"content": text}}])
+            )
+        chunks.append(
+            _chunk([{"index": choice.index, "delta": {}, "finish_reason": "stop"}])
+        )
+    if include_usage:
+        chunks.append(_chunk([], usage=completion.usage.model_dump()))
+    return chunks
+
+
+class FakeOpenAI:
+    """
+    Mimics `client.chat.completions.create`. Each call sleeps for a random
+    amount of time and then either fails or returns a ChatCompletion whose
+    content has <discussion>, <answer> and <finalAnswer> tags, so both the
+    regex and chatgpt parsing functions work with it.
+    """
+
+    def __init__(
+        self,
+        latency_seconds: float = 0.5,
+        failure_rate: float = 0.0,
+        rate_limit_rate: float = 0.0,
+        seed: int = None,
+        supports_n: bool = True,
+    ):
+        self.latency_seconds = latency_seconds
+        self.failure_rate = failure_rate
+        self.rate_limit_rate = rate_limit_rate
+        # Set to False to mimic a backend that ignores `n` and always returns
+        # a single choice.
+        self.supports_n = supports_n
+        self.num_requests = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self.chat = SimpleNamespace(completions=_FakeCompletions(self))
+
+    def _create_completion(self, model, messages, stream=False, stream_options=None, **kwargs):
+        n = kwargs.get("n", 1) if self.supports_n else 1
+        with self._lock:
+            self.num_requests += 1
+            latency = self._random.uniform(0, 2 * self.latency_seconds)
+            roll = self._random.random()
+            letters = [self._random.choice(["A", "B", "C", "D", "E"]) for _ in range(n)]
+
+        time.sleep(latency)
+        if roll < self.rate_limit_rate:
+            raise _fake_status_error(
+                RateLimitError, 429, "fake rate limit", headers={"retry-after": "1"}
+            )
+        if roll < self.rate_limit_rate + self.failure_rate:
+            raise _fake_status_error(InternalServerError, 500, "fake server error")
+
+        contents = [
+            f"<discussion>Fake discussion.</discussion>\n"
+            f"<answer>{letter}</answer>\n"
+            f"<finalAnswer>{letter}</finalAnswer>"
+            for letter in letters
+        ]
+        completion_tokens = sum(len(content) // 4 for content in contents)
+        completion = ChatCompletion.model_validate(
+            {
+                "id": f"fake-{uuid.uuid4()}",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [
+                    {
+                        "index": i,
+                        "finish_reason": "stop",
+                        "message": {"role": "assistant", "content": content},
+                    }
+                    for i, content in enumerate(contents)
+                ],
+                "usage": {
+                    "prompt_tokens": len(str(messages)) // 4,
+                    "completion_tokens": completion_tokens,
+                    "total_tokens": len(str(messages)) // 4 + completion_tokens,
+                },
+            }
+        )
+        if stream:
+            include_usage = bool(stream_options and stream_options.get("include_usage"))
+            return _FakeStream(_to_chunks(completion, include_usage), seconds_per_chunk=0.01)
+        return completion
@@ -3,7 +3,8 @@ Helper functions for doing inference, parsing output, and writing to csv.
 """
 
 from enum import Enum, auto
-import re
+import os
+import time
 from datetime import datetime
 from data_util import ExamQuestion, Reference, ContentType
 from dataclasses import dataclass
@@ -16,6 +17,14 @@ from private import (
     get_file_id_to_reference_mappings_2013,
 )
 from openai import RateLimitError
+from openai.types.chat import ChatCompletion
+from cache_util import ResponseCache, make_cache_key
+from rate_limit_util import RATE_LIMITER
+from token_util import estimate_tokens
+from retry_util import call_with_retries, is_retryable
+from stream_util import stream_chat_completion
+from telemetry_util import TELEMETRY, call_context, get_cached_prompt_tokens
+from parse_util import parse_discussion_and_answer, parse_final_answer, scan_tags
 
 
 # A few notes about models
@@ -59,13 +68,121 @@ class InferenceResult:
     model: Model
     question_type: ContentType
     responses: "list[HandGPTResponse]"
+    # How many of the responses were actually sampled. With adaptive
+    # ensembling, the rest are NOT_SAMPLED placeholders.
+    samples_used: int = None
 
 
-def do_chat_completion(client, model: Model, prompt):
+# Set this to False to always hit the API (e.g. to draw fresh samples for an
+# experiment we've already run).
+USE_RESPONSE_CACHE = True
+RESPONSE_CACHE = ResponseCache()
+# Set this to True to stream inference responses. We then record time to
+# first token, and stop reading as soon as the response has an answer.
+STREAM_RESPONSES = False
+
+
+def _create_chat_completion(
+    client,
+    model_string: str,
+    messages,
+    ensemble_index: int = 0,
+    stream: bool = False,
+    stop_when=None,
+    **kwargs,
+):
+    """
+    All chat completions go through here so that requests are served from the
+    response cache when possible, paced by the shared rate limiter, and
+    retried with backoff on transient errors.
+
+    If `stream` is set, the response is streamed (see stream_util) and we
+    stop reading once `stop_when` returns True for every choice.
+
+    Every call is recorded in TELEMETRY.
+    """
+    cache_params = kwargs
+    if stop_when is not None:
+        # Responses we stopped reading early are cut off, so they shouldn't
+        # be served to callers that want the full response.
+        cache_params = {**kwargs, "stopped_early": True}
+    cache_key = make_cache_key(model_string, messages, cache_params, ensemble_index)
+    if USE_RESPONSE_CACHE:
+        cached = RESPONSE_CACHE.get(cache_key)
+        if cached is not None:
+            TELEMETRY.record(model=model_string, cache_hit=True)
+            return ChatCompletion.model_validate_json(cached)
+
+    estimated_tokens = estimate_tokens(messages) + kwargs.get("max_tokens", 0)
+    num_attempts = 0
+    time_to_first_token = None
+    stopped_early = False
+
+    def _attempt():
+        nonlocal num_attempts, time_to_first_token, stopped_early
+        num_attempts += 1
+        RATE_LIMITER.acquire(model_string, estimated_tokens)
+        if stream:
+            response, timing = stream_chat_completion(
+                client, model_string, messages, stop_when=stop_when, **kwargs
+            )
+            time_to_first_token = timing.time_to_first_token_seconds
+            stopped_early = timing.stopped_early
+            return response
+        return client.chat.completions.create(
+            model=model_string, messages=messages, **kwargs
+        )
+
+    start = time.monotonic()
     try:
-        response = client.chat.completions.create(
-            model=get_model_string(model),
+        response = call_with_retries(_attempt)
+    except Exception as e:
+        TELEMETRY.record(
+            model=model_string,
+            latency_seconds=time.monotonic() - start,
+            retries=num_attempts - 1,
+            error=type(e).__name__,
+        )
+        raise
+    usage = response.usage
+    TELEMETRY.record(
+        model=model_string,
+        # This includes time spent waiting on the rate limiter and backing off.
+        latency_seconds=time.monotonic() - start,
+        time_to_first_token_seconds=time_to_first_token,
+        stopped_early=stopped_early,
+        prompt_tokens=usage.prompt_tokens if usage else 0,
+        cached_prompt_tokens=get_cached_prompt_tokens(usage),
+        completion_tokens=usage.completion_tokens if usage else 0,
+        retries=num_attempts - 1,
+    )
+    RATE_LIMITER.reconcile(model_string, estimated_tokens, usage)
+    if USE_RESPONSE_CACHE:
+        RESPONSE_CACHE.put(cache_key, response.model_dump_json())
+    return response
+
+
+def do_chat_completion(
+    client, model: Model, prompt, ensemble_index: int = 0, n: int = 1
+):
+    """
+    If `n` is more than 1, the response has `n` choices (see split_choices).
+    """
+    # Only pass n when we need it so that cache keys for single samples
+    # don't change.
+    kwargs = {}
+    if n > 1:
+        kwargs["n"] = n
+    if STREAM_RESPONSES:
+        kwargs["stream"] = True
+        kwargs["stop_when"] = _has_complete_answer
+    try:
+        response = _create_chat_completion(
+            client,
+            model_string=get_model_string(model),
             messages=prompt,
+            ensemble_index=ensemble_index,
+            **kwargs,
             # We will only use the default knobs because that's
             # how real people will experience it.
             # temperature=TEMPERATURE,
@@ -77,21 +194,56 @@ def do_chat_completion(client, model: Model, prompt):
         )
         return response
     # Sometimes the servers fail for whatever reason, so let's catch that.
+    # By the time we get here, retryable errors have already been retried.
     except Exception as e:
-        print(f"[ERROR] Got error with inference: {e}")
+        error_type = "retryable" if is_retryable(e) else "fatal"
+        print(f"[ERROR] Got {error_type} error with inference: {e}")
         # print("[INFO] prompt used: {}".format(prompt))
         return None
 
 
-def parse_response_string_answeronly(txt: str):
-    pattern = r"<answer>(.*?)<\/answer>"
+def split_choices(response: ChatCompletion) -> "list[ChatCompletion]":
+    """
+    Splits a response with several choices into one response per choice, so
+    each one can be parsed like a normal response. Only the first keeps the
+    usage, otherwise we would count the tokens once per choice.
+    """
+    return [
+        response.model_copy(
+            update={"choices": [choice], "usage": response.usage if i == 0 else None}
+        )
+        for i, choice in enumerate(response.choices)
+    ]
+
 
-    # Searching for the pattern in the txt
-    match = re.search(pattern, txt, re.DOTALL)
+def do_chat_completions(
+    client, model: Model, prompt, ensemble_indices: "list[int]"
+) -> "list[ChatCompletion]":
+    """
+    Samples one response per ensemble index. We ask for all of them as `n`
+    choices of a single request so that the prompt is only sent (and billed)
+    once. If we get fewer choices back (e.g. the backend doesn't support `n`,
+    or the request failed), the rest are sampled with separate requests.
 
-    # Extracting and printing the content if found
-    if match:
-        answer_content = match.group(1)
+    Returns:
+        list of responses with one choice each, in the same order as
+        `ensemble_indices`. Failed requests are None.
+    """
+    responses = []
+    if len(ensemble_indices) > 1:
+        response = do_chat_completion(
+            client, model, prompt, ensemble_indices[0], n=len(ensemble_indices)
+        )
+        if response is not None:
+            responses = split_choices(response)[: len(ensemble_indices)]
+    for ensemble_index in ensemble_indices[len(responses) :]:
+        responses.append(do_chat_completion(client, model, prompt, ensemble_index))
+    return responses
+
+
+def parse_response_string_answeronly(txt: str):
+    answer_content = scan_tags(txt).first_answer
+    if answer_content is not None:
         return "N/A", answer_content
     else:
         # print("[INFO] No content found within <discussion> or <answer> tags.")
@@ -99,6 +251,14 @@ def parse_response_string_answeronly(txt: str):
         return "PARSE_ERROR", "PARSE_ERROR"
 
 
+def _has_complete_answer(txt: str) -> bool:
+    """Whether a (possibly partial) response already has its answer."""
+    if "</answer>" not in txt:
+        return False
+    _, answer = parse_response_string(txt)
+    return answer != "PARSE_ERROR"
+
+
 def parse_response_answeronly(response):
     if response is None:
         return "PARSE_ERROR", "PARSE_ERROR"
@@ -108,20 +268,7 @@ def parse_response_answeronly(response):
 
 
 def parse_response_string(txt: str):
-    pattern = r"<discussion>(.*?)<\/discussion>\s*<answer>(.*?)<\/answer>"
-
-    # Searching for the pattern in the txt
-    match = re.search(pattern, txt, re.DOTALL)
-
-    # Extracting and printing the content if found
-    if match:
-        discussion_content = match.group(1)
-        answer_content = match.group(2)
-        return discussion_content, answer_content
-    else:
-        # print("[INFO] No content found within <discussion> or <answer> tags.")
-
-        return "PARSE_ERROR", "PARSE_ERROR"
+    return parse_discussion_and_answer(txt)
 
 
 def use_regex_to_extract_answer_chatcompletion(client, model, exam_question, response):
@@ -180,16 +327,18 @@ def write_inference_csv(
     references_list: "list[Reference]" = [],
     year: int = 0,
     exp_name: str = "",
+    output_dir: str = f"{ROOT_DIR}/out/inference",
 ) -> str:
     """
-    Writes inference results to $ROOT_DIR/out/inference
+    Writes inference results to `output_dir` ($ROOT_DIR/out/inference by
+    default)
 
     Returns:
         results file written to
     """
     current_timestamp = datetime.now()
     formatted_timestamp = current_timestamp.strftime("%Y%m%d_%H:%M:%S")
-    filepath = f"{ROOT_DIR}/out/inference/{year}_{exp_name}_{formatted_timestamp}.csv"
+    filepath = f"{output_dir}/{year}_{exp_name}_{formatted_timestamp}.csv"
 
     # print(references_list)
     # build using list
@@ -202,6 +351,7 @@ def write_inference_csv(
             print("WARNING: FATAL ERROR. unexpected...should only be one")
         file_id_mapping[ref.openai_file_id] = ref
 
+    os.makedirs(output_dir, exist_ok=True)
     # Open the file in write mode ('w') and create a csv.writer object
     with open(filepath, "w", newline="") as file:
         writer = csv.writer(file)
@@ -224,6 +374,7 @@ def write_inference_csv(
             "actual_answer",
             "human_correct_percentage",
             "human_distribution",
+            "samples_used",
         ]
         writer.writerow(header)
 
@@ -253,6 +404,11 @@ def write_inference_csv(
                 result.question.get_correct_answer(),
                 result.question.correct_answer_percentage,
                 result.question.get_human_distribution(),
+                (
+                    result.samples_used
+                    if result.samples_used is not None
+                    else len(result.responses)
+                ),
             ]
             writer.writerow(row)
 
@@ -273,7 +429,33 @@ def use_chatgpt_to_extract_answer(
     print("   got zero-shot response, extracting answer...")
     if original_response:
         original_response = original_response.choices[0].message.content
+    return _use_chatgpt_to_extract_answer_for_model(
+        client, model, exam_question.format_question(), original_response
+    )
+
+
+def get_extractor_exemplars(model=None):
+    """
+    The extractor exemplars to use for responses from `model`, or for
+    responses from the assistants API if `model` is None.
+    """
+    if model is None:
+        return ASSISTANTS_EXEMPLARS_FOR_EXTRACTOR
+    if model == Model.GPT3_5:
+        return EXEMPLARS_FOR_GPT3_EXTRACTOR
+    elif model == Model.GPT4 or model == Model.GPT4O:
+        return EXEMPLARS_FOR_GPT4_EXTRACTOR
+    print(f"Extracting with chatgpt for model {model} is not supported")
+    return []
 
+
+def _use_chatgpt_to_extract_answer_for_model(
+    client, model, question_text: str, original_response: str
+):
+    """
+    Same as use_chatgpt_to_extract_answer, but takes the formatted question
+    and the text of the response.
+    """
     extractor_prompt = [
         {
             "role": "system",
@@ -285,33 +467,30 @@ def use_chatgpt_to_extract_answer(
             ],
         },
     ]
-    if model == Model.GPT3_5:
-        extractor_prompt += EXEMPLARS_FOR_GPT3_EXTRACTOR
-    elif model == Model.GPT4 or model == Model.GPT4O:
-        extractor_prompt += EXEMPLARS_FOR_GPT4_EXTRACTOR
-    else:
-        print(f"Extracting with chatgpt for model {model} is not supported")
+    extractor_prompt += get_extractor_exemplars(model)
     extractor_prompt += [
         {
             "role": "user",
-            "content": f"""<question>{exam_question.format_question()}</question> 
+            "content": f"""<question>{question_text}</question> 
 <response>{original_response}</response>""",
         }
     ]
 
     try:
-        response = client.chat.completions.create(
-            # for some reason, gpt-4-turbo seems to be better at extraction than gpt-4o.
-            # therefore, we will use gpt-4-turbo for extraction.
-            # model="gpt-4-turbo",
-            # update june 2 - we will revert to gpt-4o
-            # because we are dropping the gpt4 experiments and observed
-            # some quality regressions in using gpt4 for extraction too
-            model="gpt-4o",
-            # model="gpt-3.5-turbo",
-            messages=extractor_prompt,
-            max_tokens=256,
-        )
+        with call_context(kind="extraction", extractor="llm"):
+            response = _create_chat_completion(
+                client,
+                # for some reason, gpt-4-turbo seems to be better at extraction than gpt-4o.
+                # therefore, we will use gpt-4-turbo for extraction.
+                # model="gpt-4-turbo",
+                # update june 2 - we will revert to gpt-4o
+                # because we are dropping the gpt4 experiments and observed
+                # some quality regressions in using gpt4 for extraction too
+                model_string="gpt-4o",
+                # model="gpt-3.5-turbo",
+                messages=extractor_prompt,
+                max_tokens=256,
+            )
     except RateLimitError as e:
         print(f"[ERROR] Got RateLimitError with extraction: {e}")
         return original_response, "EXTRACTION_ERROR_RATELIMIT"
@@ -322,11 +501,7 @@ def use_chatgpt_to_extract_answer(
 
     response = response.choices[0].message.content
 
-    pattern = r"<finalAnswer>(.*?)<\/finalAnswer>"
-    match = re.search(pattern, response, re.DOTALL)
-    extracted_answer = "PARSE_ERROR"
-    if match:
-        extracted_answer = match.group(1)
+    extracted_answer = parse_final_answer(response)
 
     print(f"   used chatgpt to extract answer {extracted_answer}")
 
@@ -336,33 +511,47 @@ def use_chatgpt_to_extract_answer(
 def use_chatgpt_to_extract_answer_textinput_assistants(
     client, exam_question: ExamQuestion, original_response
 ):
+    return _use_chatgpt_to_extract_answer_internal(
+        client, exam_question.format_question(), original_response
+    )
+
+
+def _use_chatgpt_to_extract_answer_internal(
+    client, question_text: str, original_response: str
+):
+    """
+    Extracts the answer from a text response, given the formatted question
+    (see ExamQuestion.format_question).
+    """
     extractor_prompt = [
         {
             "role": "system",
             "content": 'You are analyzing ChatGPT responses to multiple choice questions. Your task is to extract ChatGPT\'s final answer. \n\nIf you can identify ChatGPT\'s final answer, reply with just that letter inside finalAnswer tags. For example, "<finalAnswer>C</finalAnswer>".\n\nIf you cannot identify the answer, reply with "<finalAnswer>Inconclusive</finalAnswer>" ',
         },
     ]
-    extractor_prompt += ASSISTANTS_EXEMPLARS_FOR_EXTRACTOR
+    extractor_prompt += get_extractor_exemplars()
     extractor_prompt += [
         {
             "role": "user",
-            "content": f"""<question>{exam_question.format_question()}</question> 
+            "content": f"""<question>{question_text}</question> 
 <response>{original_response}</response>""",
         }
     ]
 
     # print(extractor_prompt)
     try:
-        response = client.chat.completions.create(
-            # Update June 1: there was a significant quality drop in gpt-4-turbo
-            # (it couldn't do basic output format of <finalAnswer>) so I'm
-            # switching to gpt-4o.
-            model="gpt-4o",
-            # model="gpt-4-turbo",
-            # model="gpt-3.5-turbo",
-            messages=extractor_prompt,
-            max_tokens=256,
-        )
+        with call_context(kind="extraction", extractor="llm"):
+            response = _create_chat_completion(
+                client,
+                # Update June 1: there was a significant quality drop in gpt-4-turbo
+                # (it couldn't do basic output format of <finalAnswer>) so I'm
+                # switching to gpt-4o.
+                model_string="gpt-4o",
+                # model="gpt-4-turbo",
+                # model="gpt-3.5-turbo",
+                messages=extractor_prompt,
+                max_tokens=256,
+            )
     except RateLimitError as e:
         print(f"[ERROR] Got RateLimitError with extraction: {e}")
         return original_response, "EXTRACTION_ERROR_RATELIMIT"
@@ -373,11 +562,7 @@ def use_chatgpt_to_extract_answer_textinput_assistants(
     response = response.choices[0].message.content
 
     # print(response)
-    pattern = r"<finalAnswer>(.*?)<\/finalAnswer>"
-    match = re.search(pattern, response, re.DOTALL)
-    extracted_answer = "PARSE_ERROR"
-    if match:
-        extracted_answer = match.group(1)
+    extracted_answer = parse_final_answer(response)
 
     print(f"   used chatgpt to extract answer {extracted_answer}")
 
@@ -0,0 +1,144 @@
+"""
+Precompiled patterns and helper functions for parsing model responses (and
+the few exam fields we parse with regex).
+
+Responses are scanned for <discussion>, <answer> and <finalAnswer> tags in a
+single pass (see scan_tags), so getting the discussion, the answer and the
+extractor's answer out of a response doesn't search the text once for each.
+"""
+
+import re
+from dataclasses import dataclass
+
+PARSE_ERROR = "PARSE_ERROR"
+
+# Matches every opening and closing tag we care about, e.g. "<answer>" or
+# "</finalAnswer>".
+_TAG_PATTERN = re.compile(r"<(/?)(discussion|answer|finalAnswer)>")
+# Used to check that only whitespace separates </discussion> and <answer>.
+_WHITESPACE_PATTERN = re.compile(r"\s*")
+
+# e.g. "Preferred Response: C<br /><br />Some discussion..."
+COMMENTARY_PATTERN = re.compile(
+    r"Prefer+ed Response: ?[A-Z](<br /><br />|\s*)(.*)", re.IGNORECASE | re.DOTALL
+)
+# e.g. "2013 Self-Assessment Examination"
+YEAR_PATTERN = re.compile(r"\b\d{4}\b")
+QUESTION_NUMBER_PATTERN = re.compile(r"Q(\d+)", re.IGNORECASE)
+HTML_TAG_PATTERN = re.compile(r"<[^>]+>")
+
+
+@dataclass
+class ParsedTags:
+    # Text inside <discussion></discussion>, when it's directly followed by
+    # an <answer></answer>.
+    discussion: str = None
+    # Text inside the <answer></answer> that follows the discussion.
+    answer: str = None
+    # Text inside the first <answer></answer>, whether or not there's a
+    # discussion.
+    first_answer: str = None
+    # Text inside the first <finalAnswer></finalAnswer> (from the extractor).
+    final_answer: str = None
+
+
+def _find_tags(txt: str):
+    """
+    Returns {(is_closing, name): [(start, end), ...]} for every tag, in order.
+    """
+    tags = {}
+    for match in _TAG_PATTERN.finditer(txt):
+        key = (match.group(1) == "/", match.group(2))
+        tags.setdefault(key, []).append((match.start(), match.end()))
+    return tags
+
+
+def _first_after(spans, position: int):
+    """The first span that starts at or after `position`, or None."""
+    for span in spans:
+        if span[0] >= position:
+            return span
+    return None
+
+
+def _get_first_pair(txt: str, tags, name: str) -> str:
+    """
+    Text inside the first <name></name>. Same as searching for
+    <name>(.*?)</name> with re.DOTALL.
+    """
+    opening = tags.get((False, name))
+    closings = tags.get((True, name))
+    if not opening or not closings:
+        return None
+    closing = _first_after(closings, opening[0][1])
+    if closing is None:
+        return None
+    return txt[opening[0][1] : closing[0]]
+
+
+def _get_discussion_and_answer(txt: str, tags):
+    """
+    Same as searching for
+    <discussion>(.*?)</discussion>\\s*<answer>(.*?)</answer> with re.DOTALL,
+    i.e. the first discussion that's directly followed by an answer.
+    """
+    answer_openings = {start: end for start, end in tags.get((False, "answer"), [])}
+    answer_closings = tags.get((True, "answer"), [])
+    discussion_closings = tags.get((True, "discussion"), [])
+    if not answer_openings or not answer_closings:
+        return None, None
+    for _, discussion_start in tags.get((False, "discussion"), []):
+        for discussion_end, after_discussion in discussion_closings:
+            if discussion_end < discussion_start:
+                continue
+            answer_start = _WHITESPACE_PATTERN.match(txt, after_discussion).end()
+            if answer_start not in answer_openings:
+                continue
+            answer_end = _first_after(answer_closings, answer_openings[answer_start])
+            if answer_end is None:
+                # There are no more </answer>s, so no later match will work.
+                return None, None
+            return (
+                txt[discussion_start:discussion_end],
+                txt[answer_openings[answer_start] : answer_end[0]],
+            )
+    return None, None
+
+
+def scan_tags(txt: str) -> ParsedTags:
+    """
+    Finds every tag in one pass over `txt`, then pulls out the discussion,
+    answer and finalAnswer.
+    """
+    if txt is None:
+        return ParsedTags()
+    tags = _find_tags(txt)
+    discussion, answer = _get_discussion_and_answer(txt, tags)
+    return ParsedTags(
+        discussion=discussion,
+        answer=answer,
+        first_answer=_get_first_pair(txt, tags, "answer"),
+        final_answer=_get_first_pair(txt, tags, "finalAnswer"),
+    )
+
+
+def parse_discussion_and_answer(txt: str):
+    """
+    Returns:
+        (discussion, answer), or PARSE_ERROR for both if the response isn't
+        in the form <discussion>...</discussion> <answer>...</answer>
+    """
+    tags = scan_tags(txt)
+    if tags.answer is None:
+        return PARSE_ERROR, PARSE_ERROR
+    return tags.discussion, tags.answer
+
+
+def parse_final_answer(txt: str) -> str:
+    """The extractor's <finalAnswer>, or PARSE_ERROR."""
+    final_answer = scan_tags(txt).final_answer
+    return PARSE_ERROR if final_answer is None else final_answer
+
+
+def strip_html_tags(txt: str) -> str:
+    return HTML_TAG_PATTERN.sub("", txt).strip()
@@ -4,6 +4,7 @@ Helper functions to construct prompts.
 """
 from data_util import Reference, Category, ExamQuestion, MediaType, QuestionsBuilder, get_n_examples_from_each_category, ContentType
 from openai import OpenAI   
+from token_util import count_message_tokens
 
 def _generate_fake_exemplar(question, choice_a, choice_b, choice_c, choice_d, choice_e, correct_answer, commentary):
     answer_to_num = {
@@ -67,22 +68,32 @@ def get_no_prompt_exemplars():
         ),
     ]
     
+# When retrieving passages, this is roughly how many tokens of references we
+# include per question. Exemplars get much less so that we don't blow the
+# token budget on them.
+REFERENCE_TOKEN_BUDGET = 2000
+EXEMPLAR_REFERENCE_TOKEN_BUDGET = 400
+    
 def _create_question_content(
         exam_question: ExamQuestion, 
         include_reference_text: bool = False, 
-        include_question_tag: bool = False
+        include_question_tag: bool = False,
+        retriever: "ReferenceRetriever" = None,
+        reference_token_budget: int = REFERENCE_TOKEN_BUDGET,
 ):
     content = []
        
     if include_reference_text:
         ref_texts = []
         n = 0
-        for ref in exam_question.references:
-            text = ref.get_text()
-            # Hack: for train exemplars, only take first 1000 chars, otherwise we will hit token limit
-            if exam_question.get_year() == 2012:
-                text = text[0:1000]+' ... (rest of document removed because this is an examplar)'
-            ref_texts.append(f"<document{n}>{text}</document{n}>")
+        # Only include the most relevant passages instead of whole documents.
+        # Reference text is only included when there's a retriever (see
+        # create_prompt).
+        passages = retriever.retrieve_for_question(
+            exam_question, token_budget=reference_token_budget
+        )
+        for passage in passages:
+            ref_texts.append(f"<document{n}>{passage.text}</document{n}>")
             n += 1
         if n == 0:
             ref_texts.append("NONE")
@@ -133,6 +144,73 @@ def _create_question_content(
     return content
 
 
+class _ExemplarBlock:
+    """
+    The [user, assistant] message pair for each exemplar, plus how many
+    tokens each pair takes (per model, since they use different encodings).
+    """
+
+    def __init__(self, messages):
+        self.messages = messages
+        self._num_tokens_by_model = {}
+
+    def get_num_tokens(self, model_string: str) -> "list[int]":
+        if model_string not in self._num_tokens_by_model:
+            self._num_tokens_by_model[model_string] = [
+                count_message_tokens(pair, model_string) for pair in self.messages
+            ]
+        return self._num_tokens_by_model[model_string]
+
+
+# Exemplar messages don't depend on the question, so we build them once per
+# (exemplars, options) and reuse them for every question. The messages are
+# shared between prompts, so don't modify them.
+_EXEMPLAR_BLOCK_CACHE = {}
+
+
+def _get_exemplar_block(
+        exemplars: "list[ExamQuestion]",
+        include_reference_text: bool,
+        include_question_tag: bool,
+        retriever: "ReferenceRetriever",
+) -> _ExemplarBlock:
+    # Fake exemplars (see get_no_prompt_exemplars) are new objects without a
+    # question id every time, so key on the question text too.
+    key = (
+        tuple((exemplar.question_id, exemplar.format_question()) for exemplar in exemplars),
+        include_reference_text,
+        include_question_tag,
+        retriever,
+    )
+    block = _EXEMPLAR_BLOCK_CACHE.get(key)
+    if block is not None:
+        return block
+
+    messages = []
+    for exemplar in exemplars:
+        messages.append([
+            {
+                "role": "user",
+                "content": _create_question_content(
+                    exemplar,
+                    include_reference_text=include_reference_text,
+                    include_question_tag=include_question_tag,
+                    retriever=retriever,
+                    reference_token_budget=EXEMPLAR_REFERENCE_TOKEN_BUDGET,
+                )
+            },
+            {
+                "role": "assistant",
+                "content": _create_discussion_content(
+                    exemplar, include_reference_text=include_reference_text
+                )
+            },
+        ])
+    block = _ExemplarBlock(messages)
+    _EXEMPLAR_BLOCK_CACHE[key] = block
+    return block
+
+
 def _create_discussion_content(exam_question: ExamQuestion, include_reference_text: bool = False):
     ret = ""
     discussion = exam_question.get_clean_commentary()
@@ -145,14 +223,62 @@ def _create_discussion_content(exam_question: ExamQuestion, include_reference_te
     ret += f'<answer>{exam_question.get_correct_answer()}</answer>'
     return ret
 
+def _fit_question_to_budget(
+        exam_question: ExamQuestion,
+        question_message,
+        token_budget: int,
+        model_string: str,
+        include_question_tag: bool,
+        retriever: "ReferenceRetriever",
+):
+    """
+    If the question doesn't fit in `token_budget`, retrieve fewer reference
+    passages for it until it does. The question itself is never trimmed.
+    """
+    num_tokens = count_message_tokens([question_message], model_string)
+    reference_token_budget = REFERENCE_TOKEN_BUDGET
+    while num_tokens > token_budget and retriever is not None and reference_token_budget > 0:
+        reference_token_budget = max(0, reference_token_budget - (num_tokens - token_budget))
+        question_message = {
+            "role": "user",
+            "content": _create_question_content(
+                exam_question,
+                include_reference_text=True,
+                include_question_tag=include_question_tag,
+                retriever=retriever,
+                reference_token_budget=reference_token_budget,
+            )
+        }
+        num_tokens = count_message_tokens([question_message], model_string)
+
+    if num_tokens > token_budget:
+        print(f"   [WARNING] question {exam_question.get_question_number()} doesn't fit in {token_budget} tokens")
+    return question_message, num_tokens
+
+
 def create_prompt(
         preamble: str, 
         exemplars: "list[ExamQuestion]", 
-        exam_question: ExamQuestion
+        exam_question: ExamQuestion,
+        retriever: "ReferenceRetriever" = None,
+        token_budget: int = None,
+        model_string: str = "gpt-4o",
 ):
     """
     Creates a prompt based on a preamble, list of exemplars, and question to ask.
     This supports both text only and image prompts.
+
+    If a retriever is given, the most relevant passages from each question's
+    references are included with the question (and exemplars).
+
+    If a token_budget is given (see token_util.get_prompt_token_budget), the
+    prompt is packed to fit in it. The preamble and question always stay.
+    Exemplars are dropped from the end first, then the question's reference
+    passages are trimmed.
+
+    To make the most of prompt caching, everything that depends on the
+    question comes after the preamble and exemplars, which are the same for
+    every question. Exemplars are kept in the order they're passed in.
     
     Returns
         inputs - message list of everything up until answer (preamble, examplars, question)
@@ -169,37 +295,56 @@ def create_prompt(
             }
         ]
 
-    is_few_shot = False
+    is_few_shot = bool(exemplars)
+    include_reference_text = retriever is not None
+    # Build examplars
+    exemplar_block = _get_exemplar_block(
+        exemplars or [], include_reference_text, is_few_shot, retriever
+    )
+    exemplar_messages = exemplar_block.messages
+
+    # Build question
+    question_message = {
+        "role": "user",
+        "content": _create_question_content(
+            exam_question,
+            include_reference_text=include_reference_text,
+            include_question_tag=is_few_shot,
+            retriever=retriever,
+        )
+    }
+
+    if token_budget is not None:
+        remaining_tokens = token_budget - count_message_tokens(inputs, model_string)
+        question_message, question_tokens = _fit_question_to_budget(
+            exam_question,
+            question_message,
+            remaining_tokens,
+            model_string,
+            is_few_shot,
+            retriever,
+        )
+        remaining_tokens -= question_tokens
+
+        # Keep exemplars in order until we run out of room. Dropping from the
+        # end (instead of skipping a big one) keeps the prompt prefix the same
+        # across questions.
+        num_exemplars = len(exemplar_messages)
+        exemplar_tokens = exemplar_block.get_num_tokens(model_string)
+        for i, num_tokens in enumerate(exemplar_tokens):
+            if num_tokens > remaining_tokens:
+                exemplar_messages = exemplar_messages[:i]
+                break
+            remaining_tokens -= num_tokens
+        if len(exemplar_messages) < num_exemplars:
+            print(f"   dropped {num_exemplars - len(exemplar_messages)} of {num_exemplars} exemplars to fit in {token_budget} tokens")
+
     # Add examplars
-    if exemplars:
-        for exemplar in exemplars:
-            is_few_shot = True
-            inputs.append(
-                {
-                    "role": "user",
-                    "content": _create_question_content(
-                        exemplar,
-                        include_question_tag=is_few_shot
-                    )
-                }
-            )
-            inputs.append(
-                {
-                    "role": "assistant",
-                    "content": _create_discussion_content(exemplar)
-                }
-            )
+    for messages in exemplar_messages:
+        inputs.extend(messages)
 
     # Add question
-    inputs.append(
-        {
-            "role": "user",
-            "content": _create_question_content(
-                exam_question,
-                include_question_tag=is_few_shot
-            )
-        }
-    )
+    inputs.append(question_message)
     
     target = [
         {
@@ -0,0 +1,106 @@
+"""
+Helper functions for pacing requests so we stay under our openAI rate limits.
+
+Every call to the API should go through RATE_LIMITER. That way, when we run
+many requests at once (or several experiments at once), we run at the
+sustained ceiling of our tier instead of bursting and getting 429s.
+"""
+
+import threading
+import time
+
+# (requests per minute, tokens per minute) for each model string on our tier.
+# See https://platform.openai.com/account/limits
+MODEL_RATE_LIMITS = {
+    "gpt-3.5-turbo-0125": (3500, 160000),
+    "gpt-4-turbo-2024-04-09": (500, 300000),
+    "gpt-4o": (500, 300000),
+    "ft:gpt-3.5-turbo-1106:personal::8qxFN6cX": (3500, 160000),
+    "ft:gpt-3.5-turbo-1106:personal::8qxNawaE": (3500, 160000),
+}
+# Used for any model that's not in the map above. This is deliberately
+# conservative.
+DEFAULT_RATE_LIMIT = (500, 30000)
+
+
+class _TokenBucket:
+    """
+    Classic token bucket that refills continuously at `capacity` per minute.
+    The level is allowed to go negative when we under-estimate a request, in
+    which case later requests wait until we've paid back the debt.
+    """
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.level = float(capacity)
+        self.updated_at = time.monotonic()
+
+    def refill(self, now: float):
+        refill_per_second = self.capacity / 60.0
+        elapsed = now - self.updated_at
+        self.level = min(self.capacity, self.level + elapsed * refill_per_second)
+        self.updated_at = now
+
+    def seconds_until_available(self, amount: int) -> float:
+        # Never ask for more than the bucket can hold, otherwise a single
+        # huge prompt would wait forever.
+        amount = min(amount, self.capacity)
+        if self.level >= amount:
+            return 0
+        return (amount - self.level) / (self.capacity / 60.0)
+
+    def consume(self, amount: int):
+        self.level -= amount
+
+
+class RateLimiter:
+    """
+    Process-wide requests-per-minute and tokens-per-minute limiter, with one
+    pair of buckets per model string.
+    """
+
+    def __init__(self, limits=MODEL_RATE_LIMITS, default_limit=DEFAULT_RATE_LIMIT):
+        self._limits = limits
+        self._default_limit = default_limit
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def _get_buckets(self, model_string: str):
+        if model_string not in self._buckets:
+            rpm, tpm = self._limits.get(model_string, self._default_limit)
+            self._buckets[model_string] = (_TokenBucket(rpm), _TokenBucket(tpm))
+        return self._buckets[model_string]
+
+    def acquire(self, model_string: str, estimated_tokens: int):
+        """
+        Blocks until we can send one request with `estimated_tokens` tokens.
+        """
+        while True:
+            with self._lock:
+                requests, tokens = self._get_buckets(model_string)
+                now = time.monotonic()
+                requests.refill(now)
+                tokens.refill(now)
+                wait_seconds = max(
+                    requests.seconds_until_available(1),
+                    tokens.seconds_until_available(estimated_tokens),
+                )
+                if wait_seconds == 0:
+                    requests.consume(1)
+                    tokens.consume(estimated_tokens)
+                    return
+            time.sleep(wait_seconds)
+
+    def reconcile(self, model_string: str, estimated_tokens: int, usage):
+        """
+        Corrects the token bucket once we know the actual usage of a request.
+        `usage` is the `usage` field from the response (it may be None).
+        """
+        if usage is None:
+            return
+        with self._lock:
+            _, tokens = self._get_buckets(model_string)
+            tokens.consume(usage.total_tokens - estimated_tokens)
+
+
+RATE_LIMITER = RateLimiter()
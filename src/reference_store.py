@@ -0,0 +1,222 @@
+"""
+Packs the processed text of every reference into a single corpus file that we
+memory-map. Reading a reference is then a slice of the mapped file instead of
+opening one of thousands of small files, and several worker processes can
+share the same pages in the OS page cache.
+
+The corpus needs to be rebuilt whenever the processed text files change
+(pdf_reader.py does this after it writes them). Loading the corpus doesn't
+look at the text files at all. The index records the size and modification
+time of every file, so if you changed files some other way, run
+
+    python reference_store.py
+
+to rebuild the corpus if any of them changed (or with --rebuild to always
+rebuild it). References that are missing from the corpus are read from their
+text file instead.
+"""
+
+import argparse
+import json
+import mmap
+import os
+import re
+import threading
+from private import ROOT_DIR
+
+REFERENCES_DIR = f"{ROOT_DIR}/data/references"
+REFERENCE_CORPUS_DIR = f"{REFERENCES_DIR}/compiled"
+REFERENCE_CORPUS_PATH = f"{REFERENCE_CORPUS_DIR}/references.bin"
+REFERENCE_CORPUS_INDEX_PATH = f"{REFERENCE_CORPUS_DIR}/references_index.json"
+REFERENCE_YEARS = [2012, 2013]
+
+
+def _normalize(num) -> str:
+    # The reference CSVs give us numbers like 12.0, so drop the decimal.
+    return str(num).split(".")[0]
+
+
+def _corpus_key(year, question_num, reference_num) -> str:
+    return (
+        f"{_normalize(year)}/{_normalize(question_num)}/{_normalize(reference_num)}"
+    )
+
+
+def get_processed_reference_path(year, question_num, reference_num) -> str:
+    year = _normalize(year)
+    question_num = _normalize(question_num)
+    reference_num = _normalize(reference_num)
+    root_dir = f"{REFERENCES_DIR}/handai-{year}-references/drive"
+    return f"{root_dir}/question_{question_num}/reference_{reference_num}/question_{question_num}_reference_{reference_num}_processed.txt"
+
+
+def build_reference_corpus(
+    years: "list[int]" = REFERENCE_YEARS,
+    corpus_path: str = REFERENCE_CORPUS_PATH,
+    index_path: str = REFERENCE_CORPUS_INDEX_PATH,
+):
+    """
+    Writes every *_processed.txt file for the given years into one packed
+    file, plus an index of
+    {year/question/reference: [offset, length, source path, mtime_ns, size]}.
+    """
+    pattern = re.compile(r"question_(\d+)_reference_(\d+)_processed\.txt$")
+    os.makedirs(os.path.dirname(corpus_path), exist_ok=True)
+
+    # Write to temp files and swap them in at the end. That way processes that
+    # already have the old corpus mapped keep working.
+    tmp_corpus_path = f"{corpus_path}.tmp"
+    tmp_index_path = f"{index_path}.tmp"
+    index = {}
+    offset = 0
+    with open(tmp_corpus_path, "wb") as corpus:
+        for year in years:
+            drive_dir = f"{REFERENCES_DIR}/handai-{year}-references/drive"
+            for root, _, files in sorted(os.walk(drive_dir)):
+                for file in sorted(files):
+                    match = pattern.match(file)
+                    if not match:
+                        continue
+                    path = os.path.join(root, file)
+                    # Stat before reading, so that if the file changes while
+                    # we read it, the next load sees it as stale.
+                    stat = os.stat(path)
+                    with open(path, "rb") as text_file:
+                        content = text_file.read()
+                    corpus.write(content)
+                    key = _corpus_key(year, match.group(1), match.group(2))
+                    index[key] = [
+                        offset,
+                        len(content),
+                        path,
+                        stat.st_mtime_ns,
+                        stat.st_size,
+                    ]
+                    offset += len(content)
+
+    with open(tmp_index_path, "w") as file:
+        json.dump(index, file)
+    os.replace(tmp_corpus_path, corpus_path)
+    os.replace(tmp_index_path, index_path)
+    print(
+        f"packed {len(index)} references ({offset / 1024 / 1024:.1f} MB) "
+        f"into {corpus_path}"
+    )
+
+
+def _is_stale(entry) -> bool:
+    """Whether the entry's source file changed since the corpus was built."""
+    if len(entry) < 5:
+        # Built before we recorded the source files, so we can't tell.
+        return True
+    _, _, path, mtime_ns, size = entry
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return True
+    return stat.st_mtime_ns != mtime_ns or stat.st_size != size
+
+
+def validate_reference_corpus(
+    corpus_path: str = REFERENCE_CORPUS_PATH,
+    index_path: str = REFERENCE_CORPUS_INDEX_PATH,
+):
+    """
+    Checks every source file in the index against the size and modification
+    time it had when the corpus was built, and rebuilds the corpus if any of
+    them changed. This stats every file, so it's not done on load.
+    """
+    if not os.path.exists(index_path):
+        print(f"no reference corpus at {corpus_path}, building it")
+        build_reference_corpus(corpus_path=corpus_path, index_path=index_path)
+        return
+    with open(index_path, "r") as file:
+        index = json.load(file)
+    stale_keys = [key for key, entry in index.items() if _is_stale(entry)]
+    if not stale_keys:
+        print(f"all {len(index)} references in {corpus_path} are up to date")
+        return
+    print(
+        f"[WARNING] {len(stale_keys)} references changed since the reference "
+        f"corpus was built (e.g. {stale_keys[0]}), rebuilding it"
+    )
+    years = sorted({int(key.split("/")[0]) for key in index})
+    build_reference_corpus(years, corpus_path, index_path)
+
+
+class ReferenceCorpus:
+    """
+    Read-only view of the packed corpus. The file is mapped lazily the first
+    time a reference is read.
+    """
+
+    def __init__(
+        self,
+        corpus_path: str = REFERENCE_CORPUS_PATH,
+        index_path: str = REFERENCE_CORPUS_INDEX_PATH,
+    ):
+        self.corpus_path = corpus_path
+        self.index_path = index_path
+        self._index = None
+        self._view = None
+        self._lock = threading.Lock()
+
+    def _load(self):
+        with self._lock:
+            if self._index is not None:
+                return
+            if not os.path.exists(self.index_path):
+                print(
+                    f"[WARNING] no reference corpus at {self.corpus_path}, "
+                    "reading references from individual files"
+                )
+                self._index = {}
+                return
+            with open(self.index_path, "r") as file:
+                index = json.load(file)
+            if index:
+                with open(self.corpus_path, "rb") as file:
+                    mapped = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+                self._view = memoryview(mapped)
+            self._index = index
+
+    def get_view(self, year, question_num, reference_num) -> "memoryview | None":
+        """
+        Returns a zero-copy view of the reference's utf-8 bytes, or None if
+        it's not in the corpus.
+        """
+        self._load()
+        entry = self._index.get(_corpus_key(year, question_num, reference_num))
+        if entry is None:
+            return None
+        offset, length = entry[:2]
+        return self._view[offset : offset + length]
+
+    def get_text(self, year, question_num, reference_num) -> "str | None":
+        view = self.get_view(year, question_num, reference_num)
+        if view is None:
+            return None
+        text = str(view, "utf-8")
+        # Match the newline handling of reading the file in text mode.
+        if "\r" in text:
+            text = text.replace("\r\n", "\n").replace("\r", "\n")
+        return text
+
+
+REFERENCE_CORPUS = ReferenceCorpus()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Rebuilds the reference corpus if the processed text files changed."
+    )
+    parser.add_argument(
+        "--rebuild",
+        action="store_true",
+        help="rebuild the corpus without checking the text files",
+    )
+    args = parser.parse_args()
+    if args.rebuild:
+        build_reference_corpus()
+    else:
+        validate_reference_corpus()
@@ -23,14 +23,14 @@ from inference_util import (
     write_inference_csv,
     InferenceResult,
 )
-from openai import OpenAI
+from client_util import get_openai_client
 import time
 import random
 from private import ROOT_DIR
 
 _MAX_FILES_PER_ASSISTANT = 20
 
-client = OpenAI()
+client = get_openai_client()
 references_list = read_references_csv(
     f'{ROOT_DIR}/data/references/handai-2013-references/2013-references.csv"
 )
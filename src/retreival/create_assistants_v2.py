@@ -8,7 +8,6 @@ https://platform.openai.com/docs/assistants/migration
 import os
 import sys
 import pandas as pd
-from openai import OpenAI
 import datetime
 
 
@@ -16,6 +15,7 @@ import datetime
 parent_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 sys.path.append(parent_dir)
 from private import ROOT_DIR
+from client_util import get_openai_client
 from prompt_util import create_instructions_for_assistant
 
 
@@ -65,7 +65,7 @@ def _incrementally_add_files_to_store(client, vector_store_id):
     )
 
 
-OPENAI_CLIENT = OpenAI()
+OPENAI_CLIENT = get_openai_client()
 IS_FEW_SHOT = False
 
 # If you already have the vector store setup, you can just use the old one.
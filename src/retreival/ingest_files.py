@@ -5,7 +5,6 @@ import os
 import sys
 import pandas as pd
 from dataclasses import dataclass
-from openai import OpenAI
 from datetime import datetime
 import csv
 
@@ -13,6 +12,7 @@ import csv
 parent_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 sys.path.append(parent_dir)
 from private import ROOT_DIR
+from client_util import get_openai_client
 
 
 @dataclass
@@ -238,7 +238,7 @@ input = _read_manual_references()
 PDF_DIRECTORY_PATH = f"{ROOT_DIR}/data/references/handai-2013-references/drive"
 _validate_pdfs(PDF_DIRECTORY_PATH)
 
-client = OpenAI()
+client = get_openai_client()
 results = _upload_files_to_openai(client, PDF_DIRECTORY_PATH, input)
 exit()
 
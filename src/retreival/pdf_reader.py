@@ -10,6 +10,7 @@ import pytesseract
 from PIL import Image
 import io
 from private import ROOT_DIR
+from reference_store import build_reference_corpus
 
 
 def read_pdf_with_ocr(pdf_path, tesseract_cmd=None):
@@ -105,3 +106,7 @@ def write_text_for_pdfs(start_path):
 
 # write_text_for_pdfs(f"{ROOT_DIR}/data/references/handai-2013-references/drive")
 write_text_for_pdfs(f"{ROOT_DIR}/data/references/handai-2012-references/drive")
+
+# The processed text files changed, so repack the memory-mapped corpus that
+# Reference.get_text reads from.
+build_reference_corpus()
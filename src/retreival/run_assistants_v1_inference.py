@@ -28,10 +28,11 @@ from inference_util import (
     InferenceResult,
 )
 from private import ROOT_DIR
-from openai import OpenAI
+from assistants_util import run_and_wait
+from client_util import get_openai_client
 import time
 
-client = OpenAI()
+client = get_openai_client()
 
 # question_num_to_assistant = {}
 # assistants = client.beta.assistants.list()
@@ -80,16 +81,13 @@ def query_assistant(client, assistant, exam_question: ExamQuestion):
         content=f"<question>{exam_question.format_question()}</question>",
     )
 
-    run = client.beta.threads.runs.create(
+    run = run_and_wait(
+        client,
         thread_id=thread.id,
         assistant_id=assistant.id,
         # instructions = INSTRUCTIONS_NO_EXEMPLARS
         additional_instructions="Please make sure the response is in the form <discussion>insert discussion</discussion> <answer>C</answer>. Even if you are unsure, please pick one letter you are most confident about.",
-    )
-
-    while run.status in ["queued", "in_progress", "cancelling"]:
-        time.sleep(1)  # Wait for 1 second
-        run = client.beta.threads.runs.retrieve(thread_id=thread.id, run_id=run.id)
+    ).run
 
     if run.status == "completed":
         messages = client.beta.threads.messages.list(thread_id=thread.id)
@@ -27,7 +27,14 @@ from inference_util import (
     InferenceResult,
 )
 from private import ROOT_DIR
-from openai import OpenAI
+from rate_limit_util import RATE_LIMITER
+from token_util import estimate_tokens
+from retry_util import DEFAULT_RETRY_POLICY, call_with_retries, get_backoff_seconds
+from telemetry_util import TELEMETRY, call_context, get_cached_prompt_tokens
+from assistants_util import run_and_wait
+from concurrency_util import run_concurrently
+from client_util import get_openai_client
+import functools
 import time
 
 
@@ -40,15 +47,36 @@ def _query_assistant(client, assistant, prompt, additional_instructions):
         content=prompt,
     )
 
-    run = client.beta.threads.runs.create(
-        thread_id=thread.id,
-        assistant_id=assistant.id,
-        additional_instructions=additional_instructions,
+    # We can't see the file search results up front, so this will be an
+    # under-estimate. It gets reconciled with the run's usage below.
+    estimated_tokens = estimate_tokens(
+        f"{assistant.instructions or ''}{prompt}{additional_instructions or ''}"
+    )
+    RATE_LIMITER.acquire(assistant.model, estimated_tokens)
+    start = time.monotonic()
+    # run_and_wait only handles the stream dropping. Rate limits and other
+    # transient errors are retried here, with backoff.
+    result = call_with_retries(
+        lambda: run_and_wait(
+            client,
+            thread_id=thread.id,
+            assistant_id=assistant.id,
+            use_streaming=STREAM_RUNS,
+            additional_instructions=additional_instructions,
+        )
+    )
+    run = result.run
+    RATE_LIMITER.reconcile(assistant.model, estimated_tokens, run.usage)
+    TELEMETRY.record(
+        kind="assistant",
+        model=assistant.model,
+        latency_seconds=time.monotonic() - start,
+        time_to_first_token_seconds=result.time_to_first_token_seconds,
+        prompt_tokens=run.usage.prompt_tokens if run.usage else 0,
+        cached_prompt_tokens=get_cached_prompt_tokens(run.usage),
+        completion_tokens=run.usage.completion_tokens if run.usage else 0,
+        error=None if run.status == "completed" else run.status,
     )
-
-    while run.status in ["queued", "in_progress", "cancelling"]:
-        time.sleep(1)  # Wait for 1 second
-        run = client.beta.threads.runs.retrieve(thread_id=thread.id, run_id=run.id)
 
     if run.status == "completed":
         messages = client.beta.threads.messages.list(thread_id=thread.id)
@@ -85,7 +113,13 @@ you are unsure, please pick one letter you are most confident about."""
     # Retry up until max retry threshold.
     num_attempts = 1
     while messages is None and num_attempts <= MAX_ATTEMPTS_PER_REQUEST:
-        print(f"      that didn't work. retrying attempt {num_attempts}...")
+        # Back off before retrying so we don't hammer the servers when
+        # they're already struggling.
+        delay = get_backoff_seconds(DEFAULT_RETRY_POLICY, num_attempts - 1)
+        print(
+            f"      that didn't work. retrying attempt {num_attempts} in {delay:.1f}s..."
+        )
+        time.sleep(delay)
         messages = _query_assistant(client, assistant, prompt, additional_instructions)
         num_attempts += 1
     if messages is None:
@@ -110,7 +144,7 @@ you are unsure, please pick one letter you are most confident about."""
     return response
 
 
-OPENAI_CLIENT = OpenAI()
+OPENAI_CLIENT = get_openai_client()
 
 EVAL_SET = (
     QuestionsBuilder()
@@ -128,7 +162,12 @@ EVAL_SET = (
 
 # example of filtering eval set based on questions
 # useful in case you need to redo something.
-# EVAL_SET = [e for e in EVAL_SET if e.get_question_number() in [56, 62, 64, 74, 75, 76, 89, 96, 97, 104, 105, 130, 143, 172, 175, 179, 181, 190]]
+# EVAL_SET = QuestionBank.load().query(
+#     year=2013,
+#     question_content_type=ContentType.TEXT_AND_IMAGES,
+#     has_video=False,
+#     question_numbers=[56, 62, 64, 74, 75, 76, 89, 96, 97, 104, 105, 130, 143, 172, 175, 179, 181, 190],
+# )
 REFERENCES_LIST = read_references_csv(
     f"{ROOT_DIR}/data/references/handai-2013-references/2013-references.csv"
 )
@@ -140,13 +179,31 @@ MAX_ATTEMPTS_PER_REQUEST = 3
 # question multiple times. For example, if this is 5, then we will ask
 # each question 5 times.
 ENSEMBLING_COUNT = 10
-
+# Each run is on its own thread, so we can have many in flight at once.
+MAX_CONCURRENT_RUNS = 16
+# Stream run events instead of polling. Set to False to only poll (with
+# backoff, see assistants_util).
+STREAM_RUNS = True
 
 
 # We will not prune in our final analysis to make the evals easier to explain.
 # prune_questions_without_any_references(EVAL_SET, 2013)
 
 
+def _run_ensembling_query(assistant, entry, n, is_few_shot, experiment_name):
+    print(
+        f"handling question {entry.get_question_number()} "
+        f"(y={entry.get_year()}, type={entry.get_question_content_type()}), "
+        f"ensembling query {n} of {ENSEMBLING_COUNT}"
+    )
+    with call_context(
+        experiment=experiment_name, question_id=entry.question_id, attempt=n
+    ):
+        return _run_assistant_inference(
+            OPENAI_CLIENT, assistant, entry, is_few_shot=is_few_shot
+        )
+
+
 def _run_assistant_inference_with_config(is_few_shot: bool):
     experiment_name = "zero-shot"
     if is_few_shot:
@@ -160,32 +217,34 @@ def _run_assistant_inference_with_config(is_few_shot: bool):
         assistant_id = "asst_JqyeCJIXrbsrqLQ6F7W7hsWV"
     ASSISTANT = OPENAI_CLIENT.beta.assistants.retrieve(assistant_id)
 
-    results = []
-    i = 0
-
-    for entry in EVAL_SET:
-        question_num = str(entry.get_question_number())
-        print(
-            f"handling question {i} of {len(EVAL_SET)} "
-            f"(y={entry.get_year()}, q={question_num},"
-            f" type={entry.get_question_content_type()})"
+    # Every (question, ensembling query) pair is its own run, so do them all
+    # concurrently.
+    jobs = [
+        functools.partial(
+            _run_ensembling_query, ASSISTANT, entry, n, is_few_shot, experiment_name
         )
+        for entry in EVAL_SET
+        for n in range(ENSEMBLING_COUNT)
+    ]
+    all_responses = run_concurrently(
+        jobs,
+        max_concurrency=MAX_CONCURRENT_RUNS,
+        should_stop=lambda r: r.answer == "EXTRACTION_ERROR_RATELIMIT",
+    )
 
-        responses = []
-        for n in range(ENSEMBLING_COUNT):
-            print(f"   doing ensembling query {n} of {ENSEMBLING_COUNT}")
-            response = _run_assistant_inference(
-                OPENAI_CLIENT, ASSISTANT, entry, is_few_shot=is_few_shot
+    results = []
+    for i, entry in enumerate(EVAL_SET):
+        responses = all_responses[i * ENSEMBLING_COUNT : (i + 1) * ENSEMBLING_COUNT]
+        if any(
+            r is None or r.answer == "EXTRACTION_ERROR_RATELIMIT" for r in responses
+        ):
+            print("[GRACEFUL EXIT WARNING] Hit quota limit so ending gracefully")
+            return write_inference_csv(
+                results,
+                references_list=REFERENCES_LIST,
+                year=2013,
+                exp_name=experiment_name,
             )
-            if response.answer == 'EXTRACTION_ERROR_RATELIMIT':
-                print("[GRACEFUL EXIT WARNING] Hit quota limit so ending gracefully")
-                return write_inference_csv(
-                    results,
-                    references_list=REFERENCES_LIST,
-                    year=2013,
-                    exp_name=experiment_name,
-                )
-            responses.append(response)
 
         results.append(
             InferenceResult(
@@ -196,8 +255,8 @@ def _run_assistant_inference_with_config(is_few_shot: bool):
                 responses=responses,
             )
         )
-        i += 1
 
+    TELEMETRY.print_summary(experiment=experiment_name)
     output_filepath =  write_inference_csv(
         results,
         references_list=REFERENCES_LIST,
@@ -212,4 +271,7 @@ paths = []
 paths.append(_run_assistant_inference_with_config(is_few_shot=False))
 paths.append(_run_assistant_inference_with_config(is_few_shot=True))
 print(f"See output at following paths:\n{"\n".join(paths)}")
+TELEMETRY.write_records(
+    f"{ROOT_DIR}/out/telemetry/assistants_v2_{time.strftime('%Y%m%d_%H:%M:%S')}.jsonl"
+)
 print("done :)")
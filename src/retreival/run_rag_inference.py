@@ -1,6 +1,7 @@
 """
-Retrieval by just using ChatCompletions 
-(aka injecting the full text of the reference. Hah)
+Retrieval by just using ChatCompletions. We used to inject the full text of
+every reference; now we only inject the most relevant passages from a local
+BM25 index over the references (see retrieval_util.py).
 """
 
 import os
@@ -21,8 +22,11 @@ from data_util import (
     prune_questions_without_any_references,
 )
 from prompt_util import create_prompt, get_no_prompt_exemplars
+from retrieval_util import ReferenceRetriever
+from token_util import get_prompt_token_budget
 from inference_util import (
     Model,
+    get_model_string,
     HandGPTResponse,
     do_chat_completion,
     use_regex_to_extract_answer,
@@ -30,10 +34,11 @@ from inference_util import (
     write_inference_csv,
     InferenceResult,
 )
-from openai import OpenAI
+from client_util import get_openai_client
 
 
-client = OpenAI()
+# Retries are handled by retry_util, so turn off the client's own retries.
+client = get_openai_client(max_retries=0)
 
 # Minimum system prompt needed to get an answer.
 PREAMBLE_GENERIC = """You are given a multiple-choice question. \
@@ -54,23 +59,16 @@ Finally, inside <answer></answer> tags, write the letter \
 of the answer you have chosen."""
 
 
-def _run_inference(client, selected_model, prompt, parsing_fn):
+def _run_inference(client, selected_model, prompt, parsing_fn, ensemble_index):
     """
-    Runs inference for one prompt on a model, with retries up until the max amount
+    Runs inference for one prompt on a model
     """
-    response = do_chat_completion(client, selected_model, prompt)
-
-    # Retry up until max retry threshold.
-    retry_count = 0
-    while response == None and retry_count < MAX_RETRIES:
-        print(f"      retrying attempt {retry_count}...")
-        response = do_chat_completion(client, selected_model, prompt)
-        retry_count += 1
+    # do_chat_completion retries transient errors with backoff, so if we
+    # still don't have a response, there's no point trying again here.
+    response = do_chat_completion(client, selected_model, prompt, ensemble_index)
     if response == None:
         print(
-            "      [WARNING] failed to get response {} times, this will count as incorrect answer".format(
-                MAX_RETRIES + 1
-            )
+            "      [WARNING] failed to get response, this will count as incorrect answer"
         )
 
     chatgpt_discussion, chatgpt_answer = parsing_fn(response)
@@ -101,7 +99,7 @@ IMAGE_TRAIN_SET = (
 )
 
 
-train_references_dic = read_references_as_dict(2012)
+train_references_dic = read_references_as_dict(TRAIN_YEAR)
 
 
 def get_exemplars(train_set):
@@ -123,7 +121,22 @@ print("attaching references to image exemplars")
 IMAGE_EXEMPLARS = get_exemplars(IMAGE_TRAIN_SET)
 NO_PROMPT_EXEMPLARS = get_no_prompt_exemplars()
 
-MAX_RETRIES = 2
+
+def build_retriever(test_years: "list[int]") -> ReferenceRetriever:
+    """Indexes the train references plus the references for the test years."""
+    references = []
+    for references_dic in [train_references_dic] + [
+        read_references_as_dict(year) for year in test_years
+    ]:
+        for refs in references_dic.values():
+            references.extend(refs)
+    return ReferenceRetriever.from_references(references)
+
+
+TEST_YEARS = [2013]
+print("indexing references")
+RETRIEVER = build_retriever(TEST_YEARS)
+
 # ENSEMBLING_COUNT = 3
 ENSEMBLING_COUNT = 1
 
@@ -178,12 +191,22 @@ def _run_inference_with_configs(
             continue
 
         # attach_references(eval_references_dic, entry)
-        prompt, _ = create_prompt(preamble, exemplars, entry)
+        model_string = get_model_string(selected_model)
+        prompt, _ = create_prompt(
+            preamble,
+            exemplars,
+            entry,
+            retriever=RETRIEVER,
+            token_budget=get_prompt_token_budget(model_string),
+            model_string=model_string,
+        )
 
         responses = []
         for n in range(ENSEMBLING_COUNT):
             print(f"   doing ensembling query {n} of {ENSEMBLING_COUNT}")
-            response = _run_inference(client, selected_model, prompt, parsing_fn)
+            response = _run_inference(
+                client, selected_model, prompt, parsing_fn, ensemble_index=n
+            )
             responses.append(response)
 
         results.append(
@@ -202,7 +225,7 @@ def _run_inference_with_configs(
 
 # TODO(zkbaum) we should probably do these in parallel otherwise we'll be
 # waiting around for a day.
-for year in [2013]:
+for year in TEST_YEARS:
     # GPT4 with no prompt
     _run_inference_with_configs(
         test_year=year,
@@ -4,7 +4,6 @@ Then also creates a google drive folder for each row. That way it's easier
 to keep track of references during manual entry.
 """
 
-import re
 from datetime import datetime
 import csv
 from create_drive_folders import write_directories, DriveDirectory
@@ -17,6 +16,7 @@ from data_util import (
     get_knn_exemplars,
 )
 from dataclasses import dataclass
+from parse_util import strip_html_tags
 from private import ROOT_DIR
 
 
@@ -47,9 +47,9 @@ def _unfold_references(references: str):
     ]
 
     references_filtered = [
-        re.sub("<[^>]+>", "", ref).strip()
-        for ref in references_with_empty_divs_corrected
-        if not re.sub("<[^>]+>", "", ref).strip() == ""
+        stripped
+        for stripped in map(strip_html_tags, references_with_empty_divs_corrected)
+        if stripped
     ]
 
     return references_filtered
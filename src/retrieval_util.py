@@ -0,0 +1,205 @@
+"""
+Local retrieval over the processed reference texts. Instead of injecting the
+full text of every reference into the prompt, we chunk the references into
+passages, index them with BM25 (optionally mixed with embedding similarity),
+and only include the top passages for each question that fit in a token
+budget.
+
+Everything runs locally, there are no API calls here.
+"""
+
+import math
+import pickle
+import re
+from collections import Counter
+from dataclasses import dataclass
+from data_util import ExamQuestion, Reference
+from token_util import estimate_tokens
+
+# Passages are windows of words that overlap a bit so that we don't cut an
+# important sentence in half.
+CHUNK_SIZE_WORDS = 200
+CHUNK_OVERLAP_WORDS = 50
+# Standard BM25 knobs.
+BM25_K1 = 1.5
+BM25_B = 0.75
+# When we have embeddings, this is how much weight BM25 gets vs cosine
+# similarity.
+BM25_WEIGHT = 0.5
+
+_TERM_PATTERN = re.compile(r"[a-z0-9]+")
+_STOPWORDS = set(
+    "a an and are as at be by for from in is it of on or that the this to was "
+    "were which with".split()
+)
+
+
+@dataclass
+class Passage:
+    reference: Reference
+    chunk_index: int
+    text: str
+
+
+def tokenize(text: str) -> "list[str]":
+    return [t for t in _TERM_PATTERN.findall(text.lower()) if t not in _STOPWORDS]
+
+
+def chunk_text(
+    text: str,
+    chunk_size: int = CHUNK_SIZE_WORDS,
+    overlap: int = CHUNK_OVERLAP_WORDS,
+) -> "list[str]":
+    words = text.split()
+    chunks = []
+    step = chunk_size - overlap
+    for start in range(0, len(words), step):
+        chunks.append(" ".join(words[start : start + chunk_size]))
+        if start + chunk_size >= len(words):
+            break
+    return chunks
+
+
+def _reference_key(ref: Reference):
+    # The CSVs sometimes give us 12.0 instead of 12.
+    return tuple(
+        str(x).split(".")[0] for x in [ref.year, ref.question_num, ref.reference_num]
+    )
+
+
+def _normalize_vector(vector):
+    norm = math.sqrt(sum(x * x for x in vector)) or 1
+    return [x / norm for x in vector]
+
+
+class ReferenceRetriever:
+    """
+    BM25 index over passages from the references.
+
+    embed_fn is optional. If given, it should take a list of strings and
+    return a list of vectors (e.g. a local sentence-transformers model), and
+    scores become a mix of BM25 and cosine similarity.
+    """
+
+    def __init__(self, passages: "list[Passage]", embed_fn=None):
+        self.passages = passages
+        self._embed_fn = embed_fn
+
+        # Inverted index of term -> [(passage index, term frequency)]
+        self._postings = {}
+        self._passage_lengths = []
+        self._passages_by_reference = {}
+        for i, passage in enumerate(passages):
+            terms = tokenize(passage.text)
+            self._passage_lengths.append(len(terms))
+            for term, count in Counter(terms).items():
+                self._postings.setdefault(term, []).append((i, count))
+            key = _reference_key(passage.reference)
+            self._passages_by_reference.setdefault(key, []).append(i)
+
+        num_passages = len(passages)
+        self._avg_length = sum(self._passage_lengths) / max(num_passages, 1)
+        self._idf = {
+            term: math.log(1 + (num_passages - len(p) + 0.5) / (len(p) + 0.5))
+            for term, p in self._postings.items()
+        }
+
+        self._vectors = None
+        if embed_fn is not None:
+            self._vectors = [
+                _normalize_vector(v) for v in embed_fn([p.text for p in passages])
+            ]
+
+    @classmethod
+    def from_references(cls, references: "list[Reference]", embed_fn=None):
+        passages = []
+        for ref in references:
+            if not ref.is_uploaded:
+                continue
+            for i, chunk in enumerate(chunk_text(ref.get_text())):
+                passages.append(Passage(reference=ref, chunk_index=i, text=chunk))
+        print(f"indexed {len(passages)} passages from {len(references)} references")
+        return cls(passages, embed_fn=embed_fn)
+
+    def save(self, path: str):
+        """The embedding function isn't saved, pass it to load() instead."""
+        embed_fn = self._embed_fn
+        self._embed_fn = None
+        try:
+            with open(path, "wb") as file:
+                pickle.dump(self, file)
+        finally:
+            self._embed_fn = embed_fn
+
+    @classmethod
+    def load(cls, path: str, embed_fn=None) -> "ReferenceRetriever":
+        with open(path, "rb") as file:
+            retriever = pickle.load(file)
+        retriever._embed_fn = embed_fn
+        return retriever
+
+    def _bm25_scores(self, query: str, candidates: "set[int]") -> "dict[int, float]":
+        scores = {i: 0.0 for i in candidates}
+        for term in set(tokenize(query)):
+            idf = self._idf.get(term)
+            if idf is None:
+                continue
+            for i, count in self._postings[term]:
+                if i not in scores:
+                    continue
+                length_norm = 1 - BM25_B + BM25_B * (
+                    self._passage_lengths[i] / self._avg_length
+                )
+                scores[i] += idf * count * (BM25_K1 + 1) / (count + BM25_K1 * length_norm)
+        return scores
+
+    def search(
+        self,
+        query: str,
+        references: "list[Reference]",
+        top_k: int = 5,
+        token_budget: int = None,
+    ) -> "list[Passage]":
+        """
+        Returns up to `top_k` of the best passages from `references` that fit
+        in `token_budget`, in order of relevance.
+        """
+        candidates = set()
+        for ref in references:
+            candidates.update(self._passages_by_reference.get(_reference_key(ref), []))
+        if not candidates:
+            return []
+
+        scores = self._bm25_scores(query, candidates)
+        if self._vectors is not None:
+            max_score = max(scores.values()) or 1
+            query_vector = _normalize_vector(self._embed_fn([query])[0])
+            for i in scores:
+                cosine = sum(a * b for a, b in zip(query_vector, self._vectors[i]))
+                scores[i] = (
+                    BM25_WEIGHT * scores[i] / max_score + (1 - BM25_WEIGHT) * cosine
+                )
+
+        results = []
+        tokens_used = 0
+        for i in sorted(scores, key=lambda i: scores[i], reverse=True):
+            if len(results) == top_k:
+                break
+            passage = self.passages[i]
+            num_tokens = estimate_tokens(passage.text)
+            if token_budget is not None and tokens_used + num_tokens > token_budget:
+                continue
+            results.append(passage)
+            tokens_used += num_tokens
+        return results
+
+    def retrieve_for_question(
+        self, exam_question: ExamQuestion, top_k: int = 5, token_budget: int = None
+    ) -> "list[Passage]":
+        """Searches the question's own references using the question text."""
+        return self.search(
+            exam_question.format_question(),
+            exam_question.references,
+            top_k=top_k,
+            token_budget=token_budget,
+        )
@@ -0,0 +1,100 @@
+"""
+Helper functions for retrying openAI calls with exponential backoff.
+
+We only retry errors that might go away on their own (429s, 5xx, timeouts).
+Errors like a prompt that's too long or a bad API key will fail the same way
+every time, so we give up on those right away.
+"""
+
+import random
+import time
+from dataclasses import dataclass
+from email.utils import parsedate_to_datetime
+
+from openai import APIConnectionError
+
+
+@dataclass
+class RetryPolicy:
+    max_attempts: int = 4
+    base_delay_seconds: float = 1
+    max_delay_seconds: float = 60
+
+
+DEFAULT_RETRY_POLICY = RetryPolicy()
+
+
+def is_retryable(e: Exception) -> bool:
+    # Covers timeouts too (APITimeoutError is a subclass).
+    if isinstance(e, APIConnectionError):
+        return True
+
+    status_code = getattr(e, "status_code", None)
+    if status_code is None:
+        return False
+    if status_code == 429:
+        # If we're out of quota, waiting won't help.
+        return getattr(e, "code", None) != "insufficient_quota"
+    return status_code >= 500 or status_code in [408, 409]
+
+
+def get_retry_after_seconds(e: Exception):
+    """
+    Returns how long the server asked us to wait, or None if it didn't say.
+    """
+    response = getattr(e, "response", None)
+    if response is None:
+        return None
+    headers = response.headers
+
+    retry_after_ms = headers.get("retry-after-ms")
+    if retry_after_ms:
+        try:
+            return float(retry_after_ms) / 1000
+        except ValueError:
+            pass
+
+    retry_after = headers.get("retry-after")
+    if not retry_after:
+        return None
+    try:
+        return float(retry_after)
+    except ValueError:
+        pass
+    # Retry-After can also be an HTTP date.
+    try:
+        retry_at = parsedate_to_datetime(retry_after)
+        return max(0, retry_at.timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def get_backoff_seconds(policy: RetryPolicy, attempt: int, e: Exception = None):
+    """
+    Exponential backoff with full jitter, unless the server told us how long
+    to wait. `attempt` is 0-indexed.
+    """
+    retry_after = get_retry_after_seconds(e) if e is not None else None
+    if retry_after is not None:
+        return min(retry_after, policy.max_delay_seconds)
+    cap = min(policy.max_delay_seconds, policy.base_delay_seconds * 2**attempt)
+    return random.uniform(0, cap)
+
+
+def call_with_retries(fn, policy: RetryPolicy = DEFAULT_RETRY_POLICY):
+    """
+    Calls `fn` until it succeeds, it raises a non-retryable error, or we run
+    out of attempts. The last error is re-raised.
+    """
+    for attempt in range(policy.max_attempts):
+        try:
+            return fn()
+        except Exception as e:
+            if not is_retryable(e) or attempt == policy.max_attempts - 1:
+                raise
+            delay = get_backoff_seconds(policy, attempt, e)
+            print(
+                f"      [WARNING] got retryable error ({e}). retrying attempt "
+                f"{attempt + 1} of {policy.max_attempts - 1} in {delay:.1f}s..."
+            )
+            time.sleep(delay)
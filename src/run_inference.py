@@ -3,7 +3,12 @@ This is the main entry point for inference. It supports zero and few-shot
 inference.
 """
 
-from openai import OpenAI
+import argparse
+import dataclasses
+import functools
+from datetime import datetime
+
+import inference_util
 
 from data_util import (
     Category,
@@ -12,17 +17,47 @@ from data_util import (
     get_n_examples_from_each_category,
 )
 from prompt_util import create_prompt
+from concurrency_util import run_concurrently
+from checkpoint_util import CheckpointJournal
+from client_util import get_openai_client
+from fake_client import FakeOpenAI
+from experiment_util import (
+    ExperimentCell,
+    ExperimentConfig,
+    build_experiment_matrix,
+    report_question_done,
+    run_experiment_matrix,
+    track_progress,
+)
+from batch_util import BatchRequest, LocalBatchBackend, OpenAIBatchBackend, run_batch
+from token_util import get_prompt_token_budget
+from extraction_util import EXTRACTION_STATS, use_cascaded_extractor
+from ensemble_util import (
+    NOT_SAMPLED,
+    DEFAULT_STOPPING_RULE,
+    StoppingRule,
+    get_next_sample_count,
+    should_stop_sampling,
+)
 from inference_util import (
     Model,
+    get_model_string,
     HandGPTResponse,
-    do_chat_completion,
+    do_chat_completions,
+    split_choices,
     use_regex_to_extract_answer_chatcompletion,
     write_inference_csv,
     InferenceResult,
-    use_chatgpt_to_extract_answer,
+    RESPONSE_CACHE,
 )
+from telemetry_util import TELEMETRY, call_context
+from private import ROOT_DIR
 
-CLIENT = OpenAI()
+# Retries are handled by retry_util, so turn off the client's own retries.
+CLIENT = get_openai_client(max_retries=0)
+# To dry-run without calling the API, swap in the fake client (--batch local
+# does this for you):
+# CLIENT = FakeOpenAI(latency_seconds=1, failure_rate=0.1)
 
 PREAMBLE_DETAILED = """You are a board certified hand surgeon. \
 You are taking a multiple choice exam to test your hand surgery knowledge. \
@@ -33,43 +68,290 @@ tags, briefly discuss each option and decide on the best answer choice. Then, \
 inside <answer></answer> tags, write the letter of the answer you have chosen.
 """
 
-# This is the number of times we can try per request. This accounts for the
-# off-chance that the openAI servers fail.
-MAX_ATTEMPTS_PER_REQUEST = 3
 # Given that ChatGPT is not deterministic, we may want to ask the same
 # question multiple times. For example, if this is 5, then we will ask
-# each question 5 times.
+# each question 5 times. The samples are requested as `n` choices of a single
+# completion, so the prompt is only sent once per question.
 ENSEMBLING_COUNT = 10
+# Placeholder for ensembling queries that adaptive ensembling skipped.
+NOT_SAMPLED_RESPONSE = HandGPTResponse(
+    raw_response=None, discussion=NOT_SAMPLED, answer=NOT_SAMPLED, citations=[]
+)
+# This is the max number of requests we send to openAI at the same time,
+# per experiment.
+MAX_CONCURRENT_REQUESTS = 16
+# This is the max number of experiments we run at the same time.
+MAX_CONCURRENT_EXPERIMENTS = 4
 
 
-def _run_inference(client, entry, selected_model, prompt, parsing_fn):
-    """
-    Runs inference for one prompt on a model,
-    with retries up until the max amount
-    """
-    response = do_chat_completion(client, selected_model, prompt)
-
-    # Retry up until max retry threshold.
-    num_attempts = 1
-    while response is None and num_attempts <= MAX_ATTEMPTS_PER_REQUEST:
-        print(f"      that didn't work. retrying attempt {num_attempts}...")
-        response = do_chat_completion(client, selected_model, prompt)
-        num_attempts += 1
+def _parse_response(client, entry, selected_model, parsing_fn, response):
     if response is None:
         print(
-            f"      [WARNING] failed to get response {num_attempts} times, "
+            "      [WARNING] failed to get response, "
             "this will count as incorrect answer"
         )
 
-    chatgpt_discussion, chatgpt_answer = parsing_fn(client, selected_model, entry, response)        
+    chatgpt_discussion, chatgpt_answer = parsing_fn(client, selected_model, entry, response)
 
-    response = HandGPTResponse(
+    return HandGPTResponse(
         raw_response=response,
         discussion=chatgpt_discussion,
         answer=chatgpt_answer,
         citations=[],
     )
-    return response
+
+
+def _sample_responses(client, entry, selected_model, prompt, ensemble_indices):
+    """
+    Samples one response per ensemble index. All of them are requested in
+    one call (see do_chat_completions), so the prompt is only sent once.
+    """
+    print(
+        f"   doing {len(ensemble_indices)} ensembling queries "
+        f"(q={entry.get_question_number()})"
+    )
+    # do_chat_completion retries transient errors with backoff, so if we
+    # still don't have a response, there's no point trying again here.
+    with call_context(question_id=entry.question_id, attempt=ensemble_indices[0]):
+        return do_chat_completions(client, selected_model, prompt, ensemble_indices)
+
+
+def _is_rate_limited(answer: str) -> bool:
+    return answer == "EXTRACTION_ERROR_RATELIMIT"
+
+
+def _parse_and_checkpoint(
+    journal, client, entry, selected_model, parsing_fn, ensemble_index, response
+):
+    """
+    Parses the response and writes it to the checkpoint journal. Only the
+    answer is returned so that we don't hold every raw response in memory for
+    the whole run.
+    """
+    with call_context(question_id=entry.question_id, attempt=ensemble_index):
+        response = _parse_response(client, entry, selected_model, parsing_fn, response)
+    # Don't checkpoint rate limited responses so they get redone on resume.
+    # Failed requests are checkpointed (they count as incorrect), but marked
+    # so that resume retries them.
+    if not _is_rate_limited(response.answer):
+        journal.append(
+            entry.question_id,
+            ensemble_index,
+            response,
+            failed=response.raw_response is None,
+        )
+    return response.answer
+
+
+def _sample_parse_and_checkpoint(
+    journal, client, entry, selected_model, prompt, parsing_fn, ensemble_indices
+):
+    """
+    Samples the question, then parses and checkpoints each response right
+    away, so a crash only loses the questions that were in flight.
+
+    Returns:
+        list of answers for the question
+    """
+    responses = _sample_responses(
+        client, entry, selected_model, prompt, ensemble_indices
+    )
+    answers = []
+    for n, response in zip(ensemble_indices, responses):
+        answer = _parse_and_checkpoint(
+            journal, client, entry, selected_model, parsing_fn, n, response
+        )
+        answers.append(answer)
+        if _is_rate_limited(answer):
+            return answers
+    report_question_done(entry.get_question_number())
+    return answers
+
+
+def _sample_parse_and_checkpoint_all(journal, model: Model, pending, parsing_fn):
+    """
+    Runs _sample_parse_and_checkpoint for every pending question
+    concurrently.
+
+    Returns:
+        list of answers, like run_concurrently
+    """
+    jobs = [
+        functools.partial(
+            _sample_parse_and_checkpoint,
+            journal,
+            CLIENT,
+            entry,
+            model,
+            prompt,
+            parsing_fn,
+            ensemble_indices,
+        )
+        for entry, prompt, ensemble_indices in pending
+    ]
+    answers_per_question = run_concurrently(
+        jobs,
+        max_concurrency=MAX_CONCURRENT_REQUESTS,
+        should_stop=lambda answers: any(_is_rate_limited(a) for a in answers),
+    )
+    # Questions that were skipped because we hit our quota are None.
+    return [
+        answer
+        for answers in answers_per_question
+        for answer in (answers if answers is not None else [None])
+    ]
+
+
+def _parse_and_checkpoint_all(journal, model: Model, pending, samples, parsing_fn):
+    """
+    Parses and checkpoints every sampled response from a batch. Parsing may
+    call the extractor model, so this is fanned out too.
+
+    Returns:
+        list of answers, like run_concurrently
+    """
+    jobs = []
+    for (entry, _, ensemble_indices), responses in zip(pending, samples):
+        if responses is None:
+            # Sampling was skipped because we hit our quota.
+            continue
+        for n, response in zip(ensemble_indices, responses):
+            jobs.append(
+                functools.partial(
+                    _parse_and_checkpoint,
+                    journal,
+                    CLIENT,
+                    entry,
+                    model,
+                    parsing_fn,
+                    n,
+                    response,
+                )
+            )
+    return run_concurrently(
+        jobs,
+        max_concurrency=MAX_CONCURRENT_REQUESTS,
+        should_stop=_is_rate_limited,
+    )
+
+
+def _run_adaptive_inference(
+    journal, client, entry, selected_model, prompt, parsing_fn, rule, answers
+):
+    """
+    Samples the question in rounds until `rule` says we have enough samples.
+    `answers` maps ensemble index to answer for samples we already have (e.g.
+    from a previous run).
+
+    Returns:
+        list of answers for the question
+    """
+    answers = dict(answers)
+    while not should_stop_sampling(list(answers.values()), rule):
+        count = get_next_sample_count(len(answers), rule)
+        ensemble_indices = [
+            n for n in range(rule.max_samples) if n not in answers
+        ][:count]
+        responses = _sample_responses(
+            client, entry, selected_model, prompt, ensemble_indices
+        )
+        for n, response in zip(ensemble_indices, responses):
+            answer = _parse_and_checkpoint(
+                journal, client, entry, selected_model, parsing_fn, n, response
+            )
+            if _is_rate_limited(answer):
+                return list(answers.values()) + [answer]
+            answers[n] = answer
+    print(
+        f"   stopped after {len(answers)} samples (q={entry.get_question_number()})"
+    )
+    report_question_done(entry.get_question_number())
+    return list(answers.values())
+
+
+def _run_adaptive_inference_for_all(
+    journal, model: Model, questions_and_prompts, parsing_fn, rule, already_completed
+):
+    """
+    Runs adaptive inference for every question concurrently.
+
+    Returns:
+        list of answers, like run_concurrently
+    """
+    jobs = []
+    for entry, prompt in questions_and_prompts:
+        answers = {
+            n: already_completed[(str(entry.question_id), n)]
+            for n in range(rule.max_samples)
+            if (str(entry.question_id), n) in already_completed
+        }
+        jobs.append(
+            functools.partial(
+                _run_adaptive_inference,
+                journal,
+                CLIENT,
+                entry,
+                model,
+                prompt,
+                parsing_fn,
+                rule,
+                answers,
+            )
+        )
+    answers_per_question = run_concurrently(
+        jobs,
+        max_concurrency=MAX_CONCURRENT_REQUESTS,
+        should_stop=lambda answers: any(_is_rate_limited(a) for a in answers),
+    )
+    # Questions that were skipped because we hit our quota are None.
+    return [
+        answer
+        for answers in answers_per_question
+        for answer in (answers if answers is not None else [None])
+    ]
+
+
+def _run_batch_inference(backend, model: Model, pending, batch_name: str):
+    """
+    Sends one request per pending (question, prompt, ensemble indices)
+    through the batch backend, asking for all of the question's samples at
+    once.
+
+    Returns:
+        list of sampled responses for each pending question
+    """
+    model_string = get_model_string(model)
+    requests = []
+    for entry, prompt, ensemble_indices in pending:
+        params = {}
+        if len(ensemble_indices) > 1:
+            params["n"] = len(ensemble_indices)
+        requests.append(
+            BatchRequest(
+                custom_id=f"{entry.question_id}-{ensemble_indices[0]}",
+                model_string=model_string,
+                messages=prompt,
+                ensemble_index=ensemble_indices[0],
+                params=params,
+            )
+        )
+    responses = run_batch(backend, requests, name=batch_name)
+
+    samples = []
+    for (entry, prompt, ensemble_indices), request in zip(pending, requests):
+        response = responses[request.custom_id]
+        responses_for_question = []
+        if response is not None:
+            responses_for_question = split_choices(response)[: len(ensemble_indices)]
+        missing = ensemble_indices[len(responses_for_question) :]
+        if missing:
+            print(
+                f"   [WARNING] batch is missing {len(missing)} samples for "
+                f"q={entry.get_question_number()}, requesting them directly"
+            )
+            responses_for_question += do_chat_completions(CLIENT, model, prompt, missing)
+        samples.append(responses_for_question)
+    return samples
 
 
 TRAIN_YEAR = 2008
@@ -93,8 +375,24 @@ def _run_inference_with_configs(
     exemplars,
     parsing_fn,
     exp_name,
+    resume: bool = False,
+    batch_backend=None,
+    stopping_rule: StoppingRule = None,
 ) -> str:
     """
+    If `resume` is set, (question, ensemble) pairs that are already in the
+    checkpoint journal from a previous run are skipped.
+
+    If `batch_backend` is set (see batch_util), every request is sent in one
+    batch instead of one chat completion at a time.
+
+    Either way, all of a question's ensembling queries are requested together
+    as `n` choices of one completion.
+
+    If `stopping_rule` is set, each question is sampled adaptively (see
+    ensemble_util) with ENSEMBLING_COUNT as the cap. Slots we didn't need are
+    written as NOT_SAMPLED.
+
     Returns:
         results output file string
     """
@@ -102,97 +400,245 @@ def _run_inference_with_configs(
     print(f"--- Beginning experiment {exp_name} for year {test_year} ---")
     eval_set = QuestionsBuilder().year(test_year).build()
 
-    i = 0
-    results = []
-    for entry in eval_set:
+    journal = CheckpointJournal(
+        test_year, exp_name, checkpoint_dir=f"{OUT_DIR}/checkpoints"
+    )
+    if not resume:
+        journal.reset()
+    # Only keep the answers so that we don't hold every raw response in
+    # memory for the whole run.
+    already_completed = {
+        key: response.answer
+        for key, response in journal.read(include_failed=False).items()
+    }
+    if resume:
+        print(f"resuming from {len(already_completed)} responses in {journal.path}")
+
+    # Build all the prompts up front so that we can fan out every
+    # (question, ensemble) pair at once.
+    questions_and_prompts = []
+    model_string = get_model_string(model)
+    for i, entry in enumerate(eval_set):
         print(
             f"handling question {i} of {len(eval_set)} "
             f"(y={entry.get_year()}, q={entry.get_question_number()},"
             f" type={entry.get_question_content_type()})"
         )
-        i += 1
 
         if entry.question_has_text_and_images() and model == Model.GPT3_5:
             print("   skipping because gpt3.5 does not support image")
             continue
 
-       
-        prompt, _ = create_prompt(preamble, exemplars, entry)
+        prompt, _ = create_prompt(
+            preamble,
+            exemplars,
+            entry,
+            token_budget=get_prompt_token_budget(model_string),
+            model_string=model_string,
+        )
+        questions_and_prompts.append((entry, prompt))
 
-        responses = []
-        for n in range(ENSEMBLING_COUNT):
-            print(f" doing ensembling query {n} of {ENSEMBLING_COUNT}")
-            response = _run_inference(CLIENT, entry, model, prompt, parsing_fn)
-            if response.answer == 'EXTRACTION_ERROR_RATELIMIT':
-                print("[GRACEFUL EXIT WARNING] Hit quota limit so ending gracefully")
-                return write_inference_csv(results, year=test_year, exp_name=exp_name)
-            # print(f"[debug] got response: {response}")
-            responses.append(response)
+    # Tag every API call with the experiment (see telemetry_util). Other
+    # years of the same experiment may be running at the same time, so
+    # include the year.
+    telemetry_name = f"{test_year}_{exp_name}"
+    with call_context(experiment=telemetry_name):
+        if stopping_rule is not None:
+            stopping_rule = dataclasses.replace(
+                stopping_rule, max_samples=ENSEMBLING_COUNT
+            )
+            with track_progress(len(questions_and_prompts)):
+                answers = _run_adaptive_inference_for_all(
+                    journal,
+                    model,
+                    questions_and_prompts,
+                    parsing_fn,
+                    stopping_rule,
+                    already_completed,
+                )
+        else:
+            # Each question's ensembling queries are sampled together, so group
+            # the ones we still need by question.
+            pending = []
+            for entry, prompt in questions_and_prompts:
+                ensemble_indices = [
+                    n
+                    for n in range(ENSEMBLING_COUNT)
+                    if (str(entry.question_id), n) not in already_completed
+                ]
+                if ensemble_indices:
+                    pending.append((entry, prompt, ensemble_indices))
 
+            if batch_backend is not None:
+                # Batch results all come back at once, so they're parsed
+                # afterwards.
+                samples = _run_batch_inference(
+                    batch_backend, model, pending, batch_name=f"{test_year}_{exp_name}"
+                )
+                answers = _parse_and_checkpoint_all(
+                    journal, model, pending, samples, parsing_fn
+                )
+            else:
+                with track_progress(len(pending)):
+                    answers = _sample_parse_and_checkpoint_all(
+                        journal, model, pending, parsing_fn
+                    )
+    if any(a is None or _is_rate_limited(a) for a in answers):
+        print("[GRACEFUL EXIT WARNING] Hit quota limit so ending gracefully")
+
+    # Materialize the results from the journal. If we hit our quota, we only
+    # keep questions where every ensembling query finished (or, for adaptive
+    # ensembling, where we stopped sampling).
+    completed = journal.read()
+    results = []
+    num_incomplete = 0
+    for entry, prompt in questions_and_prompts:
+        keys = [(str(entry.question_id), n) for n in range(ENSEMBLING_COUNT)]
+        sampled_keys = [key for key in keys if key in completed]
+        if stopping_rule is None:
+            is_complete = len(sampled_keys) == len(keys)
+        else:
+            is_complete = should_stop_sampling(
+                [completed[key].answer for key in sampled_keys], stopping_rule
+            )
+        if not is_complete:
+            num_incomplete += 1
+            continue
         results.append(
             InferenceResult(
                 question=entry,
                 prompt=prompt,
                 question_type=entry.get_question_content_type(),
                 model=model,
-                responses=responses,
+                responses=[completed.get(key, NOT_SAMPLED_RESPONSE) for key in keys],
+                samples_used=len(sampled_keys),
             )
         )
+    if num_incomplete:
+        print(
+            f"[WARNING] {num_incomplete} questions are incomplete. "
+            "Rerun with --resume to finish them."
+        )
 
-    result_filepath = write_inference_csv(results, year=test_year, exp_name=exp_name)
+    num_correct = sum(
+        response.answer == result.question.get_correct_answer()
+        for result in results
+        for response in result.responses
+    )
+    TELEMETRY.print_summary(experiment=telemetry_name, num_correct=num_correct)
+
+    result_filepath = write_inference_csv(
+        results,
+        year=test_year,
+        exp_name=exp_name,
+        output_dir=f"{OUT_DIR}/inference",
+    )
     print("")
     return result_filepath
 
 
-# TODO(zkbaum) we should probably do these in parallel otherwise we'll be
-# waiting around for a day.
+parser = argparse.ArgumentParser(description="Runs inference experiments.")
+parser.add_argument(
+    "--resume",
+    action="store_true",
+    help="Skip responses that are already in the checkpoint journal from a "
+    "previous run of the same experiment.",
+)
+parser.add_argument(
+    "--batch",
+    choices=["openai", "local"],
+    default=None,
+    help="Send requests through the Batch API instead of one at a time. "
+    "'local' runs the batch against a fake client, for dry runs.",
+)
+parser.add_argument(
+    "--adaptive",
+    action="store_true",
+    help="Stop sampling each question once we're confident about the "
+    "majority answer, instead of always doing ENSEMBLING_COUNT queries.",
+)
+parser.add_argument(
+    "--stream",
+    action="store_true",
+    help="Stream responses to record time to first token, and stop reading "
+    "each response once it has an <answer> tag.",
+)
+ARGS = parser.parse_args()
+inference_util.STREAM_RESPONSES = ARGS.stream
+if ARGS.adaptive and ARGS.batch:
+    parser.error("--adaptive needs the answers as they come in, so it can't be used with --batch")
+STOPPING_RULE = DEFAULT_STOPPING_RULE if ARGS.adaptive else None
+
+# Checkpoints, results and telemetry go under here.
+OUT_DIR = f"{ROOT_DIR}/out"
+BATCH_BACKEND = None
+if ARGS.batch == "openai":
+    BATCH_BACKEND = OpenAIBatchBackend(CLIENT)
+elif ARGS.batch == "local":
+    # This is a dry run, so nothing may call the real API (including answer
+    # extraction during parsing) and none of the fake responses may be mixed
+    # in with real ones: skip the response cache and write everything to a
+    # separate directory.
+    CLIENT = FakeOpenAI(latency_seconds=0.1)
+    BATCH_BACKEND = LocalBatchBackend(CLIENT)
+    inference_util.USE_RESPONSE_CACHE = False
+    OUT_DIR = f"{ROOT_DIR}/out/dry_run"
+    print(f"[WARNING] dry run with a fake client, writing output to {OUT_DIR}")
+
 # for year in [2009, 2010, 2011, 2012, 2013]:
-paths = []
-for year in [2013]:
-    # GPT3.5 zero-shot
-    paths.append(
-        _run_inference_with_configs(
-            test_year=year,
-            model=Model.GPT3_5,
-            preamble=None,
-            exemplars=None,
-            parsing_fn=use_chatgpt_to_extract_answer,
-            exp_name="gpt3_zero_shot",
-        )
-    )
-    # GPT4 zero-shot
-    # paths.append(
-    #     _run_inference_with_configs(
-    #         test_year=year,
-    #         model=Model.GPT4,
-    #         preamble=None,
-    #         exemplars=None,
-    #         parsing_fn=use_chatgpt_to_extract_answer,
-    #         exp_name="gpt4_zero_shot_shard4",
-    #     )
-    # )
-    # GPT4o zero-shot
-    paths.append(
-        _run_inference_with_configs(
-            test_year=year,
-            model=Model.GPT4O,
-            preamble=None,
-            exemplars=None,
-            parsing_fn=use_chatgpt_to_extract_answer,
-            exp_name="gpt4o_zero_shot",
-        )
-    )
-    # # GPT4 few shot
-    paths.append(
-        _run_inference_with_configs(
-            test_year=year,
-            model=Model.GPT4O,
-            preamble=PREAMBLE_DETAILED,
-            exemplars=TEXT_EXEMPLARS,
-            parsing_fn=use_regex_to_extract_answer_chatcompletion,
-            exp_name="gpt4o_few_shot",
-        )
+TEST_YEARS = [2013]
+EXPERIMENT_CONFIGS = [
+    ExperimentConfig(
+        exp_name="gpt3_zero_shot",
+        model=Model.GPT3_5,
+        parsing_fn=use_cascaded_extractor,
+    ),
+    # ExperimentConfig(
+    #     exp_name="gpt4_zero_shot_shard4",
+    #     model=Model.GPT4,
+    #     parsing_fn=use_cascaded_extractor,
+    # ),
+    ExperimentConfig(
+        exp_name="gpt4o_zero_shot",
+        model=Model.GPT4O,
+        parsing_fn=use_cascaded_extractor,
+    ),
+    ExperimentConfig(
+        exp_name="gpt4o_few_shot",
+        model=Model.GPT4O,
+        parsing_fn=use_regex_to_extract_answer_chatcompletion,
+        preamble=PREAMBLE_DETAILED,
+        exemplars=TEXT_EXEMPLARS,
+    ),
+]
+
+
+def _run_cell(cell: ExperimentCell) -> str:
+    return _run_inference_with_configs(
+        test_year=cell.year,
+        model=cell.config.model,
+        preamble=cell.config.preamble,
+        exemplars=cell.config.exemplars,
+        parsing_fn=cell.config.parsing_fn,
+        exp_name=cell.config.exp_name,
+        resume=ARGS.resume,
+        batch_backend=BATCH_BACKEND,
+        stopping_rule=STOPPING_RULE,
     )
 
+
+# Every (year, config) cell runs at the same time, sharing the rate limits.
+paths = run_experiment_matrix(
+    build_experiment_matrix(TEST_YEARS, EXPERIMENT_CONFIGS),
+    _run_cell,
+    max_concurrent_experiments=MAX_CONCURRENT_EXPERIMENTS,
+)
+
 print(f"See output at following paths:\n{"\n".join(paths)}")
+RESPONSE_CACHE.print_stats()
+TELEMETRY.print_summary()
+TELEMETRY.write_records(
+    f"{OUT_DIR}/telemetry/{datetime.now().strftime('%Y%m%d_%H:%M:%S')}.jsonl"
+)
+EXTRACTION_STATS.print_stats()
 print("done :)")
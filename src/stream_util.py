@@ -0,0 +1,130 @@
+"""
+Helper functions for streaming chat completions. Streaming lets us measure
+time-to-first-token, and lets us stop reading once we have what we need (e.g.
+the <answer> tag) instead of waiting for the model to finish a long
+discussion.
+
+The timings end up in TELEMETRY (see inference_util._create_chat_completion).
+"""
+
+import time
+from dataclasses import dataclass
+
+from openai.types.chat import ChatCompletion
+
+from token_util import count_message_tokens, count_tokens
+
+
+@dataclass
+class StreamTiming:
+    time_to_first_token_seconds: float
+    total_seconds: float
+    stopped_early: bool
+
+
+def _estimate_usage(model_string: str, messages, texts: "list[str]") -> dict:
+    """
+    The usage we report when the server didn't send one (e.g. we stopped
+    early): the prompt tokens plus the tokens we actually received. The
+    server may have generated a few more before it noticed we closed the
+    stream.
+    """
+    prompt_tokens = count_message_tokens(messages, model_string)
+    completion_tokens = sum(count_tokens(text, model_string) for text in texts)
+    return {
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "total_tokens": prompt_tokens + completion_tokens,
+    }
+
+
+def stream_chat_completion(
+    client, model_string: str, messages, stop_when=None, **kwargs
+) -> "tuple[ChatCompletion, StreamTiming]":
+    """
+    Streams a chat completion and puts it back together into a
+    ChatCompletion, so callers can treat it like a normal response.
+
+    If `stop_when` is given, it's called with a choice's text so far whenever
+    a chunk might have closed a tag (i.e. has a ">"). Once it returns True for
+    every choice, we stop reading. When we stop early, the server doesn't
+    send the usage, so the response has an estimate instead (see
+    _estimate_usage).
+    """
+    num_choices = kwargs.get("n", 1)
+    start = time.monotonic()
+    stream = client.chat.completions.create(
+        model=model_string,
+        messages=messages,
+        stream=True,
+        stream_options={"include_usage": True},
+        **kwargs,
+    )
+
+    first_token_at = None
+    metadata = None
+    pieces = {}
+    finish_reasons = {}
+    done = set()
+    usage = None
+    stopped_early = False
+    try:
+        for chunk in stream:
+            if metadata is None:
+                metadata = {"id": chunk.id, "created": chunk.created, "model": chunk.model}
+            # With include_usage, the last chunk has the usage and no choices.
+            if chunk.usage is not None:
+                usage = chunk.usage.model_dump()
+            for choice in chunk.choices:
+                pieces.setdefault(choice.index, [])
+                if choice.finish_reason is not None:
+                    finish_reasons[choice.index] = choice.finish_reason
+                content = choice.delta.content
+                if not content:
+                    continue
+                if first_token_at is None:
+                    first_token_at = time.monotonic()
+                pieces[choice.index].append(content)
+                if (
+                    stop_when is not None
+                    and ">" in content
+                    and stop_when("".join(pieces[choice.index]))
+                ):
+                    done.add(choice.index)
+            if stop_when is not None and len(done) == num_choices:
+                stopped_early = True
+                break
+    finally:
+        # Closing the stream drops the connection, so the server stops
+        # generating the rest of the response.
+        stream.close()
+
+    end = time.monotonic()
+    timing = StreamTiming(
+        time_to_first_token_seconds=(
+            first_token_at - start if first_token_at is not None else None
+        ),
+        total_seconds=end - start,
+        stopped_early=stopped_early,
+    )
+    metadata = metadata or {"id": "", "created": 0, "model": model_string}
+    if usage is None:
+        usage = _estimate_usage(
+            model_string, messages, ["".join(p) for p in pieces.values()]
+        )
+    response = ChatCompletion.model_validate(
+        {
+            **metadata,
+            "object": "chat.completion",
+            "choices": [
+                {
+                    "index": i,
+                    "finish_reason": finish_reasons.get(i, "stop"),
+                    "message": {"role": "assistant", "content": "".join(pieces[i])},
+                }
+                for i in sorted(pieces)
+            ],
+            "usage": usage,
+        }
+    )
+    return response, timing
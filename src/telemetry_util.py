@@ -0,0 +1,223 @@
+"""
+Structured records for every API call, so we can compare experiments on
+latency, tokens and cost instead of just accuracy.
+
+Every chat completion (see inference_util._create_chat_completion) and
+assistant run records a CallRecord. Fields that the call site doesn't know
+about (e.g. which experiment or question the call is for) come from the
+current call context:
+
+    with call_context(experiment="gpt4o_few_shot", question_id=123, attempt=0):
+        do_chat_completion(...)
+
+The context is a contextvar, so it follows jobs onto worker threads (see
+concurrency_util.run_concurrently).
+"""
+
+import contextlib
+import contextvars
+import dataclasses
+import json
+import os
+import threading
+import time
+from dataclasses import dataclass
+
+# (input, output) price in USD per million tokens.
+# See https://openai.com/api/pricing
+MODEL_PRICES_PER_MILLION_TOKENS = {
+    "gpt-3.5-turbo-0125": (0.5, 1.5),
+    "gpt-4-turbo-2024-04-09": (10, 30),
+    "gpt-4o": (5, 15),
+    "ft:gpt-3.5-turbo-1106:personal::8qxFN6cX": (3, 6),
+    "ft:gpt-3.5-turbo-1106:personal::8qxNawaE": (3, 6),
+}
+# Prompt tokens served from the provider's prompt cache are billed at this
+# fraction of the input price.
+CACHED_INPUT_PRICE_MULTIPLIER = 0.5
+
+_CALL_CONTEXT = contextvars.ContextVar("call_context", default={})
+
+
+@contextlib.contextmanager
+def call_context(**fields):
+    """Adds `fields` to every record made inside the `with` block."""
+    token = _CALL_CONTEXT.set({**_CALL_CONTEXT.get(), **fields})
+    try:
+        yield
+    finally:
+        _CALL_CONTEXT.reset(token)
+
+
+@dataclass
+class CallRecord:
+    # "inference", "extraction" or "assistant"
+    kind: str = "inference"
+    model: str = None
+    experiment: str = None
+    question_id: str = None
+    attempt: int = None
+    # Which extractor produced the answer ("local", "llm" or "llm_packed"),
+    # for extraction calls.
+    extractor: str = None
+    started_at: float = None
+    latency_seconds: float = 0
+    time_to_first_token_seconds: float = None
+    # Whether we stopped reading a streamed response once we had what we
+    # needed (see stream_util).
+    stopped_early: bool = False
+    prompt_tokens: int = 0
+    # How many of the prompt tokens were a prompt cache hit on the
+    # provider's side. Not to be confused with cache_hit below, which is our
+    # own response cache.
+    cached_prompt_tokens: int = 0
+    completion_tokens: int = 0
+    retries: int = 0
+    cache_hit: bool = False
+    error: str = None
+
+    def get_cost(self) -> float:
+        # Cache hits didn't cost us anything.
+        if self.cache_hit or self.model not in MODEL_PRICES_PER_MILLION_TOKENS:
+            return 0
+        input_price, output_price = MODEL_PRICES_PER_MILLION_TOKENS[self.model]
+        uncached_prompt_tokens = self.prompt_tokens - self.cached_prompt_tokens
+        return (
+            uncached_prompt_tokens * input_price
+            + self.cached_prompt_tokens * input_price * CACHED_INPUT_PRICE_MULTIPLIER
+            + self.completion_tokens * output_price
+        ) / 1e6
+
+
+def get_cached_prompt_tokens(usage) -> int:
+    """
+    Returns how many prompt tokens the provider served from its prompt cache.
+    Older responses (and the Assistants API) don't report this, so it's 0.
+    """
+    details = getattr(usage, "prompt_tokens_details", None)
+    return getattr(details, "cached_tokens", None) or 0
+
+
+def _percentile(values, p):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(p * len(values)))]
+
+
+class Telemetry:
+    def __init__(self):
+        self.records = []
+        self._lock = threading.Lock()
+
+    def record(self, **fields) -> CallRecord:
+        """
+        Makes a record from the current call context and `fields`. Fields
+        passed in take precedence over the context.
+        """
+        known_fields = {f.name for f in dataclasses.fields(CallRecord)}
+        context = {k: v for k, v in _CALL_CONTEXT.get().items() if k in known_fields}
+        record = CallRecord(**{**context, **fields})
+        if record.started_at is None:
+            record.started_at = time.time() - record.latency_seconds
+        with self._lock:
+            self.records.append(record)
+        return record
+
+    def get_records(self, experiment: str = None) -> "list[CallRecord]":
+        with self._lock:
+            records = list(self.records)
+        if experiment is not None:
+            records = [r for r in records if r.experiment == experiment]
+        return records
+
+    def summarize(self, experiment: str = None, num_correct: int = None) -> dict:
+        records = self.get_records(experiment)
+        api_records = [r for r in records if not r.cache_hit and r.model is not None]
+        latencies = [r.latency_seconds for r in api_records if r.error is None]
+        # Only streamed responses have a time to first token.
+        ttfts = [
+            r.time_to_first_token_seconds
+            for r in api_records
+            if r.time_to_first_token_seconds is not None
+        ]
+        completion_tokens = sum(r.completion_tokens for r in api_records)
+        prompt_tokens = sum(r.prompt_tokens for r in api_records)
+        cached_prompt_tokens = sum(r.cached_prompt_tokens for r in api_records)
+        total_tokens = completion_tokens + prompt_tokens
+        wall_seconds = 0
+        if api_records:
+            wall_seconds = max(
+                r.started_at + r.latency_seconds for r in api_records
+            ) - min(r.started_at for r in api_records)
+        cost = sum(r.get_cost() for r in records)
+        extraction_records = [r for r in records if r.kind == "extraction"]
+        return {
+            "num_calls": len(records),
+            "num_api_calls": len(api_records),
+            "num_cache_hits": sum(r.cache_hit for r in records),
+            "num_errors": sum(r.error is not None for r in records),
+            "num_retries": sum(r.retries for r in records),
+            "num_local_extractions": sum(
+                r.extractor == "local" for r in extraction_records
+            ),
+            "num_llm_extractions": sum(
+                r.extractor != "local" for r in extraction_records
+            ),
+            "latency_p50": _percentile(latencies, 0.5),
+            "latency_p95": _percentile(latencies, 0.95),
+            "latency_p99": _percentile(latencies, 0.99),
+            "num_streamed": len(ttfts),
+            "num_stopped_early": sum(r.stopped_early for r in api_records),
+            "time_to_first_token_p50": _percentile(ttfts, 0.5),
+            "time_to_first_token_p95": _percentile(ttfts, 0.95),
+            "prompt_tokens": prompt_tokens,
+            "cached_prompt_tokens": cached_prompt_tokens,
+            # Share of prompt tokens that hit the provider's prompt cache.
+            "prompt_cache_hit_rate": (
+                cached_prompt_tokens / prompt_tokens if prompt_tokens else 0
+            ),
+            "completion_tokens": completion_tokens,
+            # Over the whole run, so this goes up with concurrency.
+            "tokens_per_second": total_tokens / wall_seconds if wall_seconds else 0,
+            "cost": cost,
+            "cost_per_correct_answer": cost / num_correct if num_correct else None,
+        }
+
+    def print_summary(self, experiment: str = None, num_correct: int = None):
+        s = self.summarize(experiment, num_correct)
+        name = experiment or "all experiments"
+        cost_per_correct = (
+            f"${s['cost_per_correct_answer']:.4f}"
+            if s["cost_per_correct_answer"] is not None
+            else "n/a"
+        )
+        print(
+            f"telemetry for {name}: {s['num_calls']} calls "
+            f"({s['num_api_calls']} to the API, {s['num_cache_hits']} cached, "
+            f"{s['num_errors']} errors, {s['num_retries']} retries)\n"
+            f"   latency p50={s['latency_p50']:.2f}s p95={s['latency_p95']:.2f}s "
+            f"p99={s['latency_p99']:.2f}s\n"
+            f"   streamed: {s['num_streamed']} responses, time to first token "
+            f"p50={s['time_to_first_token_p50']:.2f}s "
+            f"p95={s['time_to_first_token_p95']:.2f}s, "
+            f"{s['num_stopped_early']} stopped early\n"
+            f"   tokens: {s['prompt_tokens']} prompt "
+            f"({s['prompt_cache_hit_rate']:.0%} from the prompt cache), "
+            f"{s['completion_tokens']} completion, "
+            f"{s['tokens_per_second']:.0f} tokens/s\n"
+            f"   extraction: {s['num_local_extractions']} local, "
+            f"{s['num_llm_extractions']} llm\n"
+            f"   cost: ${s['cost']:.2f} total, {cost_per_correct} per correct answer"
+        )
+
+    def write_records(self, path: str):
+        """Writes every record as a line of json."""
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as file:
+            for record in self.get_records():
+                file.write(json.dumps(dataclasses.asdict(record), default=str) + "\n")
+        print(f"wrote {len(self.records)} telemetry records to {path}")
+
+
+TELEMETRY = Telemetry()
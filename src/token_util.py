@@ -0,0 +1,110 @@
+"""
+Helper functions for counting prompt tokens locally, so we can make sure a
+prompt fits in the model's context window before we send it.
+
+We use tiktoken if it's installed. Otherwise we fall back to a rough
+estimate (estimate_tokens), which is good enough for budgeting but can be off
+by ~20%. The rate limiter always uses the rough estimate, since it runs
+before every request.
+"""
+
+import functools
+
+try:
+    import tiktoken
+
+    _HAS_TIKTOKEN = True
+except ImportError:
+    _HAS_TIKTOKEN = False
+
+# Context window (prompt + completion tokens) for each model string.
+MODEL_CONTEXT_WINDOWS = {
+    "gpt-3.5-turbo-0125": 16385,
+    "gpt-4-turbo-2024-04-09": 128000,
+    "gpt-4o": 128000,
+    # The fine-tuned models are based on gpt-3.5-turbo-1106.
+    "ft:gpt-3.5-turbo-1106:personal::8qxFN6cX": 16385,
+    "ft:gpt-3.5-turbo-1106:personal::8qxNawaE": 16385,
+}
+# Used for any model that's not in the map above (e.g. the original
+# gpt-3.5-turbo).
+DEFAULT_CONTEXT_WINDOW = 4096
+# How many tokens we leave free for the completion. Our discussions are a
+# couple of sentences per option, so this is plenty.
+COMPLETION_TOKEN_RESERVE = 1024
+
+_CHARS_PER_TOKEN = 4
+# A high detail image is ~765 tokens for a typical 1024x1024 figure.
+_TOKENS_PER_IMAGE = 765
+# Every message has a few tokens of overhead for the role, etc.
+_TOKENS_PER_MESSAGE = 4
+
+
+def _sum_message_tokens(messages, count_text_tokens) -> int:
+    """
+    Adds up the tokens for a list of chat messages, counting the text with
+    `count_text_tokens`.
+    """
+    num_tokens = 0
+    for message in messages:
+        num_tokens += _TOKENS_PER_MESSAGE
+        content = message["content"]
+        if isinstance(content, str):
+            num_tokens += count_text_tokens(content)
+            continue
+        for block in content:
+            if block["type"] == "image_url":
+                num_tokens += _TOKENS_PER_IMAGE
+            else:
+                num_tokens += count_text_tokens(block["text"])
+    return num_tokens
+
+
+def _estimate_text_tokens(text: str) -> int:
+    return len(text) // _CHARS_PER_TOKEN
+
+
+def estimate_tokens(messages) -> int:
+    """
+    Roughly estimates the number of prompt tokens for a list of chat
+    messages (or a plain string), without tokenizing.
+    """
+    if isinstance(messages, str):
+        return _estimate_text_tokens(messages) + 1
+    return _sum_message_tokens(messages, _estimate_text_tokens)
+
+
+@functools.lru_cache(maxsize=None)
+def _get_encoding(model_string: str):
+    try:
+        return tiktoken.encoding_for_model(model_string)
+    except KeyError:
+        # Fine-tuned models aren't known to tiktoken.
+        return tiktoken.get_encoding("cl100k_base")
+
+
+def count_tokens(text: str, model_string: str = "gpt-4o") -> int:
+    if not _HAS_TIKTOKEN:
+        return estimate_tokens(text)
+    return len(_get_encoding(model_string).encode(text))
+
+
+def count_message_tokens(messages, model_string: str = "gpt-4o") -> int:
+    """Counts the prompt tokens for a list of chat messages."""
+    if not _HAS_TIKTOKEN:
+        return estimate_tokens(messages)
+
+    return _sum_message_tokens(
+        messages, lambda text: count_tokens(text, model_string)
+    )
+
+
+def get_context_window(model_string: str) -> int:
+    return MODEL_CONTEXT_WINDOWS.get(model_string, DEFAULT_CONTEXT_WINDOW)
+
+
+def get_prompt_token_budget(
+    model_string: str, completion_tokens: int = COMPLETION_TOKEN_RESERVE
+) -> int:
+    """How many tokens of prompt we can send to the model."""
+    return get_context_window(model_string) - completion_tokens